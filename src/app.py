@@ -1,116 +1,306 @@
-from db import db, User, Connection, Eatery, Review
-from flask import Flask, request
+from db import db, set_sqlite_pragmas, use_explicit_sqlite_transactions, User, Connection, Eatery, Review, TimelineEntry
+from config import load_config
+import timeline
+import search
+import deletion
+import follows
+from pagination import paginate
+from ingest import ingest_reviews, parse_ndjson
+from stats import initialize_statistics, stale_statistics, LEADERBOARD_ORDER
+from cache import ResponseCache
+from metrics import RequestMetrics
+from encoding import ResponseEncoder
+from groupcommit import GroupCommitter
+from recompute import StatsRecomputer
+from graph import FollowGraph
+from flask import Blueprint, Flask, request, Response, stream_with_context
 import json
 import datetime
-from sqlalchemy import func
-
-app = Flask(__name__)
-db_filename = "beli.db" 
-
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
-
-db.init_app(app)
+import functools
+import click
+import collections
+import heapq
+from sqlalchemy.orm import joinedload, selectinload, undefer
+
+# Routes and CLI commands; registered on an app by create_app. cli_group=None keeps the
+# commands at the top level (flask reconcile-stats, not flask api reconcile-stats)
+api = Blueprint("api", __name__, cli_group=None)
+response_cache = ResponseCache()
+request_metrics = RequestMetrics()
+response_encoder = ResponseEncoder()
+write_committer = GroupCommitter()
+stats_recomputer = StatsRecomputer(write_committer)
+follow_graph = FollowGraph()
 
 # -- Generalized responses --------------------------------------------------------
 def success_response(body, code=200):
-    return json.dumps(body), code
+    return response_encoder.dumps(body), code
 
 def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
+    return response_encoder.dumps({"error": message}), code
+
+# Rows fetched per round-trip (and serialized per chunk) when streaming
+STREAM_BATCH_SIZE = 1000
+
+def wants_stream():
+    """
+    Whether the client asked for a full streamed dump (?stream=true, ?format=ndjson,
+    or Accept: application/x-ndjson) instead of a page.
+    """
+    return (request.args.get("stream") in ("1", "true")
+            or wants_ndjson())
+
+def wants_ndjson():
+    """
+    Whether the client asked for newline-delimited JSON.
+    """
+    return (request.args.get("format") == "ndjson"
+            or request.accept_mimetypes.best == "application/x-ndjson")
+
+def stream_response(key, query, serialize):
+    """
+    Stream every row of query as {key: [...]}, or as one JSON object per line if the client
+    wants NDJSON. Rows are pulled from a server-side cursor in batches and serialized
+    one at a time, so memory stays flat however large the table is.
+    """
+    rows = query.yield_per(STREAM_BATCH_SIZE)
+    ndjson = wants_ndjson()
+    dumps = response_encoder.dumps
+
+    def generate():
+        # Send the opening bytes before the query even runs
+        if not ndjson:
+            yield b'{"%s": [' % key.encode()
+        chunk = []
+        first = True
+        for row in rows:
+            if ndjson:
+                chunk.append(dumps(serialize(row)) + b"\n")
+            else:
+                chunk.append((b"" if first else b", ") + dumps(serialize(row)))
+                first = False
+            if len(chunk) == STREAM_BATCH_SIZE:
+                yield b"".join(chunk)
+                chunk = []
+        if chunk:
+            yield b"".join(chunk)
+        if not ndjson:
+            yield b"]}"
+
+    mimetype = "application/x-ndjson" if ndjson else "application/json"
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+# -- Response cache ----------------------------------------------------------------
+def cached_response(kind):
+    """
+    Decorator for GET routes about one user/eatery (kind is "user" or "eatery").
+    Serves the body from response_cache while it is fresh, tags responses with an ETag,
+    and answers a matching If-None-Match with 304 and no body.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            key = (kind, kwargs["%s_id" % kind], request.path)
+            entry = response_cache.get(key)
+            if entry is None:
+                body, code = view(**kwargs)
+                if code != 200:
+                    return body, code
+                entry = response_cache.set(key, body)
+            body, etag = entry
+            response = Response(body)
+            response.set_etag(etag)
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+# Rank ranges wider than this drop every cached user view instead of looking up who moved
+RANK_INVALIDATION_LIMIT = 50
+
+def invalidate_user_ranks(ranks):
+    """
+    Drop cached views of every user now ranked within ranks, the (lo, hi) range returned by
+    update_user_ranking (hi None means down to the last user). A wide range drops all of
+    them at once, which costs at most the cache's size rather than a lookup per moved user.
+    """
+    if ranks is None or not response_cache.has_kind("user"):
+        return
+    lo, hi = ranks
+    if hi is None or hi - lo + 1 > RANK_INVALIDATION_LIMIT:
+        response_cache.invalidate_kind("user")
+        return
+    moved = db.session.query(User.id).filter(User.ratings_count > 0).order_by(*LEADERBOARD_ORDER).offset(lo - 1).limit(hi - lo + 1)
+    for (user_id,) in moved:
+        response_cache.invalidate("user", user_id)
+
+def invalidate_recomputed(user_ids, eatery_ids, ranks):
+    """
+    Drop cached views of users/eateries whose statistics stats_recomputer just recomputed.
+    """
+    for user_id in user_ids:
+        response_cache.invalidate("user", user_id)
+    for eatery_id in eatery_ids:
+        response_cache.invalidate("eatery", eatery_id)
+    invalidate_user_ranks(ranks)
+
+def positive_arg(name, default):
+    """
+    The integer query argument ?name= (default if it is absent). Raises ValueError if it is not a positive integer.
+    """
+    try:
+        value = int(request.args.get(name, default))
+    except ValueError:
+        raise ValueError("%s must be an integer" % name)
+    if value < 1:
+        raise ValueError("%s must be positive" % name)
+    return value
 
-# -- Update rankings/average ratings ---------------------------------------------
-def update_user_rankings():
+def top_limit(default=10, maximum=100):
     """
-    Updates each user's ranking based on how many reviews they have written.
-    More reviews = higher rank (lower number).
+    The ?limit= of a top-N route, capped at maximum. Raises ValueError if it is not a positive integer.
     """
-    # Query review count for each user, ordered by count descending
-    user_review_counts = db.session.query(
-        Review.user_id,
-        func.count(Review.id).label("review_count")
-    ).group_by(Review.user_id).order_by(func.count(Review.id).desc()).all()
+    return min(positive_arg("limit", default), maximum)
 
-    # Assign ranking based on index in sorted list (starting from 1)
-    for rank, (user_id, count) in enumerate(user_review_counts, start=1):
-        user = db.session.get(User, user_id)
-        if user:
-            user.ranking = rank
-            user.ratings_count = count  # Optional: keep this in sync
+# Most ids one multi-get (?ids=) may ask for
+MAX_IDS = 100
 
-    db.session.commit()
+def requested_ids():
+    """
+    The distinct ids in ?ids= (comma-separated), in the order given. Raises ValueError if one
+    is not an integer or there are more than MAX_IDS.
+    """
+    try:
+        ids = [ int(i) for i in request.args["ids"].split(",") if i.strip() ]
+    except ValueError:
+        raise ValueError("ids must be comma-separated integers")
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_IDS:
+        raise ValueError("at most %d ids can be requested at once" % MAX_IDS)
+    return ids
 
-def update_user_average_rating(user_id):
-    """"
-    Update user's average rating based on ratings across all reviews they have written.
+def in_requested_order(rows, ids):
     """
-    user = User.query.filter_by(id=user_id).first()
-    if user is None:
-        return failure_response("user not found")
-    reviews = user.reviews
-    if len(reviews) == 0:
-        user.average_rating = 0
-    else:
-        total = sum([review.rating for review in reviews])
-        user.average_rating = round((float) (total) / len(reviews), 1)
-    user.ratings_count = len(reviews)
-    db.session.commit()
+    Rows (with an id attribute) fetched for ids, in the order of ids, and the ids not found.
+    """
+    by_id = { row.id: row for row in rows }
+    return [ by_id[i] for i in ids if i in by_id ], [ i for i in ids if i not in by_id ]
 
-def update_eatery_average_rating(eatery_id):
-    """"
-    Update eatery's average rating based on ratings across all reviews written about them.
+# -- Eager-loading queries -------------------------------------------------------
+def connections_with_users():
     """
-    eatery = Eatery.query.filter_by(id=eatery_id).first()
-    if eatery is None:
-        return failure_response("eatery not found")
-    reviews = eatery.reviews
-    if len(reviews) == 0:
-        eatery.average_rating = 0
-    else:
-        total = sum([review.rating for review in reviews])
-        eatery.average_rating = round((float) (total) / len(reviews), 1)
-    db.session.commit()
+    Connection query that loads both users in the same SELECT, so serialize() issues no further queries.
+    """
+    return Connection.query.options(
+        joinedload(Connection.follower).undefer(User.ranking), joinedload(Connection.following).undefer(User.ranking)
+    )
+
+def users_with_reviews():
+    """
+    User query that loads every user's reviews in one extra SELECT, so serialize() issues no further queries.
+    """
+    return User.query.options(selectinload(User.reviews), undefer(User.ranking))
+
+# -- User page queries -------------------------------------------------------------
+# Shared by the per-section user routes and the composite profile route
+def followers_page(user_id, args):
+    """
+    One page of a user's followers' rows. Returns (rows, next_cursor); raises ValueError on a bad limit or cursor.
+    """
+    # Paged on connection.follower_id so that ix_connection_following also gives the order
+    followers = db.session.query(*User.columns(), Connection.follower_id).join(
+        Connection, Connection.follower_id == User.id
+    ).filter(Connection.following_id == user_id)
+    return paginate(followers, args, Connection.follower_id)
+
+def following_page(user_id, args):
+    """
+    One page of the rows of the users a user follows. Returns (rows, next_cursor); raises ValueError on a bad limit or cursor.
+    """
+    # Paged on connection.following_id so that the unique (follower_id, following_id) index also gives the order
+    following = db.session.query(*User.columns(), Connection.following_id).join(
+        Connection, Connection.following_id == User.id
+    ).filter(Connection.follower_id == user_id)
+    return paginate(following, args, Connection.following_id)
 
-def initialize_statistics():
+def user_reviews_page(user_id, args):
     """
-    Initialize average ratings for users/eateries + user rankings.
+    One page of a user's reviews, highest rated first. Returns (rows, next_cursor); raises ValueError on a bad limit or cursor.
     """
-    for user in User.query.all():
-        update_user_average_rating(user.id)
-    for eatery in Eatery.query.all():
-        update_eatery_average_rating(eatery.id)
-    update_user_rankings()
+    reviews = db.session.query(*Review.columns()).filter(Review.user_id == user_id)
+    return paginate(reviews, args, Review.rating, Review.id, descending=True)
 
-# Initialize statistics
-with app.app_context():
+def check_statistics(app):
+    """
+    Compare the persisted statistics against a checksum of the review table and log a warning
+    if they disagree. Rebuilding them is left to reconcile-stats so that starting a server
+    never recomputes anything.
+    """
+    with app.app_context():
+        stale = stale_statistics()
+    if stale:
+        app.logger.warning(
+            "Rating aggregates/rankings/follow counts are out of date (%s); run `flask --app app reconcile-stats`.",
+            ", ".join(stale)
+        )
+
+@api.cli.command("reconcile-stats")
+@click.option("--force", is_flag=True, help="Rebuild even if the checksum matches.")
+def reconcile_stats_command(force):
+    """
+    Rebuild running rating aggregates, rankings and follow counts from the Review and Connection
+    tables if they are out of date.
+    """
+    stale = stale_statistics()
+    if not stale and not force:
+        print("Statistics are consistent with the review table, nothing to do.")
+        return
     initialize_statistics()
+    print("Statistics reconciled (out of date: %s)." % (", ".join(stale) or "none"))
 
-@app.route("/")
+@api.cli.command("rebuild-timelines")
+def rebuild_timelines_command():
+    """
+    Rebuild every user's home timeline from the Connection and Review tables.
+    """
+    timeline.rebuild_timelines()
+    print("Timelines rebuilt.")
+
+@api.route("/")
 def hello_world():
     return "Hello world!"
 
 # -- USER ROUTES -------------------------------------------------------------------
 
-@app.route("/api/users/")
+@api.route("/api/users/")
 def get_users():
     """"
-    Get all users
-    """
-    users = User.query.all()
-    return success_response({"users" : [ u.serialize() for u in users ]})
+    Get all users, a page at a time (?limit=&after=), or the users with the given ?ids=1,2,3
+    """
+    if "ids" in request.args:
+        try:
+            ids = requested_ids()
+        except ValueError as e:
+            return failure_response(str(e), 400)
+        users, missing = in_requested_order(users_with_reviews().filter(User.id.in_(ids)), ids)
+        return success_response({"users": [ u.serialize() for u in users ], "missing": missing})
+    try:
+        users, cursor = paginate(users_with_reviews(), request.args, User.id)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return success_response({"users" : [ u.serialize() for u in users ], "next_cursor": cursor})
 
-@app.route("/api/users/<int:user_id>/")
+@api.route("/api/users/<int:user_id>/")
+@cached_response("user")
 def get_user_by_id(user_id):
     """
     Get user by id
     """
-    user = User.query.filter_by(id=user_id).first()
+    user = User.query.options(undefer(User.ranking)).filter_by(id=user_id).first()
     if user is None:
         return failure_response("user not found")
     return success_response(user.serialize())
 
-@app.route("/api/users/", methods=["POST"])
+@api.route("/api/users/", methods=["POST"])
 def create_user():
     """"
     Create user
@@ -132,81 +322,105 @@ def create_user():
     db.session.commit()
     return success_response(user.serialize(), 201)
 
-@app.route("/api/users/<int:user_id>/", methods=["DELETE"])
+@api.route("/api/users/<int:user_id>/", methods=["DELETE"])
 def delete_user_by_id(user_id):
     """"
     Delete user by id
     """
-    user = User.query.filter_by(id=user_id).first()
+    def work():
+        user = db.session.query(*User.columns()).filter_by(id=user_id).first()
+        if user is None:
+            return None, None
+        serialized = User.serialize_row(user)
+        serialized["reviews"] = [
+            Review.serialize_row(r) for r in db.session.query(*Review.columns()).filter_by(user_id=user_id).order_by(Review.id)
+        ]
+        return serialized, deletion.delete_user(user_id, stats_recomputer)
+
+    user, eatery_ids = write_committer.run(work)
     if user is None:
         return failure_response("user not found")
-    db.session.delete(user)
-    db.session.commit() 
-    return success_response(user.serialize())
-
-@app.route("/api/users/<int:user_id>/followers/")
+    stats_recomputer.mark_dirty([], eatery_ids)
+    follow_graph.remove_user(user_id)
+    # Everyone ranked below this user moved up, and their followers'/followings' counts changed
+    response_cache.invalidate_kind("user")
+    for eatery_id in eatery_ids:
+        response_cache.invalidate("eatery", eatery_id)
+    return success_response(user)
+
+@api.route("/api/users/<int:user_id>/followers/")
 def get_user_followers(user_id):
     """
-    Get all followers of a user
+    Get all followers of a user, a page at a time (?limit=&after=)
     """
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return failure_response("user not found")
-    followers = Connection.query.filter_by(following_id=user_id)
-    return success_response({"followers" : [ c.follower.simple_serialize() for c in followers ]})
+    try:
+        followers, cursor = followers_page(user_id, request.args)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return success_response({"followers" : [ User.serialize_row(u) for u in followers ], "next_cursor": cursor})
 
-@app.route("/api/users/<int:user_id>/following/")
+@api.route("/api/users/<int:user_id>/following/")
 def get_user_following(user_id):
     """
-    Get all people this user is following
+    Get all people this user is following, a page at a time (?limit=&after=)
     """
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return failure_response("user not found")
-    following = Connection.query.filter_by(follower_id=user_id)
-    return success_response({"following" : [ c.following.simple_serialize() for c in following ]})
+    try:
+        following, cursor = following_page(user_id, request.args)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return success_response({"following" : [ User.serialize_row(u) for u in following ], "next_cursor": cursor})
 
-@app.route("/api/users/<int:user_id>/reviews/")
+@api.route("/api/users/<int:user_id>/reviews/")
 def get_user_reviews(user_id):
     """
-    Get all reviews, ordered by rating (highest to lowest), made by this user
+    Get all reviews, ordered by rating (highest to lowest), made by this user, a page at a time (?limit=&after=)
     """
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return failure_response("user not found")
-    reviews = Review.query.filter_by(user_id=user_id)
-    sorted_reviews = sorted(reviews, key=lambda r: r.rating, reverse=True)
-
-    return success_response({"reviews": [ r.serialize() for r in sorted_reviews ]})
+    try:
+        reviews, cursor = user_reviews_page(user_id, request.args)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return success_response({"reviews": [ Review.serialize_row(r) for r in reviews ], "next_cursor": cursor})
 
-@app.route("/api/users/<int:user_id>/following_reviews/")
+@api.route("/api/users/<int:user_id>/following_reviews/")
 def get_user_following_reviews(user_id):
     """
-    Get all reviews made by this user's following, sorted from most recent to least recent
+    Get all reviews made by this user's following, sorted from most recent to least recent, a page at a time (?limit=&after=)
     """
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return failure_response("user not found")
-    following = user.following
-    reviews = []
-    for f in following:
-        for r in Review.query.filter_by(user_id=f.id):
-            reviews.append(r) 
-    sorted_reviews =  sorted(reviews, key=lambda r: r.timestamp, reverse=True)
-
-    return success_response({"reviews": [ r.serialize() for r in sorted_reviews ]})
+    # Rows carry review_id for the cursor; their timestamp is the review's, which the entry copies
+    reviews = db.session.query(*Review.columns(), TimelineEntry.review_id).join(
+        TimelineEntry, TimelineEntry.review_id == Review.id
+    ).filter(TimelineEntry.owner_id == user_id)
+    try:
+        reviews, cursor = paginate(reviews, request.args, TimelineEntry.timestamp, TimelineEntry.review_id, descending=True)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return success_response({"reviews": [ Review.serialize_row(r) for r in reviews ], "next_cursor": cursor})
 
-@app.route("/api/users/<int:user_id>/ranking/")
+@api.route("/api/users/<int:user_id>/ranking/")
+@cached_response("user")
 def get_user_ranking(user_id): 
     """
     Get the ranking of a user
     """
-    user = User.query.filter_by(id=user_id).first()
+    user = db.session.query(User.ranking).filter_by(id=user_id).first()
     if user is None:
         return failure_response("user not found")
     return success_response({"ranking": user.ranking})
 
-@app.route("/api/users/<int:user_id>/average_rating/")
+@api.route("/api/users/<int:user_id>/average_rating/")
+@cached_response("user")
 def get_user_average_rating(user_id):
     """
     Get the average rating of a user
@@ -216,7 +430,8 @@ def get_user_average_rating(user_id):
         return failure_response("user not found")
     return success_response({"average_rating": user.average_rating})
 
-@app.route("/api/users/<int:user_id>/rating_count/")
+@api.route("/api/users/<int:user_id>/rating_count/")
+@cached_response("user")
 def get_user_ratings_count(user_id):
     """
     Get the ratings_count of a user
@@ -226,27 +441,218 @@ def get_user_ratings_count(user_id):
         return failure_response("user not found")
     return success_response({"ratings_count": user.ratings_count})
 
+# Sections of a profile (?fields=), in response order. The user's ranking, average rating and
+# rating count come with their own row; each list takes one more query
+PROFILE_SECTIONS = ("user", "ranking", "average_rating", "ratings_count", "followers", "following", "reviews")
+
+# List section -> (page query, model its rows serialize as)
+PROFILE_LISTS = {
+    "followers": (followers_page, User),
+    "following": (following_page, User),
+    "reviews": (user_reviews_page, Review)
+}
+
+# Rows per list section unless ?limit= says otherwise
+PROFILE_PAGE_SIZE = 20
+
+@api.route("/api/users/<int:user_id>/profile/")
+def get_user_profile(user_id):
+    """
+    Get what a user's profile shows in one request: the user, their ranking, average rating and rating count,
+    and the first page (?limit=, default 20) of their followers, following and reviews, with a next_cursor
+    for each list's own route. ?fields= (comma-separated) picks which of these to return
+    """
+    fields = request.args.get("fields")
+    sections = PROFILE_SECTIONS if fields is None else [ f.strip() for f in fields.split(",") if f.strip() ]
+    unknown = [ f for f in sections if f not in PROFILE_SECTIONS ]
+    if unknown:
+        return failure_response("unknown fields %s (expected some of %s)" % (", ".join(unknown), ", ".join(PROFILE_SECTIONS)), 400)
+
+    user = db.session.query(*User.columns()).filter_by(id=user_id).first()
+    if user is None:
+        return failure_response("user not found")
+    user = User.serialize_row(user)
+    profile = {}
+    if "user" in sections:
+        profile["user"] = user
+    for section in ("ranking", "average_rating", "ratings_count"):
+        if section in sections:
+            profile[section] = user[section]
+    args = {"limit": request.args.get("limit", PROFILE_PAGE_SIZE)}
+    next_cursors = {}
+    try:
+        for section, (page, model) in PROFILE_LISTS.items():
+            if section in sections:
+                rows, next_cursors[section] = page(user_id, args)
+                profile[section] = [ model.serialize_row(r) for r in rows ]
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    if next_cursors:
+        profile["next_cursors"] = next_cursors
+    return success_response(profile)
+
+# -- CACHE ROUTES ------------------------------------------------------------
+
+@api.route("/api/cache/stats/")
+def get_cache_stats():
+    """
+    Get the response cache's hit/miss counters
+    """
+    return success_response(response_cache.stats())
+
+@api.route("/metrics")
+def get_metrics():
+    """
+    Per-route request metrics in the Prometheus text format
+    """
+    return Response(request_metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# -- ADMIN ROUTES ------------------------------------------------------------
+
+@api.route("/api/admin/flush/", methods=["POST"])
+def flush_statistics():
+    """
+    Recompute the rating aggregates/rankings still queued (STATS_MODE=background) now, and get the queue's counters
+    """
+    flushed = stats_recomputer.flush()
+    return success_response({"flushed": flushed, "recompute": stats_recomputer.stats()})
+
+# -- LEADERBOARD ROUTES ------------------------------------------------------
+
+@api.route("/api/leaderboard/")
+def get_leaderboard():
+    """
+    Get the top N ranked users (?limit=, default 10, max 100), plus a user's own rank if ?user_id= is given
+    """
+    try:
+        limit = top_limit()
+        user_id = positive_arg("user_id", None) if "user_id" in request.args else None
+    except ValueError as e:
+        return failure_response(str(e), 400)
+
+    users = db.session.query(*User.columns()).filter(User.ratings_count > 0).order_by(*LEADERBOARD_ORDER).limit(limit)
+    body = {"leaderboard": [ User.serialize_row(u) for u in users ]}
+    if user_id is not None:
+        user = db.session.query(User.id, User.ranking).filter_by(id=user_id).first()
+        if user is None:
+            return failure_response("user not found")
+        body["user"] = {"id": user.id, "ranking": user.ranking}
+    return success_response(body)
+
+# -- RECOMMENDATION ROUTES ---------------------------------------------------
+
+@api.route("/api/users/<int:user_id>/recommendations/users/")
+def get_recommended_users(user_id):
+    """
+    Get people this user may know: users followed by the people they follow, most mutual follows first (?limit=, default 10, max 100)
+    """
+    try:
+        limit = top_limit()
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    if db.session.query(User.id).filter_by(id=user_id).first() is None:
+        return failure_response("user not found")
+
+    suggested = follow_graph.suggested_follows(user_id, limit)
+    users = {}
+    if suggested:
+        users = { u.id: u for u in db.session.query(*User.columns()).filter(User.id.in_([ id for id, _ in suggested ])) }
+    return success_response({"users": [
+        dict(User.serialize_row(users[id]), mutual_count=mutuals) for id, mutuals in suggested if id in users
+    ]})
+
+@api.route("/api/users/<int:user_id>/recommendations/eateries/")
+def get_recommended_eateries(user_id):
+    """
+    Get eateries this user's network loves: eateries reviewed by the people they follow and not by them,
+    each review counting rating / 10, best first (?limit=, default 10, max 100)
+    """
+    try:
+        limit = top_limit()
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    if db.session.query(User.id).filter_by(id=user_id).first() is None:
+        return failure_response("user not found")
+
+    network = follow_graph.following_of(user_id)
+    reviews = db.session.query(Review.user_id, Review.eatery_id, Review.rating).filter(
+        Review.user_id.in_(network + [user_id])
+    )
+    visits = collections.Counter()
+    weights = collections.Counter()
+    reviewed = set()
+    for reviewer_id, eatery_id, rating in reviews:
+        if reviewer_id == user_id:
+            reviewed.add(eatery_id)
+        else:
+            visits[eatery_id] += 1
+            weights[eatery_id] += rating / 10
+    best = heapq.nsmallest(
+        limit, (e for e in weights.items() if e[0] not in reviewed), key=lambda item: (-item[1], item[0])
+    )
+    eateries = {}
+    if best:
+        eateries = { e.id: e for e in db.session.query(*Eatery.columns()).filter(Eatery.id.in_([ id for id, _ in best ])) }
+    return success_response({"eateries": [
+        dict(Eatery.serialize_row(eateries[id]), visits=visits[id], weight=round(weight, 2))
+        for id, weight in best if id in eateries
+    ]})
+
+# -- SEARCH ROUTES -----------------------------------------------------------
+
+@api.route("/api/search/")
+def search_text():
+    """
+    Full-text search of eateries (name, location, description) and reviews (text), best match first.
+    Every word of ?q= must match; the last one also matches as a prefix. ?type=eateries or ?type=reviews
+    searches one of them a page at a time (?limit=&after=); without ?type=, get the first page of each
+    """
+    if db.engine.dialect.name != "sqlite":
+        return failure_response("search needs the SQLite FTS5 index", 501)
+    kind = request.args.get("type")
+    if kind is not None and kind not in search.SEARCHES:
+        return failure_response("type must be one of: %s" % ", ".join(search.SEARCHES), 400)
+    if kind is None and request.args.get("after"):
+        return failure_response("after needs a type", 400)
+    try:
+        match = search.match_expression(request.args.get("q"))
+        if kind is not None:
+            rows, cursor = search.search(kind, match, request.args)
+            return success_response({kind: [ search.serialize_result(kind, r) for r in rows ], "next_cursor": cursor})
+        body = {}
+        for kind in search.SEARCHES:
+            rows, _ = search.search(kind, match, request.args)
+            body[kind] = [ search.serialize_result(kind, r) for r in rows ]
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return success_response(body)
+
 # -- CONNECTION ROUTES -------------------------------------------------------
 
-@app.route("/api/connections/")
+@api.route("/api/connections/")
 def get_connections():
     """
-    Get all connections
+    Get all connections, a page at a time (?limit=&after=), or all at once as a stream (?stream=true / NDJSON)
     """
-    connections = Connection.query.all()
-    return success_response({"connections" : [ c.serialize() for c in connections ]})
+    if wants_stream():
+        return stream_response("connections", connections_with_users().order_by(Connection.id), lambda c: c.serialize())
+    try:
+        connections, cursor = paginate(connections_with_users(), request.args, Connection.id)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return success_response({"connections" : [ c.serialize() for c in connections ], "next_cursor": cursor})
 
-@app.route("/api/connections/<int:connection_id>/")
+@api.route("/api/connections/<int:connection_id>/")
 def get_connection_by_id(connection_id):
     """
     Get connection by id
     """
-    connection = Connection.query.filter_by(id=connection_id).first()
+    connection = connections_with_users().filter_by(id=connection_id).first()
     if connection is None:
         return failure_response("connection not found")
     return success_response(connection.serialize())
 
-@app.route("/api/connections/", methods=["POST"])
+@api.route("/api/connections/", methods=["POST"])
 def follow():
     """"
     Have one user follow another
@@ -263,24 +669,23 @@ def follow():
     if follower_id == following_id:
         return failure_response("user cannot follow self", 400)
 
-    follower = User.query.filter_by(id=follower_id).first()
-    following = User.query.filter_by(id=following_id).first()
-    if follower is None:
-        return failure_response("follower not found")
-    if following is None:
-        return failure_response("following not found")
-
-    connection = Connection(follower_id=follower_id, following_id=following_id)
-    db.session.add(connection)
-
-    # Update follower/following counts
-    follower.following_count = follower.following_count + 1
-    following.follower_count = following.follower_count + 1
-
-    db.session.commit()
-    return success_response(connection.serialize())
+    def work():
+        # Following someone already followed is a no-op that returns the existing connection
+        connection, made = follows.follow(follower_id, following_id)
+        if connection is None:
+            return None, False, follows.missing_user(follower_id, following_id)
+        return follows.serialize_connection(connection.id, connection.timestamp, follower_id, following_id), made, None
 
-@app.route("/api/connections/", methods=["DELETE"])
+    connection, made, error = write_committer.run(work)
+    if connection is None:
+        return failure_response(error)
+    if made:
+        follow_graph.follow(follower_id, following_id)
+        response_cache.invalidate("user", follower_id)
+        response_cache.invalidate("user", following_id)
+    return success_response(connection)
+
+@api.route("/api/connections/", methods=["DELETE"])
 def unfollow():
     """"
     Have one user unfollow another
@@ -294,36 +699,68 @@ def unfollow():
     following_id = body.get("following_id")
     if follower_id is None or following_id is None:
         return failure_response("Missing required fields!", 400)
-    
-    follower = User.query.filter_by(id=follower_id).first()
-    following = User.query.filter_by(id=following_id).first()
-    if follower is None:
-        return failure_response("follower not found")
-    if following is None:
-        return failure_response("following not found")
-
-    connection = Connection.query.filter_by(follower_id=follower_id, following_id=following_id).first()
-    if connection is None:
-        return failure_response("connection does not exist", 404)
-    db.session.delete(connection)
-   
-    follower.following_count = follower.following_count - 1
-    following.follower_count = following.follower_count - 1
-    db.session.commit()
 
-    return success_response(connection.serialize())
+    def work():
+        connection = follows.unfollow(follower_id, following_id)
+        if connection is None:
+            return None, follows.missing_user(follower_id, following_id) or "connection does not exist"
+        return follows.serialize_connection(connection.id, connection.timestamp, follower_id, following_id), None
+
+    connection, error = write_committer.run(work)
+    if connection is None:
+        return failure_response(error)
+    follow_graph.unfollow(follower_id, following_id)
+    response_cache.invalidate("user", follower_id)
+    response_cache.invalidate("user", following_id)
+    return success_response(connection)
 
 # -- EATERY ROUTES ----------------------------------------------------------
 
-@app.route("/api/eateries/")
+@api.route("/api/eateries/")
 def get_eateries():
     """"
-    Get all eateries
-    """
-    eateries = Eatery.query.all()
-    return success_response({"eateries": [ e.serialize() for e in eateries ]})
+    Get all eateries, a page at a time (?limit=&after=), or the eateries with the given ?ids=1,2,3
+    """
+    if "ids" in request.args:
+        try:
+            ids = requested_ids()
+        except ValueError as e:
+            return failure_response(str(e), 400)
+        eateries, missing = in_requested_order(db.session.query(*Eatery.columns()).filter(Eatery.id.in_(ids)), ids)
+        return success_response({"eateries": [ Eatery.serialize_row(e) for e in eateries ], "missing": missing})
+    try:
+        eateries, cursor = paginate(db.session.query(*Eatery.columns()), request.args, Eatery.id)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return success_response({"eateries": [ Eatery.serialize_row(e) for e in eateries ], "next_cursor": cursor})
 
-@app.route("/api/eateries/<int:eatery_id>/")
+@api.route("/api/eateries/top/")
+def get_top_eateries():
+    """
+    Get the top K eateries by score (?limit=, default 10, max 100), optionally at one ?location=,
+    among those with at least ?min_reviews= reviews (default 1)
+    """
+    try:
+        limit = top_limit()
+        min_reviews = positive_arg("min_reviews", 1)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+
+    # Walks ix_eatery_score (or ix_eatery_location_score) from the top, so the cost is K rows
+    # plus any skipped for having too few reviews, not the size of the table
+    eateries = db.session.query(*Eatery.columns(), Eatery.ratings_count, Eatery.score).filter(
+        Eatery.ratings_count >= min_reviews
+    )
+    location = request.args.get("location")
+    if location is not None:
+        eateries = eateries.filter(Eatery.location == location)
+    eateries = eateries.order_by(Eatery.score.desc(), Eatery.id).limit(limit)
+    return success_response({"eateries": [
+        dict(Eatery.serialize_row(e), ratings_count=e.ratings_count, score=round(e.score, 3)) for e in eateries
+    ]})
+
+@api.route("/api/eateries/<int:eatery_id>/")
+@cached_response("eatery")
 def get_eatery_by_id(eatery_id):
     """
     Get eatery by id
@@ -333,7 +770,7 @@ def get_eatery_by_id(eatery_id):
         return failure_response("eatery not found")
     return success_response(eatery.serialize())
 
-@app.route("/api/eateries/", methods=["POST"])
+@api.route("/api/eateries/", methods=["POST"])
 def create_eatery():
     """
     Create eatery
@@ -354,30 +791,44 @@ def create_eatery():
     db.session.commit()
     return success_response(eatery.serialize(), 201)
 
-@app.route("/api/eateries/<int:eatery_id>/", methods=["DELETE"])
+@api.route("/api/eateries/<int:eatery_id>/", methods=["DELETE"])
 def delete_eatery_by_id(eatery_id):
     """"
     Delete eatery by id
     """
-    eatery = Eatery.query.filter_by(id=eatery_id).first()
+    def work():
+        eatery = db.session.query(*Eatery.columns()).filter_by(id=eatery_id).first()
+        if eatery is None:
+            return None, None, None
+        return (Eatery.serialize_row(eatery),) + deletion.delete_eatery(eatery_id, stats_recomputer)
+
+    eatery, user_ids, ranks = write_committer.run(work)
     if eatery is None:
         return failure_response("eatery not found")
-    db.session.delete(eatery)
-    db.session.commit()
-    return success_response(eatery.serialize())
-
-@app.route("/api/eateries/<int:eatery_id>/reviews/")
+    stats_recomputer.mark_dirty(user_ids, [])
+    response_cache.invalidate("eatery", eatery_id)
+    for user_id in user_ids:
+        response_cache.invalidate("user", user_id)
+    invalidate_user_ranks(ranks)
+    return success_response(eatery)
+
+@api.route("/api/eateries/<int:eatery_id>/reviews/")
 def get_eatery_reviews(eatery_id):
     """
-    Get all reviews for this eatery
+    Get all reviews for this eatery, most recent first, a page at a time (?limit=&after=)
     """
     eatery = Eatery.query.filter_by(id=eatery_id).first()
     if eatery is None:
         return failure_response("eatery not found")
-    reviews = Review.query.filter_by(eatery_id=eatery_id)
-    return success_response({"reviews": [ r.serialize() for r in reviews ]})
-
-@app.route("/api/eateries/<int:eatery_id>/rating/")
+    try:
+        reviews = db.session.query(*Review.columns()).filter(Review.eatery_id == eatery_id)
+        reviews, cursor = paginate(reviews, request.args, Review.timestamp, Review.id, descending=True)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return success_response({"reviews": [ Review.serialize_row(r) for r in reviews ], "next_cursor": cursor})
+
+@api.route("/api/eateries/<int:eatery_id>/rating/")
+@cached_response("eatery")
 def get_average_rating_eatery(eatery_id):
     """
     Get the average rating of an eatery
@@ -389,15 +840,20 @@ def get_average_rating_eatery(eatery_id):
 
 # -- REVIEW ROUTES ----------------------------------------------------------
 
-@app.route("/api/reviews/")
+@api.route("/api/reviews/")
 def get_reviews():
     """
-    Get all reviews
+    Get all reviews, most recent first, a page at a time (?limit=&after=), or all at once as a stream (?stream=true / NDJSON)
     """
-    reviews = Review.query.all()
-    return success_response({"reviews": [ r.serialize() for r in reviews ]})
+    if wants_stream():
+        return stream_response("reviews", db.session.query(*Review.columns()).order_by(Review.id), Review.serialize_row)
+    try:
+        reviews, cursor = paginate(db.session.query(*Review.columns()), request.args, Review.timestamp, Review.id, descending=True)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return success_response({"reviews": [ Review.serialize_row(r) for r in reviews ], "next_cursor": cursor})
 
-@app.route("/api/reviews/<int:review_id>/")
+@api.route("/api/reviews/<int:review_id>/")
 def get_review_by_id(review_id):
     """
     Get review by id
@@ -407,7 +863,7 @@ def get_review_by_id(review_id):
         return failure_response("review not found")
     return success_response(review.serialize())
 
-@app.route("/api/reviews/", methods=["POST"])
+@api.route("/api/reviews/", methods=["POST"])
 def create_review():
     """
     Create a review 
@@ -423,63 +879,145 @@ def create_review():
     review_text = body.get("review_text")
     if user_id is None or eatery_id is None or rating is None:
         return failure_response("Missing required fields!", 400)
-    
-    review = Review(user_id=user_id, eatery_id=eatery_id, rating=rating, review_text=review_text)
-    db.session.add(review)
-    db.session.commit()
-    # Update all user rankings; update this user's average rating; update this eatery's average rating
-    update_user_rankings()
-    update_user_average_rating(user_id)
-    update_eatery_average_rating(eatery_id)
 
-    return success_response(review.serialize(), 201)
+    def work():
+        # Looked up inside the unit, once it holds the write lock
+        if db.session.query(User.id).filter_by(id=user_id).first() is None:
+            return None, None, "user not found"
+        if db.session.query(Eatery.id).filter_by(id=eatery_id).first() is None:
+            return None, None, "eatery not found"
+        review = Review(user_id=user_id, eatery_id=eatery_id, rating=rating, review_text=review_text)
+        db.session.add(review)
+        db.session.flush()
+        timeline.fan_out_review(review)
+        # Fold this rating into the user's/eatery's running aggregates (or leave them to the recomputer)
+        return review.serialize(), stats_recomputer.rating_changed(user_id, eatery_id, rating, 1), None
+
+    review, ranks, error = write_committer.run(work)
+    if review is None:
+        return failure_response(error)
+    stats_recomputer.mark_dirty([user_id], [eatery_id])
+    response_cache.invalidate("user", user_id)
+    response_cache.invalidate("eatery", eatery_id)
+    invalidate_user_ranks(ranks)
+
+    return success_response(review, 201)
 
-@app.route("/api/reviews/<int:review_id>/", methods=["DELETE"])
+@api.route("/api/reviews/bulk/", methods=["POST"])
+def create_reviews_bulk():
+    """
+    Create many reviews at once, from a JSON list (or {"reviews": [...]}) or an NDJSON body
+    (Content-Type: application/x-ndjson). Rows that are invalid or conflict with an existing
+    review are skipped and reported by index
+    """
+    if request.mimetype == "application/x-ndjson":
+        items = parse_ndjson(request.stream)
+    else:
+        try:
+            body = json.loads(request.data)
+        except:
+            return failure_response("Invalid JSON format!", 400)
+        items = body.get("reviews") if isinstance(body, dict) else body
+        if not isinstance(items, list):
+            return failure_response("Expected a list of reviews!", 400)
+
+    result = ingest_reviews(items, run=write_committer.run)
+    # Aggregates and ranks may have moved for many users and eateries
+    response_cache.invalidate_kind("user")
+    response_cache.invalidate_kind("eatery")
+
+    return success_response(result, 201 if result["inserted"] else 200)
+
+@api.route("/api/reviews/<int:review_id>/", methods=["DELETE"])
 def delete_review_by_id(review_id):
     """"
     Delete review by id
     """
-    review = Review.query.filter_by(id=review_id).first()
+    def work():
+        review = Review.query.filter_by(id=review_id).with_for_update().first()
+        if review is None:
+            return None, None
+        # Timeline entries first: databases created before ON DELETE CASCADE would refuse the review's delete
+        timeline.remove_review([review_id])
+        db.session.delete(review)
+        return review.serialize(), stats_recomputer.rating_changed(review.user_id, review.eatery_id, -review.rating, -1)
+
+    review, ranks = write_committer.run(work)
     if review is None:
         return failure_response("review not found")
-    db.session.delete(review)
-    db.session.commit()
+    stats_recomputer.mark_dirty([review["user_id"]], [review["eatery_id"]])
+    response_cache.invalidate("user", review["user_id"])
+    response_cache.invalidate("eatery", review["eatery_id"])
+    invalidate_user_ranks(ranks)
 
-    update_user_rankings()
-    update_user_average_rating(review.user_id)
-    update_eatery_average_rating(review.eatery_id)
+    return success_response(review)
 
-    return success_response(review.serialize())
-
-@app.route("/api/reviews/<int:review_id>/", methods=["PUT"])
+@api.route("/api/reviews/<int:review_id>/", methods=["PUT"])
 def edit_review(review_id):
     """
     Edit a review by id
     """
-    review = Review.query.filter_by(id=review_id).first()
-    if review is None:
-        return failure_response("review not found")
-
     try:
         body = json.loads(request.data)
     except:
         return failure_response("Invalid JSON format!", 400)
-   
-    rating = body.get("rating", review.rating)
-    review_text = body.get("review_text", review.review_text)
-    timestamp = datetime.datetime.now()
-    if not (1 <= rating <= 10):
-        return failure_response("rating must be between 1 and 10", 400)
-    review.rating = rating
-    review.review_text = review_text
-    review.timestamp = timestamp
 
-    db.session.commit()
+    def work():
+        review = Review.query.filter_by(id=review_id).with_for_update().first()
+        if review is None:
+            return None, None
+        rating = body.get("rating", review.rating)
+        review_text = body.get("review_text", review.review_text)
+        if not (1 <= rating <= 10):
+            raise ValueError("rating must be between 1 and 10")
+        delta = rating - review.rating
+        review.rating = rating
+        review.review_text = review_text
+        review.timestamp = datetime.datetime.now()
+        timeline.touch_review(review)
+
+        # Editing bumps the review's timestamp, which can reorder ties in the leaderboard
+        return review.serialize(), stats_recomputer.rating_changed(review.user_id, review.eatery_id, delta, 0)
 
-    update_user_average_rating(review.user_id)
-    update_eatery_average_rating(review.eatery_id)
+    try:
+        review, ranks = write_committer.run(work)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    if review is None:
+        return failure_response("review not found")
+    stats_recomputer.mark_dirty([review["user_id"]], [review["eatery_id"]])
+    response_cache.invalidate("user", review["user_id"])
+    response_cache.invalidate("eatery", review["eatery_id"])
+    invalidate_user_ranks(ranks)
 
-    return success_response(review.serialize())
+    return success_response(review)
     
+# -- App factory -------------------------------------------------------------------
+def create_app(profile=None, check_stats=True):
+    """
+    Build and configure an app. profile picks a config.PROFILES entry (default: BELI_ENV).
+    Servers should create one app per process: wsgi.py does, and under gunicorn it is created
+    once in the master (preload_app) so the statistics check runs once, not once per worker.
+    """
+    app = Flask(__name__)
+    load_config(app, profile)
+    db.init_app(app)
+    with app.app_context():
+        set_sqlite_pragmas(db.engine, app.config["SQLITE_PRAGMAS"])
+        if app.config["METRICS_ENABLED"]:
+            request_metrics.init_app(app, db.engine)
+        use_explicit_sqlite_transactions(db.engine)
+        write_committer.init_app(app, db.engine)
+    # After the metrics hooks, so that their after_request (run last) counts compressed bytes
+    response_encoder.init_app(app)
+    stats_recomputer.init_app(app, on_recompute=invalidate_recomputed)
+    follow_graph.init_app(app)
+    response_cache.init_app(app)
+    app.register_blueprint(api)
+    if check_stats:
+        check_statistics(app)
+    return app
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    app = create_app()
+    app.run(host="0.0.0.0", port=5000, debug=app.config["DEBUG"])
\ No newline at end of file
@@ -0,0 +1,6 @@
+"""
+ASGI entry point for the async read API (see async_api.py), e.g. `uvicorn asgi:app`.
+"""
+from async_api import create_async_app
+
+app = create_async_app()
@@ -0,0 +1,206 @@
+"""
+Asyncio read API for the high fan-in read routes, served by an ASGI server.
+
+These routes spend most of their time waiting on the database. Under app.py's WSGI workers
+each waiting request holds a whole thread; here one process serves many of them at once,
+awaiting queries through an async SQLAlchemy engine (aiosqlite, or asyncpg for PostgreSQL).
+Paths, parameters, pagination and response bodies match app.py's, and the models, row
+serializers, pagination helpers and configuration profiles are shared with it. Writes stay
+on the WSGI app.
+
+Usage: uvicorn asgi:app --port 5001
+"""
+import os
+from flask import Config
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response
+from starlette.routing import Route
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from config import apply_profile, async_database_url, async_engine_options, instance_database_url
+from db import set_sqlite_pragmas, User, Connection, Eatery, Review, TimelineEntry
+from encoding import ResponseEncoder
+from stats import LEADERBOARD_ORDER
+from pagination import page_query, page_result
+
+# app.py's instance folder, which relative SQLite paths point into for both apps
+INSTANCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance")
+
+response_encoder = ResponseEncoder()
+
+# -- Generalized responses --------------------------------------------------------
+def success_response(body, code=200):
+    return Response(response_encoder.dumps(body), code, media_type="application/json")
+
+def failure_response(message, code=404):
+    return Response(response_encoder.dumps({"error": message}), code, media_type="application/json")
+
+async def exists(session, model, entity_id):
+    """
+    Whether a row with this id exists.
+    """
+    return (await session.execute(select(model.id).where(model.id == entity_id))).first() is not None
+
+async def fetch_page(session, query, args, *keys, descending=False):
+    """
+    Async counterpart of pagination.paginate for a select(). Returns (rows, next_cursor).
+    Raises ValueError on a bad limit or cursor.
+    """
+    query, limit = page_query(query, args, *keys, descending=descending)
+    rows = (await session.execute(query)).all()
+    return page_result(rows, limit, *keys)
+
+async def review_page(request, key, query, *keys):
+    """
+    Response for one page of review rows from query, newest (highest keys) first, under key.
+    """
+    async with request.app.state.session() as session:
+        try:
+            reviews, cursor = await fetch_page(session, query, request.query_params, *keys, descending=True)
+        except ValueError as e:
+            return failure_response(str(e), 400)
+    return success_response({key: [ Review.serialize_row(r) for r in reviews ], "next_cursor": cursor})
+
+# -- USER ROUTES -------------------------------------------------------------------
+async def get_user_followers(request):
+    """
+    Get all followers of a user, a page at a time (?limit=&after=)
+    """
+    user_id = request.path_params["user_id"]
+    async with request.app.state.session() as session:
+        if not await exists(session, User, user_id):
+            return failure_response("user not found")
+        followers = select(*User.columns(), Connection.follower_id).join(
+            Connection, Connection.follower_id == User.id
+        ).where(Connection.following_id == user_id)
+        try:
+            followers, cursor = await fetch_page(session, followers, request.query_params, Connection.follower_id)
+        except ValueError as e:
+            return failure_response(str(e), 400)
+    return success_response({"followers" : [ User.serialize_row(u) for u in followers ], "next_cursor": cursor})
+
+async def get_user_following(request):
+    """
+    Get all people this user is following, a page at a time (?limit=&after=)
+    """
+    user_id = request.path_params["user_id"]
+    async with request.app.state.session() as session:
+        if not await exists(session, User, user_id):
+            return failure_response("user not found")
+        following = select(*User.columns(), Connection.following_id).join(
+            Connection, Connection.following_id == User.id
+        ).where(Connection.follower_id == user_id)
+        try:
+            following, cursor = await fetch_page(session, following, request.query_params, Connection.following_id)
+        except ValueError as e:
+            return failure_response(str(e), 400)
+    return success_response({"following" : [ User.serialize_row(u) for u in following ], "next_cursor": cursor})
+
+async def get_user_reviews(request):
+    """
+    Get all reviews, ordered by rating (highest to lowest), made by this user, a page at a time (?limit=&after=)
+    """
+    user_id = request.path_params["user_id"]
+    async with request.app.state.session() as session:
+        if not await exists(session, User, user_id):
+            return failure_response("user not found")
+    reviews = select(*Review.columns()).where(Review.user_id == user_id)
+    return await review_page(request, "reviews", reviews, Review.rating, Review.id)
+
+async def get_user_following_reviews(request):
+    """
+    Get all reviews made by this user's following, sorted from most recent to least recent, a page at a time (?limit=&after=)
+    """
+    user_id = request.path_params["user_id"]
+    async with request.app.state.session() as session:
+        if not await exists(session, User, user_id):
+            return failure_response("user not found")
+    reviews = select(*Review.columns(), TimelineEntry.review_id).join(
+        TimelineEntry, TimelineEntry.review_id == Review.id
+    ).where(TimelineEntry.owner_id == user_id)
+    return await review_page(request, "reviews", reviews, TimelineEntry.timestamp, TimelineEntry.review_id)
+
+async def get_leaderboard(request):
+    """
+    Get the top N ranked users (?limit=, default 10, max 100), plus a user's own rank if ?user_id= is given
+    """
+    # Same checks, in the same order, as app.py's positive_arg
+    args = { "limit": request.query_params.get("limit", 10), "user_id": request.query_params.get("user_id") }
+    for name, value in args.items():
+        if value is None:
+            continue
+        try:
+            args[name] = int(value)
+        except ValueError:
+            return failure_response("%s must be an integer" % name, 400)
+        if args[name] < 1:
+            return failure_response("%s must be positive" % name, 400)
+    limit, user_id = min(args["limit"], 100), args["user_id"]
+
+    async with request.app.state.session() as session:
+        users = await session.execute(
+            select(*User.columns()).where(User.ratings_count > 0).order_by(*LEADERBOARD_ORDER).limit(limit)
+        )
+        body = {"leaderboard": [ User.serialize_row(u) for u in users ]}
+        if user_id is not None:
+            user = (await session.execute(select(User.id, User.ranking).where(User.id == user_id))).first()
+            if user is None:
+                return failure_response("user not found")
+            body["user"] = {"id": user.id, "ranking": user.ranking}
+    return success_response(body)
+
+# -- EATERY ROUTES -----------------------------------------------------------------
+async def get_eatery_reviews(request):
+    """
+    Get all reviews for this eatery, most recent first, a page at a time (?limit=&after=)
+    """
+    eatery_id = request.path_params["eatery_id"]
+    async with request.app.state.session() as session:
+        if not await exists(session, Eatery, eatery_id):
+            return failure_response("eatery not found")
+    reviews = select(*Review.columns()).where(Review.eatery_id == eatery_id)
+    return await review_page(request, "reviews", reviews, Review.timestamp, Review.id)
+
+# -- REVIEW ROUTES -----------------------------------------------------------------
+async def get_reviews(request):
+    """
+    Get all reviews, most recent first, a page at a time (?limit=&after=)
+    """
+    return await review_page(request, "reviews", select(*Review.columns()), Review.timestamp, Review.id)
+
+ROUTES = [
+    Route("/api/users/{user_id:int}/followers/", get_user_followers),
+    Route("/api/users/{user_id:int}/following/", get_user_following),
+    Route("/api/users/{user_id:int}/reviews/", get_user_reviews),
+    Route("/api/users/{user_id:int}/following_reviews/", get_user_following_reviews),
+    Route("/api/leaderboard/", get_leaderboard),
+    Route("/api/eateries/{eatery_id:int}/reviews/", get_eatery_reviews),
+    Route("/api/reviews/", get_reviews),
+]
+
+# -- App factory -------------------------------------------------------------------
+def create_async_app(profile=None):
+    """
+    Build the ASGI app. profile picks a config.PROFILES entry (default: BELI_ENV); the database,
+    pool sizes and SQLite PRAGMAs come from the same configuration as create_app.
+    """
+    config = Config(os.path.dirname(INSTANCE_PATH))
+    apply_profile(config, profile)
+    response_encoder.configure(config)
+    url = instance_database_url(config["SQLALCHEMY_DATABASE_URI"], INSTANCE_PATH)
+    engine = create_async_engine(
+        async_database_url(url), echo=config["SQLALCHEMY_ECHO"], **async_engine_options(config)
+    )
+    set_sqlite_pragmas(engine.sync_engine, config["SQLITE_PRAGMAS"])
+
+    # Starlette only offers gzip; zstd/br are negotiated by the WSGI app alone
+    middleware = [
+        Middleware(GZipMiddleware, minimum_size=config["COMPRESS_MIN_BYTES"])
+    ] if "gzip" in response_encoder.encodings else []
+    app = Starlette(debug=config["DEBUG"], routes=ROUTES, middleware=middleware, on_shutdown=[engine.dispose])
+    app.state.engine = engine
+    app.state.session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    return app
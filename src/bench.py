@@ -0,0 +1,650 @@
+"""
+Benchmarks for the backend. Each benchmark prints its results as JSON.
+
+Usage:
+    python3 bench.py serializers [--rows N] [--repeat R]
+    python3 bench.py concurrency [--clients C] [--requests N] [--path P] [--threads T] [--db-latency-ms MS]
+    python3 bench.py routes [--users U] [--reviews-per-user R] [--requests N] [--output FILE]
+    python3 bench.py writes [--clients C] [--writes N] [--group-commit-ms MS ...] [--stats-mode MODE ...]
+    python3 bench.py follows [--clients C] [--requests N] [--users U] [--group-commit-ms MS ...]
+    python3 bench.py encoding [--requests N] [--path P] [--encoder E ...] [--encoding E ...]
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from flask import Flask
+from sqlalchemy import event, func, insert
+from sqlalchemy.engine import Engine
+from db import db, count_queries, User, Connection, Eatery, Review
+from stats import initialize_statistics
+import synthetic
+
+def make_app(uri="sqlite://"):
+    """
+    Standalone app bound to its own (by default in-memory) database, so benchmarks never touch beli.db.
+    """
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = uri
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    return app
+
+def insert_reviews(rows):
+    """
+    Insert rows reviews, spread over 100 eateries and as many users as needed.
+    """
+    eateries = 100
+    users = rows // eateries + 1
+    now = datetime.datetime.now()
+    db.session.execute(insert(Eatery), [
+        {"name": "Eatery %d" % i, "location": "Hall %d" % i, "average_rating": 0} for i in range(eateries)
+    ])
+    db.session.execute(insert(User), [
+        {"name": "User %d" % i, "username": "user%d" % i, "timestamp": now} for i in range(users)
+    ])
+    db.session.execute(insert(Review), [
+        {"user_id": i // eateries + 1, "eatery_id": i % eateries + 1, "rating": i % 10 + 1,
+         "review_text": "review %d" % i, "timestamp": now}
+        for i in range(rows)
+    ])
+    db.session.commit()
+
+def best_rate(fn, rows, repeat):
+    """
+    Run fn repeat times and return the best rows/sec.
+    """
+    best = None
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        out = fn()
+        elapsed = time.perf_counter() - start
+        assert len(out) == rows
+        best = elapsed if best is None else min(best, elapsed)
+    return rows / best
+
+def bench_serializers(args):
+    """
+    Compare serializing every review through ORM objects vs. straight from column rows.
+    """
+    app = make_app()
+    with app.app_context():
+        db.create_all()
+        insert_reviews(args.rows)
+        orm = best_rate(lambda: [ r.serialize() for r in Review.query.all() ], args.rows, args.repeat)
+        rows = best_rate(lambda: [ Review.serialize_row(r) for r in db.session.query(*Review.columns()) ], args.rows, args.repeat)
+    return {
+        "benchmark": "serializers",
+        "rows": args.rows,
+        "orm_rows_per_sec": round(orm),
+        "projection_rows_per_sec": round(rows),
+        "speedup": round(rows / orm, 2)
+    }
+
+def percentile(values, p):
+    """
+    The p-th percentile (0-100) of a sorted list, by nearest rank.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+def latency_summary(latencies, elapsed):
+    """
+    Throughput and p50/p95/p99 latency (ms) for a list of request latencies in seconds.
+    """
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "requests_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2)
+    }
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def add_query_latency(seconds):
+    """
+    Make every SQLite statement wait this long before running, in the thread that runs it, as a
+    stand-in for a database across the network: a WSGI thread is blocked meanwhile, while the
+    async API's event loop goes on serving other requests.
+    """
+    @event.listens_for(Engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        # aiosqlite's adapter wraps the sqlite3 connection, which runs in aiosqlite's own thread
+        adapted = getattr(dbapi_connection, "_connection", None)
+        connection = adapted._conn if adapted is not None else dbapi_connection
+        connection.set_trace_callback(lambda statement: time.sleep(seconds))
+
+def serve(args):
+    """
+    Run the WSGI (gunicorn) or ASGI (uvicorn) server in this process, for bench_concurrency.
+    """
+    if args.db_latency_ms:
+        add_query_latency(args.db_latency_ms / 1000)
+    if args.server == "wsgi":
+        from gunicorn.app.wsgiapp import WSGIApplication
+        sys.argv = [
+            "gunicorn", "--workers", "1", "--threads", str(args.threads),
+            "--bind", "127.0.0.1:%d" % args.port, "--access-logfile", "/dev/null", "wsgi:app"
+        ]
+        WSGIApplication("%(prog)s [OPTIONS] [APP_MODULE]").run()
+    else:
+        import uvicorn
+        uvicorn.run("asgi:app", port=args.port, access_log=False, log_level="warning")
+
+def start_server(command, port, env):
+    """
+    Start a server process from src and wait until it accepts connections on port.
+    """
+    process = subprocess.Popen(
+        command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not start: %s" % " ".join(command))
+
+async def http_get(port, path):
+    """
+    GET path from localhost:port over a fresh connection; returns the status code.
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(("GET %s HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n" % path).encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b" ", 2)[1])
+
+async def load(port, paths, clients, requests):
+    """
+    Send requests GETs (cycling through paths) from clients concurrent connections.
+    Returns (latencies, errors, elapsed seconds).
+    """
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def client():
+        nonlocal errors
+        for i in remaining:
+            start = time.perf_counter()
+            try:
+                ok = await http_get(port, paths[i % len(paths)]) == 200
+            except (OSError, IndexError, ValueError):
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[ client() for _ in range(clients) ])
+    return latencies, errors, time.perf_counter() - start
+
+def bench_concurrency(args):
+    """
+    Compare one WSGI worker process (gunicorn, gthread) with one ASGI process (uvicorn, async_api)
+    serving the same read routes to many concurrent clients, over a generated SQLite database.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        uri = "sqlite:///" + os.path.join(directory, "bench.db")
+        app = make_app(uri)
+        with app.app_context():
+            db.create_all()
+            insert_reviews(args.rows)
+            initialize_statistics()
+        env = dict(os.environ, BELI_ENV="production", SQLALCHEMY_DATABASE_URI=uri)
+
+        results = {
+            "benchmark": "concurrency",
+            "paths": args.path,
+            "clients": args.clients,
+            "wsgi_threads": args.threads,
+            "db_latency_ms": args.db_latency_ms
+        }
+        for name in ("wsgi", "asgi"):
+            port = free_port()
+            command = [
+                sys.executable, os.path.abspath(__file__), "serve", name, "--port", str(port),
+                "--threads", str(args.threads), "--db-latency-ms", str(args.db_latency_ms)
+            ]
+            process = start_server(command, port, env)
+            try:
+                asyncio.run(load(port, args.path, args.clients, min(args.clients, args.requests)))  # warm up
+                latencies, errors, elapsed = asyncio.run(load(port, args.path, args.clients, args.requests))
+            finally:
+                process.terminate()
+                process.wait()
+            results[name] = dict(latency_summary(latencies, elapsed), errors=errors)
+    results["throughput_gain"] = round(results["asgi"]["requests_per_sec"] / results["wsgi"]["requests_per_sec"], 2)
+    return results
+
+def route_scenarios(rng, users, eateries, reviews, connections):
+    """
+    (route, method, request, record) for every route in app.py, in the order they are benchmarked.
+    request(i, state) returns (path, JSON body or None) for the i-th request. record(state, body,
+    response), if given, keeps what a successful write created in state, so that later routes can
+    edit and delete it again. users, eateries, reviews and connections are the highest ids.
+    """
+    user = lambda: rng.randint(1, users)
+    eatery = lambda: rng.randint(1, eateries)
+
+    def created(key):
+        def record(state, body, response):
+            state.setdefault(key, []).append(json.loads(response.data)["id"])
+        return record
+
+    def followed(state, body, response):
+        state.setdefault("follows", []).append(body)
+
+    def search_words(i, state):
+        # Alternately a common word, a rarer made-up dish name (as a prefix) and a two-word query
+        words = [ rng.choice(synthetic.REVIEW_WORDS), "dish%d" % rng.randint(0, 999), "%s %s" % (rng.choice(synthetic.REVIEW_WORDS), "dish%d" % rng.randint(0, 99)) ]
+        return "/api/search/?q=%s&limit=20" % words[i % 3].replace(" ", "%20"), None
+
+    def new_review(i, state):
+        # Each benchmark user reviews a different eatery, so no (user, eatery) pair repeats
+        return "/api/reviews/", {"user_id": state["users"][i], "eatery_id": i % eateries + 1, "rating": rng.randint(1, 10), "review_text": "bench"}
+
+    def bulk_reviews(i, state):
+        return "/api/reviews/bulk/", [
+            {"user_id": state["users"][i], "eatery_id": (i + k) % eateries + 1, "rating": rng.randint(1, 10)} for k in range(1, 11)
+        ]
+
+    return [
+        ("/", "GET", lambda i, state: ("/", None), None),
+        ("/api/users/", "GET", lambda i, state: ("/api/users/", None), None),
+        ("/api/users/<id>/", "GET", lambda i, state: ("/api/users/%d/" % user(), None), None),
+        ("/api/users/<id>/followers/", "GET", lambda i, state: ("/api/users/%d/followers/" % user(), None), None),
+        ("/api/users/<id>/following/", "GET", lambda i, state: ("/api/users/%d/following/" % user(), None), None),
+        ("/api/users/<id>/reviews/", "GET", lambda i, state: ("/api/users/%d/reviews/" % user(), None), None),
+        ("/api/users/<id>/following_reviews/", "GET", lambda i, state: ("/api/users/%d/following_reviews/" % user(), None), None),
+        ("/api/users/<id>/ranking/", "GET", lambda i, state: ("/api/users/%d/ranking/" % user(), None), None),
+        ("/api/users/<id>/average_rating/", "GET", lambda i, state: ("/api/users/%d/average_rating/" % user(), None), None),
+        ("/api/users/<id>/rating_count/", "GET", lambda i, state: ("/api/users/%d/rating_count/" % user(), None), None),
+        ("/api/users/<id>/recommendations/users/", "GET", lambda i, state: ("/api/users/%d/recommendations/users/" % user(), None), None),
+        ("/api/users/<id>/recommendations/eateries/", "GET", lambda i, state: ("/api/users/%d/recommendations/eateries/" % user(), None), None),
+        ("/api/search/", "GET", search_words, None),
+        ("/api/leaderboard/", "GET", lambda i, state: ("/api/leaderboard/?user_id=%d" % user(), None), None),
+        ("/api/cache/stats/", "GET", lambda i, state: ("/api/cache/stats/", None), None),
+        ("/metrics", "GET", lambda i, state: ("/metrics", None), None),
+        ("/api/connections/", "GET", lambda i, state: ("/api/connections/", None), None),
+        ("/api/connections/<id>/", "GET", lambda i, state: ("/api/connections/%d/" % rng.randint(1, connections), None), None),
+        ("/api/eateries/", "GET", lambda i, state: ("/api/eateries/", None), None),
+        ("/api/eateries/top/", "GET", lambda i, state: ("/api/eateries/top/?location=Hall%%20%d" % (i % 50), None), None),
+        ("/api/eateries/<id>/", "GET", lambda i, state: ("/api/eateries/%d/" % eatery(), None), None),
+        ("/api/eateries/<id>/reviews/", "GET", lambda i, state: ("/api/eateries/%d/reviews/" % eatery(), None), None),
+        ("/api/eateries/<id>/rating/", "GET", lambda i, state: ("/api/eateries/%d/rating/" % eatery(), None), None),
+        ("/api/reviews/", "GET", lambda i, state: ("/api/reviews/", None), None),
+        ("/api/reviews/<id>/", "GET", lambda i, state: ("/api/reviews/%d/" % rng.randint(1, reviews), None), None),
+        ("/api/users/", "POST", lambda i, state: ("/api/users/", {"name": "Bench %d" % i, "username": "bench%d" % i}), created("users")),
+        ("/api/eateries/", "POST", lambda i, state: ("/api/eateries/", {"name": "Bench %d" % i, "location": "Bench Hall"}), created("eateries")),
+        ("/api/connections/", "POST", lambda i, state: ("/api/connections/", {"follower_id": state["users"][i], "following_id": user()}), followed),
+        ("/api/reviews/", "POST", new_review, created("reviews")),
+        ("/api/reviews/bulk/", "POST", bulk_reviews, None),
+        ("/api/admin/flush/", "POST", lambda i, state: ("/api/admin/flush/", None), None),
+        ("/api/reviews/<id>/", "PUT", lambda i, state: ("/api/reviews/%d/" % state["reviews"][i], {"rating": rng.randint(1, 10)}), None),
+        ("/api/reviews/<id>/", "DELETE", lambda i, state: ("/api/reviews/%d/" % state["reviews"][i], None), None),
+        ("/api/connections/", "DELETE", lambda i, state: ("/api/connections/", state["follows"][i]), None),
+        ("/api/eateries/<id>/", "DELETE", lambda i, state: ("/api/eateries/%d/" % state["eateries"][i], None), None),
+        # Also deletes the benchmark users' bulk-imported reviews
+        ("/api/users/<id>/", "DELETE", lambda i, state: ("/api/users/%d/" % state["users"][i], None), None),
+    ]
+
+def bench_routes(args):
+    """
+    Latency percentiles, throughput and SQL statements per request for every route in app.py,
+    served in-process (no network) by the production profile over a synthetic database.
+    """
+    from app import create_app, response_cache
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        uri = args.database or "sqlite:///" + os.path.join(directory, "bench.db")
+        if not args.database:
+            app = make_app(uri)
+            with app.app_context():
+                db.create_all()
+                synthetic.generate(
+                    args.users, args.reviews_per_user, following=args.following,
+                    eateries=args.eateries, seed=args.seed
+                )
+        os.environ["SQLALCHEMY_DATABASE_URI"] = uri
+        app = create_app("production", check_stats=False)
+        client = app.test_client()
+        results = {}
+        with app.app_context():
+            engine = db.engine
+            counts = {}
+            max_ids = []
+            for model in (User, Eatery, Review, Connection):
+                count, max_id = db.session.query(func.count(model.id), func.max(model.id)).one()
+                counts[model.__tablename__] = count
+                max_ids.append(max_id or 1)
+            db.session.remove()
+        state = {}
+        scenarios = route_scenarios(rng, *max_ids)
+        for route, method, make_request, record in scenarios:
+            response_cache.clear()
+            latencies = []
+            queries = []
+            errors = 0
+            for i in range(args.requests):
+                path, body = make_request(i, state)
+                data = json.dumps(body) if body is not None else None
+                with count_queries(engine) as statements:
+                    start = time.perf_counter()
+                    response = client.open(path, method=method, data=data)
+                    response.get_data()
+                    latencies.append(time.perf_counter() - start)
+                queries.append(len(statements))
+                if response.status_code >= 400:
+                    errors += 1
+                elif record is not None:
+                    record(state, body, response)
+            summary = latency_summary(latencies, sum(latencies))
+            summary.update(
+                queries_per_request=round(sum(queries) / len(queries), 2),
+                max_queries=max(queries),
+                errors=errors
+            )
+            results["%s %s" % (method, route)] = summary
+    return {
+        "benchmark": "routes",
+        "dataset": counts,
+        "requests_per_route": args.requests,
+        "routes": results
+    }
+
+def bench_writes(args):
+    """
+    Review-creation throughput from many concurrent clients (threads, in-process), committing
+    every write on its own and with group commit over each window in args.group_commit_ms,
+    with the statistics updated in each STATS_MODE in args.stats_mode.
+    """
+    from app import create_app, write_committer, stats_recomputer
+    results = {
+        "benchmark": "writes",
+        "clients": args.clients,
+        "writes": args.writes
+    }
+    for window, stats_mode in itertools.product(args.group_commit_ms, args.stats_mode):
+        with tempfile.TemporaryDirectory() as directory:
+            uri = "sqlite:///" + os.path.join(directory, "bench.db")
+            app = make_app(uri)
+            with app.app_context():
+                db.create_all()
+                synthetic.generate(args.writes // 50 + 1, 0, following=args.following, eateries=50, seed=args.seed)
+            os.environ.update(SQLALCHEMY_DATABASE_URI=uri, GROUP_COMMIT_MS=str(window), STATS_MODE=stats_mode)
+            app = create_app("production", check_stats=False)
+            write_committer.batches = write_committer.units = 0
+            stats_recomputer.events = stats_recomputer.recomputes = 0
+            stats_recomputer.max_lag = 0.0
+            # Every write is a new (user, eatery) pair
+            pairs = [ (i // 50 + 1, i % 50 + 1) for i in range(args.writes) ]
+            latencies = []
+            errors = []
+
+            def client(pairs):
+                http = app.test_client()
+                for user_id, eatery_id in pairs:
+                    start = time.perf_counter()
+                    response = http.post("/api/reviews/", data=json.dumps({"user_id": user_id, "eatery_id": eatery_id, "rating": 5}))
+                    latencies.append(time.perf_counter() - start)
+                    if response.status_code != 201:
+                        errors.append(response.status_code)
+
+            clients = [ threading.Thread(target=client, args=(pairs[i::args.clients],)) for i in range(args.clients) ]
+            start = time.perf_counter()
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+            summary = latency_summary(latencies, time.perf_counter() - start)
+            summary.update(errors=len(errors), units_per_commit=write_committer.stats()["units_per_batch"] or 1)
+            if stats_mode == "background":
+                # What the worker had not caught up on when the last write returned
+                start = time.perf_counter()
+                stats_recomputer.flush()
+                summary.update(final_flush_ms=round((time.perf_counter() - start) * 1000, 2), **stats_recomputer.stats())
+            name = "group_commit_%gms" % window if window else "commit_per_write"
+            results["%s_%s_stats" % (name, stats_mode)] = summary
+    return results
+
+def bench_encoding(args):
+    """
+    Bytes/sec and CPU time per response of one route (by default a page of /api/reviews/) for
+    each JSON encoder and Content-Encoding: served in-process, one request at a time, so the
+    process's CPU time per request is the response's. "encode_cpu_ms" is the part spent
+    serializing, encoding and compressing the page's rows, measured apart from the route.
+    """
+    from app import create_app
+    import encoding
+    results = {
+        "benchmark": "encoding",
+        "path": args.path,
+        "requests": args.requests
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        uri = "sqlite:///" + os.path.join(directory, "bench.db")
+        app = make_app(uri)
+        with app.app_context():
+            db.create_all()
+            synthetic.generate(args.users, args.reviews_per_user, following=0, eateries=100, seed=args.seed)
+        os.environ.update(SQLALCHEMY_DATABASE_URI=uri)
+        for encoder in args.encoder:
+            if encoder == "orjson" and encoding.orjson is None:
+                results[encoder] = "not installed"
+                continue
+            identity_bytes = None
+            for content_encoding in args.encoding:
+                if content_encoding != "identity" and not encoding.COMPRESSORS[content_encoding][1]:
+                    results["%s_%s" % (encoder, content_encoding)] = "not installed"
+                    continue
+                os.environ.update(JSON_ENCODER=encoder, COMPRESS_ENCODINGS="" if content_encoding == "identity" else content_encoding)
+                app = create_app("production", check_stats=False)
+                http = app.test_client()
+                headers = {"Accept-Encoding": content_encoding}
+                response = http.get(args.path, headers=headers)
+                assert response.status_code == 200 and response.headers.get("Content-Encoding", "identity") == content_encoding
+                size = len(response.get_data())
+                identity_bytes = identity_bytes or size
+
+                cpu = time.process_time()
+                start = time.perf_counter()
+                for _ in range(args.requests):
+                    http.get(args.path, headers=headers).get_data()
+                elapsed = time.perf_counter() - start
+                cpu = time.process_time() - cpu
+
+                with app.app_context():
+                    rows = db.session.query(*Review.columns()).order_by(Review.timestamp.desc(), Review.id.desc()).limit(args.encode_rows).all()
+                dumps = encoding.ENCODERS[encoder]
+                encode_cpu = time.process_time()
+                for _ in range(args.requests):
+                    body = dumps({"reviews": [ Review.serialize_row(r) for r in rows ], "next_cursor": None})
+                    if content_encoding != "identity":
+                        body = encoding.compress(content_encoding, body)
+                encode_cpu = time.process_time() - encode_cpu
+
+                results["%s_%s" % (encoder, content_encoding)] = {
+                    "requests_per_sec": round(args.requests / elapsed, 1),
+                    "cpu_ms_per_response": round(cpu / args.requests * 1000, 3),
+                    "encode_cpu_ms": round(encode_cpu / args.requests * 1000, 3),
+                    "response_bytes": size,
+                    "compression_ratio": round(identity_bytes / size, 2),
+                    "wire_mb_per_sec": round(size * args.requests / elapsed / 1e6, 2),
+                    "payload_mb_per_sec": round(identity_bytes * args.requests / elapsed / 1e6, 2)
+                }
+    return results
+
+def bench_follows(args):
+    """
+    Stress test for follow/unfollow: many concurrent clients (threads, in-process) following and
+    unfollowing random pairs among a few users, so the same pairs and counters are hit at once
+    and many requests repeat a follow or unfollow. Afterwards every user's follower/following
+    counts must equal their rows in the Connection table; "failed" is set if any does not, or if
+    any request got an unexpected status.
+    """
+    from app import create_app, write_committer
+    results = {
+        "benchmark": "follows",
+        "clients": args.clients,
+        "requests": args.requests,
+        "users": args.users,
+        "failed": False
+    }
+    for window in args.group_commit_ms:
+        with tempfile.TemporaryDirectory() as directory:
+            uri = "sqlite:///" + os.path.join(directory, "bench.db")
+            app = make_app(uri)
+            with app.app_context():
+                db.create_all()
+                synthetic.generate(args.users, 0, following=0, eateries=1, seed=args.seed)
+            os.environ.update(SQLALCHEMY_DATABASE_URI=uri, GROUP_COMMIT_MS=str(window))
+            app = create_app("production", check_stats=False)
+            write_committer.batches = write_committer.units = 0
+            rng = random.Random(args.seed)
+            operations = []
+            for _ in range(args.requests):
+                follower_id, following_id = rng.sample(range(1, args.users + 1), 2)
+                operations.append((rng.choice(["POST", "DELETE"]), follower_id, following_id))
+            latencies = []
+            statuses = collections.Counter()
+            errors = []
+
+            def client(operations):
+                http = app.test_client()
+                for method, follower_id, following_id in operations:
+                    start = time.perf_counter()
+                    response = http.open("/api/connections/", method=method, data=json.dumps({
+                        "follower_id": follower_id, "following_id": following_id
+                    }))
+                    latencies.append(time.perf_counter() - start)
+                    statuses[method, response.status_code] += 1
+                    # Unfollowing a pair that is not connected is a 404; anything else is an error
+                    if response.status_code != 200 and (method, response.status_code) != ("DELETE", 404):
+                        errors.append(response.status_code)
+
+            clients = [ threading.Thread(target=client, args=(operations[i::args.clients],)) for i in range(args.clients) ]
+            start = time.perf_counter()
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+            summary = latency_summary(latencies, time.perf_counter() - start)
+            with app.app_context():
+                mismatched = 0
+                for column, key in ((User.follower_count, Connection.following_id), (User.following_count, Connection.follower_id)):
+                    count = db.session.query(func.count(Connection.id)).filter(key == User.id).scalar_subquery()
+                    mismatched += db.session.query(func.count(User.id)).filter(column != count).scalar()
+                connections = db.session.query(func.count(Connection.id)).scalar()
+            summary.update(
+                errors=len(errors), mismatched_counters=mismatched, connections=connections,
+                statuses={ "%s %d" % key: n for key, n in sorted(statuses.items()) },
+                units_per_commit=write_committer.stats()["units_per_batch"] or 1
+            )
+            results["failed"] = results["failed"] or bool(errors or mismatched)
+            name = "group_commit_%gms" % window if window else "commit_per_write"
+            results[name] = summary
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serializers = commands.add_parser("serializers", help="ORM vs. column-projection serialization throughput")
+    serializers.add_argument("--rows", type=int, default=50000)
+    serializers.add_argument("--repeat", type=int, default=3)
+    serializers.set_defaults(run=bench_serializers)
+
+    concurrency = commands.add_parser("concurrency", help="WSGI worker vs. async read API under many concurrent clients")
+    concurrency.add_argument("--rows", type=int, default=50000, help="reviews in the generated database")
+    concurrency.add_argument("--clients", type=int, default=200)
+    concurrency.add_argument("--requests", type=int, default=5000)
+    concurrency.add_argument("--threads", type=int, default=4, help="threads in the WSGI worker")
+    concurrency.add_argument("--path", action="append", help="route(s) to request (default: eatery and user review pages)")
+    concurrency.add_argument("--db-latency-ms", type=float, default=0, help="simulated database round-trip per statement")
+    concurrency.set_defaults(run=bench_concurrency)
+
+    routes = commands.add_parser("routes", help="latency, throughput and query counts for every route over synthetic data")
+    routes.add_argument("--users", type=int, default=2000)
+    routes.add_argument("--reviews-per-user", type=int, default=10)
+    routes.add_argument("--following", type=int, default=20)
+    routes.add_argument("--eateries", type=int, default=100)
+    routes.add_argument("--requests", type=int, default=100, help="requests per route")
+    routes.add_argument("--seed", type=int, default=0)
+    routes.add_argument("--database", help="benchmark an existing database (SQLAlchemy URL; the write routes change it) instead of generating one")
+    routes.add_argument("--output", help="also write the results to this file")
+    routes.set_defaults(run=bench_routes)
+
+    writes = commands.add_parser("writes", help="concurrent review-write throughput with and without group commit")
+    writes.add_argument("--clients", type=int, default=16)
+    writes.add_argument("--writes", type=int, default=2000)
+    writes.add_argument("--following", type=int, default=20, help="follows per user, i.e. timeline fan-out per write")
+    writes.add_argument("--group-commit-ms", type=float, nargs="+", default=[0, 2, 5], help="windows to compare (0 = commit per write)")
+    writes.add_argument("--stats-mode", nargs="+", choices=["sync", "background"], default=["sync", "background"])
+    writes.add_argument("--seed", type=int, default=0)
+    writes.set_defaults(run=bench_writes)
+
+    follows = commands.add_parser("follows", help="concurrent follow/unfollow stress test; checks the follow counters stay exact")
+    follows.add_argument("--clients", type=int, default=32)
+    follows.add_argument("--requests", type=int, default=5000)
+    follows.add_argument("--users", type=int, default=10, help="users to follow/unfollow among; fewer means more contention")
+    follows.add_argument("--group-commit-ms", type=float, nargs="+", default=[0, 2], help="windows to compare (0 = commit per write)")
+    follows.add_argument("--seed", type=int, default=0)
+    follows.set_defaults(run=bench_follows)
+
+    encodings = commands.add_parser("encoding", help="bytes/sec and CPU per response for each JSON encoder and compression")
+    encodings.add_argument("--users", type=int, default=200)
+    encodings.add_argument("--reviews-per-user", type=int, default=20)
+    encodings.add_argument("--requests", type=int, default=200, help="requests per encoder/encoding")
+    encodings.add_argument("--path", default="/api/reviews/?limit=1000", help="route to request")
+    encodings.add_argument("--encode-rows", type=int, default=1000, help="review rows encoded per response by the encode-only measurement")
+    encodings.add_argument("--encoder", nargs="+", choices=["json", "orjson"], default=["json", "orjson"])
+    encodings.add_argument("--encoding", nargs="+", choices=["identity", "gzip", "br", "zstd"], default=["identity", "gzip", "br", "zstd"])
+    encodings.add_argument("--seed", type=int, default=0)
+    encodings.set_defaults(run=bench_encoding)
+
+    server = commands.add_parser("serve", help="run one of the concurrency benchmark's servers")
+    server.add_argument("server", choices=["wsgi", "asgi"])
+    server.add_argument("--port", type=int, default=5000)
+    server.add_argument("--threads", type=int, default=4)
+    server.add_argument("--db-latency-ms", type=float, default=0)
+    server.set_defaults(run=serve)
+
+    args = parser.parse_args()
+    if getattr(args, "path", False) is None:
+        args.path = ["/api/eateries/1/reviews/", "/api/users/1/reviews/", "/api/reviews/?limit=50"]
+    result = args.run(args)
+    if result is not None:
+        print(json.dumps(result, indent=2))
+        if getattr(args, "output", None):
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+        if result.get("failed"):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
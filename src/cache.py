@@ -0,0 +1,128 @@
+import collections
+import hashlib
+import threading
+import time
+
+class ResponseCache:
+    """
+    In-process LRU cache with a TTL for serialized response bodies.
+    Keys are (kind, entity id, view) tuples so every cached view of one entity can be
+    invalidated together. Each process (e.g. each server worker) has its own cache, so a
+    write handled elsewhere is only picked up once the TTL expires.
+    """
+
+    def __init__(self, max_entries=10000, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key -> (expires_at, body, etag)
+        self.keys_by_entity = collections.defaultdict(set)  # (kind, id) -> keys
+        self.entries_by_kind = collections.Counter()  # kind -> number of entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        """
+        Size the cache from an app's RESPONSE_CACHE_SIZE/RESPONSE_CACHE_TTL settings and drop
+        anything cached from another app's database.
+        """
+        with self.lock:
+            self.max_entries = app.config["RESPONSE_CACHE_SIZE"]
+            self.ttl = app.config["RESPONSE_CACHE_TTL"]
+            self.entries.clear()
+            self.keys_by_entity.clear()
+            self.entries_by_kind.clear()
+
+    def get(self, key):
+        """
+        Return (body, etag) for key if it is cached and fresh, else None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._discard(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def set(self, key, body):
+        """
+        Cache body under key and return (body, etag).
+        """
+        etag = hashlib.blake2b(body if isinstance(body, bytes) else body.encode(), digest_size=12).hexdigest()
+        with self.lock:
+            if key in self.entries:
+                self._discard(key)
+            self.entries[key] = (time.monotonic() + self.ttl, body, etag)
+            self.keys_by_entity[key[:2]].add(key)
+            self.entries_by_kind[key[0]] += 1
+            while len(self.entries) > self.max_entries:
+                self._discard(next(iter(self.entries)))
+        return body, etag
+
+    def has_kind(self, kind):
+        """
+        Whether anything about an entity of this kind is cached.
+        """
+        with self.lock:
+            return self.entries_by_kind[kind] > 0
+
+    def invalidate(self, kind, entity_id):
+        """
+        Drop every cached view of one entity.
+        """
+        with self.lock:
+            for key in list(self.keys_by_entity.get((kind, entity_id), ())):
+                self._discard(key)
+            self.invalidations += 1
+
+    def invalidate_kind(self, kind):
+        """
+        Drop every cached view of every entity of this kind.
+        """
+        with self.lock:
+            for entity in [ e for e in self.keys_by_entity if e[0] == kind ]:
+                for key in list(self.keys_by_entity[entity]):
+                    self._discard(key)
+            self.invalidations += 1
+
+    def clear(self):
+        """
+        Drop everything and reset the counters.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_entity.clear()
+            self.entries_by_kind.clear()
+            self.hits = self.misses = self.invalidations = 0
+
+    def stats(self):
+        """
+        Hit/miss counters and current size.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+                "invalidations": self.invalidations,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl
+            }
+
+    def _discard(self, key):
+        """
+        Remove one key; the caller holds the lock.
+        """
+        del self.entries[key]
+        self.entries_by_kind[key[0]] -= 1
+        keys = self.keys_by_entity[key[:2]]
+        keys.discard(key)
+        if not keys:
+            del self.keys_by_entity[key[:2]]
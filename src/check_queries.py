@@ -0,0 +1,161 @@
+"""
+Query regression checks for the read routes.
+
+Requests every read route against the seeded database and fails (exit code 1) if any of them
+- runs more SQL statements than its budget. Budgets do not depend on the amount of data, so a
+  route that slips back into lazy loading one row at a time (N+1 queries) goes over budget.
+- runs a query whose SQLite EXPLAIN QUERY PLAN scans a table instead of searching an index
+  (even walking a whole index, e.g. in timestamp order to find one eatery's reviews, is a
+  scan), or sorts in a temporary B-tree instead of reading rows in index order.
+
+Usage: python3 seed.py && python3 check_queries.py
+(tests/test_queries.py runs the same checks under pytest, against a freshly seeded database.)
+"""
+import sys
+from app import create_app, follow_graph
+from db import db, count_queries
+
+# route -> maximum number of SQL statements it may run
+QUERY_BUDGETS = {
+    "/api/users/": 2,
+    "/api/users/1/": 2,
+    "/api/users/?ids=3,1,2": 2,
+    "/api/users/1/profile/": 4,
+    "/api/users/1/profile/?fields=user,ranking": 1,
+    "/api/users/1/followers/": 2,
+    "/api/users/1/following/": 2,
+    "/api/users/1/reviews/": 2,
+    "/api/users/1/following_reviews/": 2,
+    "/api/users/1/ranking/": 1,
+    "/api/users/1/average_rating/": 1,
+    "/api/users/1/rating_count/": 1,
+    "/api/leaderboard/?user_id=1": 2,
+    "/api/users/2/recommendations/users/": 3,
+    "/api/users/2/recommendations/eateries/": 4,
+    "/api/connections/": 1,
+    "/api/connections/?stream=true": 1,
+    "/api/connections/1/": 1,
+    "/api/eateries/": 1,
+    "/api/eateries/top/": 1,
+    "/api/eateries/?ids=19,1": 1,
+    "/api/eateries/top/?location=Olin%20Library&min_reviews=2": 1,
+    "/api/eateries/19/": 1,
+    "/api/eateries/19/reviews/": 2,
+    "/api/eateries/19/rating/": 1,
+    "/api/reviews/": 1,
+    "/api/reviews/?stream=true": 1,
+    "/api/reviews/1/": 1,
+    "/api/search/?q=duff": 2,
+    "/api/search/?q=oyster%20cr&type=reviews": 1,
+    "/api/search/?q=ca&type=eateries&limit=2": 1,
+}
+
+# Routes that page through (or export) a whole table in primary-key order. SQLite reports
+# these as a plain SCAN; the LIMIT (or the export itself) is what bounds them.
+FULL_SCAN_ROUTES = {
+    "/api/users/",
+    "/api/connections/",
+    "/api/connections/?stream=true",
+    "/api/eateries/",
+    "/api/reviews/?stream=true",
+}
+
+# Routes that read the first page of a whole table in the order of one of its indexes. SQLite
+# reports these as SCAN ... USING INDEX; the LIMIT is what bounds them.
+INDEX_SCAN_ROUTES = {
+    "/api/eateries/top/",
+    "/api/reviews/",
+}
+
+# Routes ranked by full-text relevance. The rank (bm25) is computed per match, so the matches
+# are always sorted in a temporary B-tree and read back from subqueries; search.MAX_CANDIDATES
+# is what bounds them.
+RANKED_ROUTES = {
+    "/api/search/?q=duff",
+    "/api/search/?q=oyster%20cr&type=reviews",
+    "/api/search/?q=ca&type=eateries&limit=2",
+}
+
+def plan_problems(connection, statement, parameters, ranked=False, index_scans=False):
+    """
+    Lines of a statement's EXPLAIN QUERY PLAN that show a table scan or an unindexed sort.
+    Full-text matches (SCAN of a virtual table's index) are lookups, not scans. With ranked,
+    sorts and scans of subqueries are allowed; with index_scans, scans in index order are.
+    """
+    plan = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+    problems = []
+    for row in plan:
+        detail = row[-1]
+        if ranked and ("TEMP B-TREE" in detail or (detail.startswith("SCAN") and detail.split()[1] not in db.metadata.tables)):
+            continue
+        if detail.startswith("SCAN") and "VIRTUAL TABLE INDEX" not in detail and not (index_scans and "INDEX" in detail):
+            problems.append(detail)
+        elif "TEMP B-TREE" in detail:
+            problems.append(detail)
+    return problems
+
+def check_app(profile=None):
+    """
+    An app to check routes with, its test client and engine, with SQL echo off and the follow
+    graph loaded (query budgets assume it is, as it is after a process's first request).
+    """
+    app = create_app(profile)
+    app.config["SQLALCHEMY_ECHO"] = False
+    with app.app_context():
+        engine = db.engine
+        engine.echo = False
+        follow_graph.refresh()
+    return app, app.test_client(), engine
+
+def request_route(client, engine, route):
+    """
+    GET route, draining streamed bodies. Returns (response, [(statement, parameters), ...] it ran).
+    """
+    with count_queries(engine) as statements:
+        response = client.get(route)
+        response.get_data()
+    return response, statements
+
+def budget_problems(route, response, statements):
+    """
+    Problems with a route's response: over its query budget, or not 200.
+    """
+    problems = []
+    budget = QUERY_BUDGETS[route]
+    if len(statements) > budget:
+        problems.append("%d queries, budget is %d" % (len(statements), budget))
+    if response.status_code != 200:
+        problems.append("HTTP %d" % response.status_code)
+    return problems
+
+def route_plan_problems(engine, route, statements):
+    """
+    plan_problems of every statement a route ran; none for FULL_SCAN_ROUTES or other databases than SQLite.
+    """
+    if engine.dialect.name != "sqlite" or route in FULL_SCAN_ROUTES:
+        return []
+    problems = []
+    with engine.connect() as connection:
+        for statement, parameters in statements:
+            problems += plan_problems(
+                connection, statement, parameters, ranked=route in RANKED_ROUTES, index_scans=route in INDEX_SCAN_ROUTES
+            )
+    return problems
+
+def main():
+    app, client, engine = check_app()
+    failures = 0
+    for route, budget in QUERY_BUDGETS.items():
+        response, statements = request_route(client, engine, route)
+        problems = budget_problems(route, response, statements) + route_plan_problems(engine, route, statements)
+        status = "FAIL" if problems else "ok"
+        print("%-4s %-36s %d/%d queries %s" % (status, route, len(statements), budget, "; ".join(problems)))
+        if problems:
+            failures += 1
+    if failures:
+        print("%d route(s) failed" % failures)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
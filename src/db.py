@@ -1,11 +1,116 @@
 from flask_sqlalchemy import SQLAlchemy
+import contextlib
 import datetime
-from sqlalchemy import func, event
-from sqlalchemy.orm import Session
+from sqlalchemy import func, event, case, select, MetaData, Table, Column, Integer, String
+from sqlalchemy.orm import Session, column_property
+from encoding import iso_timestamp
 
 db = SQLAlchemy()
 
-class User(db.Model):
+@contextlib.contextmanager
+def count_queries(engine):
+    """
+    Count the SQL statements executed on engine inside the with-block.
+    Yields a list that collects a (statement, parameters) pair per statement; len() of it is the query count.
+    """
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+def set_sqlite_pragmas(engine, pragmas):
+    """
+    Run PRAGMA name=value for each of pragmas on every new connection to a SQLite engine.
+    Does nothing for other databases.
+    """
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s=%s" % (name, value))
+        cursor.close()
+    event.listen(engine, "connect", connect)
+
+def use_explicit_sqlite_transactions(engine):
+    """
+    Have a SQLite engine start every transaction with BEGIN itself instead of leaving it to the
+    sqlite3 driver, which only begins one right before an INSERT/UPDATE/DELETE, after any reads.
+    Reads then see one snapshot, SAVEPOINTs (session.begin_nested()) nest inside the
+    transaction, and a connection with the execution option sqlite_begin="IMMEDIATE" takes
+    the write lock up front. Does nothing for other databases.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+    def begin(connection):
+        # Straight on the driver connection, so statement counters (metrics, check_queries) skip it
+        connection.connection.execute("BEGIN %s" % connection.get_execution_options().get("sqlite_begin", "DEFERRED"))
+    event.listen(engine, "connect", connect)
+    event.listen(engine, "begin", begin)
+
+def insert_or_ignore(model, dialect):
+    """
+    INSERT into model's table that skips rows conflicting with a unique constraint instead of
+    failing (ON CONFLICT DO NOTHING), for SQLite or PostgreSQL. The statement's rowcount says
+    whether the row went in.
+    """
+    if dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model).on_conflict_do_nothing()
+
+class RowSerializable:
+    """
+    Mixin for models whose serialized fields are listed once, in order, in serialized_fields.
+    Read routes can select just columns() and pass the plain rows to serialize_row(),
+    skipping ORM object hydration; the ORM serializers go through the same code.
+    """
+    serialized_fields = ()
+
+    @classmethod
+    def columns(cls):
+        """
+        Columns for serialized_fields, in order.
+        """
+        return [ getattr(cls, f) for f in cls.serialized_fields ]
+
+    @classmethod
+    def timestamp_fields(cls):
+        """
+        The serialized_fields that are DateTime columns, worked out once per model.
+        """
+        fields = cls.__dict__.get("serialized_timestamp_fields")
+        if fields is None:
+            fields = tuple(f for f in cls.serialized_fields if isinstance(getattr(cls, f).type, db.DateTime))
+            cls.serialized_timestamp_fields = fields
+        return fields
+
+    @classmethod
+    def serialize_row(cls, row):
+        """
+        Serialize a row (or any sequence) of values for serialized_fields. Extra trailing values are ignored.
+        """
+        serialized = dict(zip(cls.serialized_fields, row))
+        for f in cls.timestamp_fields():
+            value = serialized.get(f)
+            if value is not None:
+                serialized[f] = iso_timestamp(value)
+        return serialized
+
+    def serialize_fields(self):
+        """
+        Serialize this object's serialized_fields.
+        """
+        return self.serialize_row([ getattr(self, f) for f in self.serialized_fields ])
+
+class User(db.Model, RowSerializable):
     """
     User model.
     Many-to-many relationship with Connection.
@@ -19,18 +124,31 @@ class User(db.Model):
     location = db.Column(db.String, nullable=True)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
     ratings_count = db.Column(db.Integer, default=0)
+    ratings_sum = db.Column(db.Float, default=0)  # running total of ratings, kept in step with ratings_count
     average_rating = db.Column(db.Float, default=0)
-    ranking = db.Column(db.Integer, default=0)
+    last_review_at = db.Column(db.DateTime, nullable=True)  # most recent review timestamp, breaks ranking ties
     follower_count = db.Column(db.Integer, default=0)
     following_count = db.Column(db.Integer, default=0)
 
+    serialized_fields = (
+        "id", "name", "username", "bio", "location", "timestamp",
+        "ratings_count", "average_rating", "ranking", "follower_count", "following_count"
+    )
+
+    # Rank index: the leaderboard read backwards (most reviews, then most recent, then lowest id
+    # first), and the users ahead of someone in their rank bucket counted as one range
+    __table_args__ = (
+        db.Index("ix_user_rank_key", "ratings_count", "last_review_at", id.desc()),
+    )
+
     # Relationships: 1 user to many reviews; many users to many connections
+    # Deleting a user deletes these in the database (ON DELETE CASCADE) rather than loading them first
     # This user's followers are instances where this user's id is the following id in Connection
-    followers = db.relationship("Connection", foreign_keys="[Connection.following_id]", back_populates="following",  cascade="delete")
+    followers = db.relationship("Connection", foreign_keys="[Connection.following_id]", back_populates="following", cascade="delete", passive_deletes=True)
     # This user's following are instances where this user's id is the follower id in Connection
-    following = db.relationship("Connection", foreign_keys="[Connection.follower_id]", back_populates="follower",  cascade="delete")
+    following = db.relationship("Connection", foreign_keys="[Connection.follower_id]", back_populates="follower", cascade="delete", passive_deletes=True)
     # 1
-    reviews = db.relationship("Review", back_populates="user", cascade="delete")
+    reviews = db.relationship("Review", back_populates="user", cascade="delete", passive_deletes=True)
 
     def __init__(self, **kwargs):
         """
@@ -42,9 +160,11 @@ class User(db.Model):
         self.location = kwargs.get("location", "")
         self.timestamp = datetime.datetime.now()
         self.ratings_count = 0 
+        self.ratings_sum = 0
         self.average_rating = 0
-        self.ranking = 0 # ranking 0 means you haven't ranked eateries yet
-        # ranking is given based on number of reviews, then recency of reviews (in case of tie)
+        # ranking (computed, see rank_expression) is given based on number of reviews, then
+        # recency of reviews (in case of tie); 0 means you haven't ranked eateries yet
+        self.last_review_at = None
         self.follower_count = 0
         self.following_count = 0
  
@@ -52,38 +172,56 @@ class User(db.Model):
         """
         Simple serialize User object (without reviews and followers/following).
         """
-        return {
-            "id": self.id,
-            "name": self.name,
-            "username": self.username,
-            "bio": self.bio,
-            "location": self.location,
-            "timestamp": self.timestamp.isoformat(),
-            "ratings_count": self.ratings_count,
-            "average_rating": self.average_rating,
-            "ranking": self.ranking,
-            "follower_count": self.follower_count,
-            "following_count": self.following_count 
-        }
+        return self.serialize_fields()
 
     def serialize(self):
         """
         Serialize User object (without followers/following).
         """
-        return {
-            "id": self.id,
-            "name": self.name,
-            "username": self.username,
-            "bio": self.bio,
-            "location": self.location,
-            "timestamp": self.timestamp.isoformat(),
-            "ratings_count": self.ratings_count,
-            "average_rating": self.average_rating,
-            "ranking": self.ranking,
-            "follower_count": self.follower_count,
-            "following_count": self.following_count,
-            "reviews": [ r.serialize() for r in self.reviews ]
-        }
+        serialized = self.serialize_fields()
+        serialized["reviews"] = [ r.serialize() for r in self.reviews ]
+        return serialized
+
+class RankBucket(db.Model):
+    """
+    Rank bucket model.
+    Number of users on the leaderboard (users with reviews) per review count. A review write
+    moves its author from one bucket to the next instead of renumbering every user it passes.
+    """
+    __tablename__ = "rank_bucket"
+
+    ratings_count = db.Column(db.Integer, primary_key=True)
+    users = db.Column(db.Integer, nullable=False, default=0)
+
+def rank_expression(ratings_count, last_review_at, user_id):
+    """
+    SQL expression for the leaderboard rank of a user with the given review count (> 0), last
+    review time and id, each a column or a value: one more than the users in the buckets above
+    plus the users ahead in the same bucket (reviewed more recently, or at the same time with a
+    lower id). Nothing is stored per user. The buckets above are one rank_bucket row per review
+    count, but the users ahead are counted by walking their entries in ix_user_rank_key, so the
+    cost grows with the user's place in their bucket: up to the whole bucket, and the buckets
+    of users with few reviews hold most users.
+    """
+    ahead = User.__table__.alias("ahead")
+    above = select(func.coalesce(func.sum(RankBucket.users), 0)).where(
+        RankBucket.ratings_count > ratings_count
+    ).scalar_subquery()
+    later = select(func.count()).select_from(ahead).where(
+        ahead.c.ratings_count == ratings_count, ahead.c.last_review_at > last_review_at
+    ).scalar_subquery()
+    tied = select(func.count()).select_from(ahead).where(
+        ahead.c.ratings_count == ratings_count, ahead.c.last_review_at == last_review_at, ahead.c.id < user_id
+    ).scalar_subquery()
+    return 1 + above + later + tied
+
+# Computed when asked for, so it is never out of step with the buckets. Deferred, since it
+# costs a walk of the user's bucket (see rank_expression): loading a User leaves it out, and
+# selecting User.columns() or User.ranking, or undefer(User.ranking), brings it in
+User.ranking = column_property(
+    case((User.ratings_count > 0, rank_expression(User.ratings_count, User.last_review_at, User.id)), else_=0),
+    deferred=True
+)
 
 class Connection(db.Model):
     """ 
@@ -93,14 +231,18 @@ class Connection(db.Model):
     __tablename__ = "connection"
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    follower_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    following_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    follower_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    following_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     timestamp = db.Column(db.DateTime,nullable=False, default=datetime.datetime.now) 
 
-    # Connections must be unique
+    # Connections must be unique; the unique index also serves "who does X follow" lookups,
+    # and ix_connection_following serves "who follows X". AUTOINCREMENT: SQLite would otherwise
+    # hand a deleted highest id to the next follow, which the follow graph (graph.py) would miss
     __table_args__ = (
         db.UniqueConstraint("follower_id", "following_id", name='unique_user_connection'),
-        db.CheckConstraint("follower_id != following_id", name="check_not_following_self")
+        db.CheckConstraint("follower_id != following_id", name="check_not_following_self"),
+        db.Index("ix_connection_following", "following_id", "follower_id"),
+        {"sqlite_autoincrement": True}
     )
 
     # Relationships: many-to-many with User
@@ -123,10 +265,10 @@ class Connection(db.Model):
             "id": self.id,
             "follower": self.follower.simple_serialize() if self.follower else None,
             "following": self.following.simple_serialize() if self.following else None,
-            "timestamp": self.timestamp.isoformat()
+            "timestamp": iso_timestamp(self.timestamp)
         }
     
-class Eatery(db.Model):
+class Eatery(db.Model, RowSerializable):
     """
     Eatery model.
     """
@@ -136,10 +278,21 @@ class Eatery(db.Model):
     name = db.Column(db.String, nullable=False)
     description = db.Column(db.String(150), nullable=True)
     location = db.Column(db.String, nullable=True) 
+    ratings_count = db.Column(db.Integer, default=0)
+    ratings_sum = db.Column(db.Float, default=0)  # running total of ratings, kept in step with ratings_count
     average_rating = db.Column(db.Float, default=0)
+    score = db.Column(db.Float, default=0)  # Bayesian average rating (stats.eatery_score_expression), kept in step with the average
+
+    serialized_fields = ("id", "name", "description", "location", "average_rating")
+
+    # Top-rated eateries, overall and per location, read in score order
+    __table_args__ = (
+        db.Index("ix_eatery_score", score.desc(), "id"),
+        db.Index("ix_eatery_location_score", "location", score.desc(), "id"),
+    )
 
     # Relationship: 1 eatery to many reviews
-    reviews = db.relationship("Review", back_populates="eatery",  cascade="delete")
+    reviews = db.relationship("Review", back_populates="eatery", cascade="delete", passive_deletes=True)
 
     def __init__(self, **kwargs):
         """
@@ -148,21 +301,18 @@ class Eatery(db.Model):
         self.name = kwargs.get("name")
         self.description = kwargs.get("description")
         self.location = kwargs.get("location")
+        self.ratings_count = 0
+        self.ratings_sum = 0
         self.average_rating = 0
+        self.score = 0
 
     def serialize(self):
         """
         Serialize Eatery object (without reviews).
         """
-        return {
-            "id": self.id,
-            "name": self.name,
-            "description": self.description,
-            "location": self.location,
-            "average_rating": self.average_rating
-        }
+        return self.serialize_fields()
 
-class Review(db.Model):
+class Review(db.Model, RowSerializable):
     """
     Review model.
     Each row is a rating (float 1-10) and optional review by one user for one eatery.
@@ -170,16 +320,23 @@ class Review(db.Model):
     __tablename__ = "review"
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    eatery_id = db.Column(db.Integer, db.ForeignKey("eatery.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    eatery_id = db.Column(db.Integer, db.ForeignKey("eatery.id", ondelete="CASCADE"), nullable=False)
     rating = db.Column(db.Float, nullable=False)  # 1-10 value
     review_text = db.Column(db.String, nullable=True)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
 
+    serialized_fields = ("id", "user_id", "eatery_id", "rating", "review_text", "timestamp")
+
     # Table constraints: rating must be between 0 and 10
+    # Indexes match the review listings: all reviews and an eatery's reviews newest first,
+    # a user's reviews best first (id, the rowid, breaks ties in each)
     __table_args__ = (
         db.CheckConstraint("rating >= 1 AND rating <= 10", name="checking_rating_range"),
-        db.UniqueConstraint("user_id", "eatery_id", name='unique_user_eatery_review')
+        db.UniqueConstraint("user_id", "eatery_id", name='unique_user_eatery_review'),
+        db.Index("ix_review_timestamp", "timestamp"),
+        db.Index("ix_review_eatery_timestamp", "eatery_id", "timestamp"),
+        db.Index("ix_review_user_rating", "user_id", "rating")
     ) 
 
     # Relationship: many reviews to 1 user, many reviews to 1 eatery
@@ -194,11 +351,105 @@ class Review(db.Model):
         self.timestamp = datetime.datetime.now()
 
     def serialize(self):
-        return {
-            "id": self.id,
-            "user_id": self.user_id,
-            "eatery_id": self.eatery_id,
-            "rating": self.rating,
-            "review_text": self.review_text,
-            "timestamp": self.timestamp.isoformat()
-        }
\ No newline at end of file
+        return self.serialize_fields()
+
+class TimelineEntry(db.Model):
+    """
+    Timeline entry model.
+    Each row puts one review into the home timeline of one user who follows its author.
+    Written when reviews are created/follows happen, so reading a timeline is a single index range scan.
+    """
+    __tablename__ = "timeline_entry"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)  # whose timeline this is
+    review_id = db.Column(db.Integer, db.ForeignKey("review.id", ondelete="CASCADE"), nullable=False, index=True)
+    author_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)  # copy of the review's timestamp
+
+    # Each review shows up at most once per timeline; timelines are read newest first; an
+    # author's entries are found (to delete them with the author) by author_id
+    __table_args__ = (
+        db.UniqueConstraint("owner_id", "review_id", name="unique_timeline_review"),
+        db.Index("ix_timeline_owner_timestamp", "owner_id", "timestamp", "review_id"),
+        db.Index("ix_timeline_author", "author_id"),
+    )
+
+    # Relationship: many entries to 1 review
+    review = db.relationship("Review")
+
+    def __init__(self, **kwargs):
+        """
+        Initialize TimelineEntry object.
+        """
+        self.owner_id = kwargs.get("owner_id")
+        self.review_id = kwargs.get("review_id")
+        self.author_id = kwargs.get("author_id")
+        self.timestamp = kwargs.get("timestamp")
+
+# -- Full-text search -----------------------------------------------------------------
+# SQLite FTS5 indexes over eatery and review text. They are external-content tables: the text
+# stays in the eatery/review rows and the index only holds tokens, kept in step by triggers,
+# so every write path (ORM, bulk inserts, cascades) updates it in the same transaction.
+search_metadata = MetaData()
+
+def search_table(name, content, columns):
+    """
+    A Table for querying an FTS5 index of columns of content (a model table), keyed by its rowid.
+    The hidden column named after the table is the one MATCH and bm25() take.
+    """
+    table = Table(name, search_metadata, Column("rowid", Integer, primary_key=True),
+        *[ Column(c, String) for c in columns ], Column(name, String))
+    table.info["content"] = content
+    table.info["columns"] = columns
+    return table
+
+eatery_search = search_table("eatery_search", Eatery.__table__, ("name", "location", "description"))
+review_search = search_table("review_search", Review.__table__, ("review_text",))
+search_tables = (eatery_search, review_search)
+
+def search_index_ddl(table):
+    """
+    Statements creating an FTS5 table and the triggers that keep it in step with its content table.
+    Words are case- and accent-insensitive; prefixes of 2 and 3 characters get their own index.
+    """
+    name, content, columns = table.name, table.info["content"].name, table.info["columns"]
+    column_list = ", ".join(columns)
+    new_values = ", ".join("new.%s" % c for c in columns)
+    old_values = ", ".join("old.%s" % c for c in columns)
+    insert = "INSERT INTO %s(rowid, %s) VALUES (new.id, %s);" % (name, column_list, new_values)
+    delete = "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.id, %s);" % (name, name, column_list, old_values)
+    return [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, content='%s', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')" % (name, column_list, content),
+        "CREATE TRIGGER IF NOT EXISTS %s_insert AFTER INSERT ON %s BEGIN %s END" % (name, content, insert),
+        "CREATE TRIGGER IF NOT EXISTS %s_delete AFTER DELETE ON %s BEGIN %s END" % (name, content, delete),
+        "CREATE TRIGGER IF NOT EXISTS %s_update AFTER UPDATE OF %s ON %s BEGIN %s %s END" % (
+            name, column_list, content, delete, insert
+        ),
+    ]
+
+def create_search_indexes(connection, rebuild=False):
+    """
+    Create the search tables and triggers that do not exist yet; with rebuild, re-index every
+    row already in the content tables. Does nothing for databases other than SQLite.
+    """
+    if connection.dialect.name != "sqlite":
+        return
+    for table in search_tables:
+        for statement in search_index_ddl(table):
+            connection.exec_driver_sql(statement)
+        if rebuild:
+            connection.exec_driver_sql("INSERT INTO %s(%s) VALUES ('rebuild')" % (table.name, table.name))
+
+def drop_search_indexes(connection):
+    """
+    Drop the search tables (their triggers go with the content tables).
+    """
+    if connection.dialect.name != "sqlite":
+        return
+    for table in search_tables:
+        connection.exec_driver_sql("DROP TABLE IF EXISTS %s" % table.name)
+
+event.listen(db.metadata, "after_create", lambda target, connection, **kw: create_search_indexes(connection))
+event.listen(db.metadata, "before_drop", lambda target, connection, **kw: drop_search_indexes(connection))
@@ -0,0 +1,59 @@
+from sqlalchemy import func, select
+from db import db, User, Connection, Eatery, Review
+from stats import drop_user_ranking
+import timeline
+
+# Deleting a user or an eatery takes a handful of set-based statements instead of loading
+# every dependent row into the session and deleting it one at a time. Dependent rows go
+# first, so the deletes also work on databases created before the foreign keys cascaded
+# (SQLite cannot add ON DELETE CASCADE to an existing table) and with foreign keys enforced.
+# Only the counters and aggregates of the rows the deleted ones touched are adjusted.
+
+def rating_totals(group_by, where):
+    """
+    {id: (-sum of ratings, -number of reviews)} of the reviews matching where, grouped by group_by:
+    the rating deltas that removing those reviews makes.
+    """
+    rows = db.session.execute(
+        select(group_by, func.sum(Review.rating), func.count(Review.id)).where(where).group_by(group_by)
+    )
+    return { id: (-ratings_sum, -ratings_count) for id, ratings_sum, ratings_count in rows }
+
+def delete_user(user_id, recomputer):
+    """
+    Delete a user with their reviews, follows and timeline entries. Takes the user out of the
+    leaderboard, takes their ratings out of the eateries they reviewed (through recomputer,
+    a StatsRecomputer) and their follows out of the counterparties' counters.
+    Runs in the caller's transaction. Returns the ids of the eateries they reviewed.
+    """
+    drop_user_ranking(user_id)
+
+    eatery_deltas = rating_totals(Review.eatery_id, Review.user_id == user_id)
+    recomputer.ratings_removed({}, eatery_deltas)
+
+    followed = select(Connection.following_id).where(Connection.follower_id == user_id)
+    followers = select(Connection.follower_id).where(Connection.following_id == user_id)
+    User.query.filter(User.id.in_(followed)).update({User.follower_count: User.follower_count - 1}, synchronize_session=False)
+    User.query.filter(User.id.in_(followers)).update({User.following_count: User.following_count - 1}, synchronize_session=False)
+
+    timeline.remove_user(user_id)
+    Review.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    Connection.query.filter((Connection.follower_id == user_id) | (Connection.following_id == user_id)).delete(synchronize_session=False)
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+    return list(eatery_deltas)
+
+def delete_eatery(eatery_id, recomputer):
+    """
+    Delete an eatery with its reviews (and their timeline entries), taking their ratings out
+    of their authors' aggregates and the leaderboard through recomputer (a StatsRecomputer).
+    Runs in the caller's transaction. Returns (ids of the users who had reviewed it, moved
+    leaderboard ranks as update_user_ranking returns them).
+    """
+    user_deltas = rating_totals(Review.user_id, Review.eatery_id == eatery_id)
+
+    timeline.remove_review(select(Review.id).where(Review.eatery_id == eatery_id))
+    Review.query.filter_by(eatery_id=eatery_id).delete(synchronize_session=False)
+    Eatery.query.filter_by(id=eatery_id).delete(synchronize_session=False)
+    # Only once the reviews are gone, so the authors' last_review_at no longer counts them
+    ranks = recomputer.ratings_removed(user_deltas, {})
+    return list(user_deltas), ranks
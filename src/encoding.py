@@ -0,0 +1,214 @@
+"""
+Response encoding: turning response bodies into JSON bytes, and compressing them.
+
+The JSON encoder is pluggable (JSON_ENCODER): the standard library's json, or orjson, which
+encodes the same documents several times faster. Response bodies above COMPRESS_MIN_BYTES are
+compressed with the best of COMPRESS_ENCODINGS the client accepts (Accept-Encoding); streamed
+bodies are compressed chunk by chunk as they are sent. gzip is always available; orjson,
+zstd (zstandard) and br (brotli) are used if they are installed.
+"""
+import json
+import zlib
+from flask import request
+from werkzeug.http import parse_accept_header
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# -- Timestamps ---------------------------------------------------------------------
+# Most timestamps in responses belong to rows that are served again and again (hot pages,
+# cached users), so their ISO strings are kept rather than formatted on every request.
+# The cache is emptied when full, which costs less than tracking which strings are in use.
+TIMESTAMP_CACHE_SIZE = 65536
+timestamp_strings = {}
+
+def iso_timestamp(value):
+    """
+    value.isoformat(), cached for naive datetimes (aware ones with the same instant compare
+    equal but format differently).
+    """
+    if value.tzinfo is not None:
+        return value.isoformat()
+    text = timestamp_strings.get(value)
+    if text is None:
+        if len(timestamp_strings) >= TIMESTAMP_CACHE_SIZE:
+            timestamp_strings.clear()
+        text = timestamp_strings[value] = value.isoformat()
+    return text
+
+# -- JSON encoders ------------------------------------------------------------------
+def stdlib_dumps(body):
+    return json.dumps(body).encode()
+
+def orjson_dumps(body):
+    return orjson.dumps(body, option=orjson.OPT_NON_STR_KEYS)
+
+# JSON_ENCODER -> function encoding a body as JSON bytes
+ENCODERS = {
+    "json": stdlib_dumps,
+    "orjson": orjson_dumps
+}
+
+# -- Compressors --------------------------------------------------------------------
+# Levels are tuned for responses compressed on every request: most of the size reduction of
+# the slower levels at a fraction of their CPU time
+GZIP_LEVEL = 4
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+class GzipCompressor:
+    """
+    Streaming gzip compressor. compress() returns whatever output is ready, flush() the rest
+    of what was given so far (so a client can decode each streamed chunk as it arrives),
+    and finish() ends the stream. The other compressors work the same way.
+    """
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+class BrotliCompressor:
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+class ZstdCompressor:
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+# Content-Encoding -> (compressor class, whether its library is installed)
+COMPRESSORS = {
+    "zstd": (ZstdCompressor, zstandard is not None),
+    "br": (BrotliCompressor, brotli is not None),
+    "gzip": (GzipCompressor, True)
+}
+
+def compress(encoding, data):
+    """
+    data compressed in one go with the named Content-Encoding.
+    """
+    compressor = COMPRESSORS[encoding][0]()
+    return compressor.compress(data) + compressor.finish()
+
+def compress_stream(encoding, chunks):
+    """
+    Compress an iterable of str/bytes chunks with the named Content-Encoding, yielding one
+    flushed compressed chunk per input chunk.
+    """
+    compressor = COMPRESSORS[encoding][0]()
+    for chunk in chunks:
+        if not chunk:
+            continue
+        yield compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk) + compressor.flush()
+    yield compressor.finish()
+
+class ResponseEncoder:
+    """
+    Encodes response bodies with the configured JSON encoder (dumps) and compresses an app's
+    responses for clients that accept it.
+    """
+
+    def __init__(self):
+        self.dumps = stdlib_dumps
+        self.encoder = "json"
+        self.encodings = []  # usable Content-Encodings, most preferred first
+        self.min_bytes = 1024
+
+    def init_app(self, app):
+        """
+        configure() from an app's config and compress its responses.
+        """
+        self.configure(app.config)
+        app.after_request(self.after_request)
+
+    def configure(self, config):
+        """
+        Read JSON_ENCODER/COMPRESS_ENCODINGS/COMPRESS_MIN_BYTES from config. Encodings whose
+        library is not installed are skipped.
+        """
+        encoder = config["JSON_ENCODER"]
+        if encoder == "auto":
+            encoder = "orjson" if orjson is not None else "json"
+        if encoder not in ENCODERS:
+            raise ValueError("JSON_ENCODER must be 'auto', 'json' or 'orjson', not %r" % encoder)
+        if encoder == "orjson" and orjson is None:
+            raise ValueError("JSON_ENCODER is 'orjson' but orjson is not installed")
+        for encoding in config["COMPRESS_ENCODINGS"]:
+            if encoding not in COMPRESSORS:
+                raise ValueError("unknown COMPRESS_ENCODINGS entry %r (expected %s)" % (encoding, ", ".join(COMPRESSORS)))
+        self.encoder = encoder
+        self.dumps = ENCODERS[encoder]
+        self.encodings = [ e for e in config["COMPRESS_ENCODINGS"] if COMPRESSORS[e][1] ]
+        self.min_bytes = config["COMPRESS_MIN_BYTES"]
+
+    def negotiate(self, accept_encoding):
+        """
+        The Content-Encoding to use for a request's Accept-Encoding header, or None to send
+        the body as is. Ties in the client's preferences go to the order of self.encodings.
+        """
+        if not self.encodings or not accept_encoding:
+            return None
+        return parse_accept_header(accept_encoding).best_match(self.encodings)
+
+    def after_request(self, response):
+        if not self.encodings or request.method == "HEAD" or response.direct_passthrough:
+            return response
+        if response.status_code < 200 or response.status_code in (204, 304) or "Content-Encoding" in response.headers:
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = self.negotiate(request.headers.get("Accept-Encoding"))
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            # Streamed dumps are the largest responses, so they are always worth compressing
+            response.response = compress_stream(encoding, response.response)
+            response.headers.pop("Content-Length", None)
+        else:
+            body = response.get_data()
+            if len(body) < self.min_bytes:
+                return response
+            compressed = compress(encoding, body)
+            if len(compressed) >= len(body):
+                return response
+            response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoding
+        # The compressed body is a different representation of the same resource
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
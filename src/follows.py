@@ -0,0 +1,88 @@
+import datetime
+from sqlalchemy import case, literal, select
+from db import db, User, Connection, insert_or_ignore
+from encoding import iso_timestamp
+import timeline
+
+# Following and unfollowing change the Connection table and both users' counters without
+# reading the counters first. The connection is inserted (or deleted) by one statement that
+# reports whether a row actually changed, and only then are the counters moved, by an
+# UPDATE ... SET count = count + 1 on both users at once. Two requests for the same follow
+# can no longer both count it, and a repeated follow/unfollow is a no-op.
+
+def adjust_counts(follower_id, following_id, delta):
+    """
+    Add delta to the follower's following_count and to the followed user's follower_count.
+    """
+    User.query.filter(User.id.in_([follower_id, following_id])).update({
+        User.following_count: User.following_count + case((User.id == follower_id, delta), else_=0),
+        User.follower_count: User.follower_count + case((User.id == following_id, delta), else_=0),
+    }, synchronize_session=False)
+
+def missing_user(follower_id, following_id):
+    """
+    Error message if either user does not exist, else None.
+    """
+    found = set(db.session.execute(select(User.id).where(User.id.in_([follower_id, following_id]))).scalars())
+    if follower_id not in found:
+        return "follower not found"
+    if following_id not in found:
+        return "following not found"
+    return None
+
+def find_connection(follower_id, following_id):
+    """
+    (id, timestamp) of the connection from follower to following, or None.
+    """
+    return db.session.execute(
+        select(Connection.id, Connection.timestamp).filter_by(follower_id=follower_id, following_id=following_id)
+    ).first()
+
+def follow(follower_id, following_id):
+    """
+    Have one user follow another, unless they already do or either does not exist.
+    Runs in the caller's transaction. Returns (the connection's (id, timestamp) or None if
+    either user does not exist, whether it was just made).
+    """
+    users_exist = select(literal(follower_id), literal(following_id), literal(datetime.datetime.now())).where(
+        select(User.id).where(User.id == follower_id).exists(),
+        select(User.id).where(User.id == following_id).exists()
+    )
+    inserted = db.session.execute(
+        insert_or_ignore(Connection, db.session.get_bind().dialect).from_select(
+            ["follower_id", "following_id", "timestamp"], users_exist
+        )
+    ).rowcount == 1
+    if inserted:
+        adjust_counts(follower_id, following_id, 1)
+        timeline.backfill_timeline(follower_id, following_id)
+    return find_connection(follower_id, following_id), inserted
+
+def unfollow(follower_id, following_id):
+    """
+    Have one user stop following another. Runs in the caller's transaction.
+    Returns the deleted connection's (id, timestamp), or None if there was none.
+    """
+    connection = find_connection(follower_id, following_id)
+    if connection is None:
+        return None
+    if Connection.query.filter_by(id=connection.id).delete(synchronize_session=False) != 1:
+        return None
+    adjust_counts(follower_id, following_id, -1)
+    timeline.purge_timeline(follower_id, following_id)
+    return connection
+
+def serialize_connection(connection_id, timestamp, follower_id, following_id):
+    """
+    Serialize a connection like Connection.serialize, reading both users' current rows in one query.
+    """
+    users = {
+        u.id: User.serialize_row(u)
+        for u in db.session.query(*User.columns()).filter(User.id.in_([follower_id, following_id]))
+    }
+    return {
+        "id": connection_id,
+        "follower": users.get(follower_id),
+        "following": users.get(following_id),
+        "timestamp": iso_timestamp(timestamp)
+    }
@@ -0,0 +1,158 @@
+import concurrent.futures
+import contextlib
+import os
+import queue
+import threading
+import time
+from db import db
+
+class GroupCommitter:
+    """
+    Runs units of write work (functions that change the database through db.session and
+    return a result) and commits them.
+
+    By default each unit runs on the calling request's thread and gets its own commit. With
+    GROUP_COMMIT_MS set, units are handed to a single writer thread per process instead. It
+    gathers whatever arrives within that many milliseconds (at most GROUP_COMMIT_MAX_BATCH
+    units), runs each in its own SAVEPOINT so a failing unit only rolls back its own changes,
+    and commits them all at once. That costs each write up to GROUP_COMMIT_MS of latency,
+    but saves a commit (and with synchronous=FULL an fsync) per write and stops request
+    threads from contending for SQLite's write lock.
+
+    Either way a unit's transaction starts by taking SQLite's write lock (BEGIN IMMEDIATE), so
+    what it reads cannot change under it before it commits; on other databases units should
+    lock the rows they read-modify-write (SELECT ... FOR UPDATE). On SQLite, units committed
+    one at a time also queue on an in-process lock first: SQLite runs one writer at a time
+    anyway, and its busy handler retries by sleeping, so threads left to race for the write
+    lock can starve past busy_timeout.
+
+    Units must do all of their reads and writes themselves and must not commit. With group
+    commit they run outside the request (and its app context), so they should take plain
+    values, not ORM objects loaded by the request. Any exception a unit raises is re-raised
+    to its caller.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.window = 0
+        self.max_batch = 1
+        self.queue = queue.Queue()
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.write_lock = None
+        self.batches = 0
+        self.units = 0
+
+    def init_app(self, app, engine):
+        self.app = app
+        self.window = app.config["GROUP_COMMIT_MS"] / 1000
+        self.max_batch = app.config["GROUP_COMMIT_MAX_BATCH"]
+        self.write_lock = threading.Lock() if engine.dialect.name == "sqlite" else contextlib.nullcontext()
+
+    def run(self, work):
+        """
+        Run work and commit it, alone or with a group. Returns what work returned.
+        """
+        if not self.window:
+            with self.write_lock:
+                try:
+                    self.begin_write()
+                    result = work()
+                    db.session.commit()
+                except:
+                    db.session.rollback()
+                    raise
+            return result
+        future = concurrent.futures.Future()
+        self.queue.put((work, future))
+        self.start_writer()
+        return future.result()
+
+    def start_writer(self):
+        """
+        Start the writer thread if this process does not have a running one (e.g. after a fork).
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive() or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.write_loop, name="group-commit", daemon=True)
+                self.thread.start()
+
+    def write_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                with self.app.app_context():
+                    self.commit_batch(batch)
+            except Exception as e:
+                # Keep the writer alive for the next batch; nobody is left waiting on this one
+                self.app.logger.exception("Group commit failed")
+                for work, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def begin_write(self):
+        """
+        Begin the session's transaction holding the write lock (see db.use_explicit_sqlite_transactions).
+        Raises RuntimeError if the session is already in a transaction: its BEGIN has been sent
+        without the lock, and the execution options would be silently ignored.
+        """
+        if db.session().in_transaction():
+            raise RuntimeError(
+                "write units must start their session's transaction; a query ran on db.session before write_committer.run"
+            )
+        db.session.connection(execution_options={"sqlite_begin": "IMMEDIATE"})
+
+    def commit_batch(self, batch):
+        """
+        Run a batch of units in one transaction and resolve their futures. If the transaction
+        cannot begin or commit (e.g. "database is locked" once another process has held the
+        write lock past busy_timeout), every unit fails with that error.
+        """
+        outcomes = {}  # future -> (result, error)
+        try:
+            self.begin_write()
+            for work, future in batch:
+                try:
+                    with db.session.begin_nested():
+                        outcomes[future] = (work(), None)
+                except Exception as e:
+                    outcomes[future] = (None, e)
+            db.session.commit()
+            with self.lock:
+                self.batches += 1
+                self.units += len(batch)
+        except Exception as e:
+            db.session.rollback()
+            # Nothing was committed: units keep their own error, the rest get the batch's
+            outcomes = { future: (None, outcomes.get(future, (None, None))[1] or e) for work, future in batch }
+        finally:
+            db.session.remove()
+        for future, (result, error) in outcomes.items():
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self):
+        """
+        Batches committed and units in them so far, by this process's writer thread.
+        """
+        with self.lock:
+            return {
+                "enabled": bool(self.window),
+                "window_ms": self.window * 1000,
+                "batches": self.batches,
+                "units": self.units,
+                "units_per_batch": round(self.units / self.batches, 2) if self.batches else 0
+            }
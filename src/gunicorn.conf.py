@@ -0,0 +1,31 @@
+"""
+gunicorn settings for serving wsgi:app in production. Run `gunicorn` from src; this file is
+picked up automatically. Every setting can be overridden with an environment variable.
+"""
+import multiprocessing
+import os
+
+wsgi_app = "wsgi:app"
+bind = "0.0.0.0:%s" % os.environ.get("PORT", "5000")
+
+# Pre-fork worker processes, each serving requests on a small thread pool
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_class = "gthread" if threads > 1 else "sync"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+
+# Import the app (and run its startup statistics check) once in the master, then fork
+preload_app = True
+
+accesslog = "-"
+
+# Have /metrics report the totals of every worker, whichever one answers the scrape
+os.environ.setdefault("METRICS_DIR", "metrics")
+
+def post_fork(server, worker):
+    """
+    Drop database connections inherited from the master; each worker opens its own.
+    """
+    from app import db
+    with server.app.wsgi().app_context():
+        db.engine.dispose()
@@ -0,0 +1,200 @@
+"""
+Bulk review ingestion.
+
+Reviews are written in batches. Each batch is validated with a few set-based queries, inserted
+with one executemany INSERT, fanned out to timelines with one INSERT ... SELECT, folded into the
+user/eatery rating aggregates and rankings once, and committed by a runner (the app's
+write_committer, so each batch holds the write lock from its first query). Invalid rows, and rows that
+conflict with an existing review for the same user and eatery (unique_user_eatery_review), are
+skipped and reported by their position in the input.
+
+Usage:
+    python3 ingest.py reviews.ndjson      # one JSON review per line
+    python3 ingest.py reviews.json        # a JSON list of reviews
+    python3 ingest.py - < reviews.ndjson  # NDJSON from stdin
+"""
+import argparse
+import datetime
+import json
+import sys
+from flask import Flask
+from sqlalchemy import insert, tuple_
+from sqlalchemy.exc import IntegrityError
+from config import load_config
+from db import db, User, Eatery, Review
+from stats import apply_rating_deltas, update_users_ranking
+import timeline
+
+BATCH_SIZE = 1000
+
+def parse_ndjson(lines):
+    """
+    Decode one JSON value per non-blank line. Lines that are not valid JSON yield a ValueError
+    in their place, so that they are reported as errors at the right index.
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode()
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield e
+
+def parse_review(item):
+    """
+    Validate one review from the input and return it as a row for the review table.
+    Raises ValueError describing what is wrong with it.
+    """
+    if isinstance(item, ValueError):
+        raise ValueError("Invalid JSON format!")
+    if not isinstance(item, dict):
+        raise ValueError("review must be a JSON object")
+    user_id = item.get("user_id")
+    eatery_id = item.get("eatery_id")
+    rating = item.get("rating")
+    if user_id is None or eatery_id is None or rating is None:
+        raise ValueError("Missing required fields!")
+    if not isinstance(user_id, int) or not isinstance(eatery_id, int):
+        raise ValueError("user_id and eatery_id must be integers")
+    if isinstance(rating, bool) or not isinstance(rating, (int, float)) or not (1 <= rating <= 10):
+        raise ValueError("rating must be between 1 and 10")
+    review_text = item.get("review_text")
+    if review_text is not None and not isinstance(review_text, str):
+        raise ValueError("review_text must be a string")
+    timestamp = item.get("timestamp")
+    try:
+        timestamp = datetime.datetime.fromisoformat(timestamp) if timestamp else datetime.datetime.now()
+    except (TypeError, ValueError):
+        raise ValueError("timestamp must be an ISO 8601 date and time")
+    return {
+        "user_id": user_id,
+        "eatery_id": eatery_id,
+        "rating": float(rating),
+        "review_text": review_text,
+        "timestamp": timestamp
+    }
+
+def commit_each(work):
+    """
+    Run work and commit it: the runner for ingest_reviews outside the app.
+    """
+    try:
+        result = work()
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+    return result
+
+def ingest_batch(batch):
+    """
+    Insert one batch of (index, row) pairs in the caller's transaction, which the caller commits.
+    Returns (number inserted, errors); errors is a list of {"index", "error"} dicts.
+    """
+    errors = []
+    user_ids = { row["user_id"] for _, row in batch }
+    eatery_ids = { row["eatery_id"] for _, row in batch }
+    pairs = { (row["user_id"], row["eatery_id"]) for _, row in batch }
+    known_users = { id for (id,) in db.session.query(User.id).filter(User.id.in_(user_ids)) }
+    known_eateries = { id for (id,) in db.session.query(Eatery.id).filter(Eatery.id.in_(eatery_ids)) }
+    taken = set(db.session.query(Review.user_id, Review.eatery_id).filter(
+        tuple_(Review.user_id, Review.eatery_id).in_(pairs)
+    ))
+
+    rows = []
+    for index, row in batch:
+        pair = (row["user_id"], row["eatery_id"])
+        if row["user_id"] not in known_users:
+            errors.append({"index": index, "error": "user not found"})
+        elif row["eatery_id"] not in known_eateries:
+            errors.append({"index": index, "error": "eatery not found"})
+        elif pair in taken:
+            errors.append({"index": index, "error": "user has already reviewed this eatery (unique_user_eatery_review)"})
+        else:
+            taken.add(pair)
+            rows.append(row)
+    if not rows:
+        return 0, errors
+
+    db.session.execute(insert(Review), rows)
+    inserted_pairs = [ (row["user_id"], row["eatery_id"]) for row in rows ]
+    authors = { row["user_id"] for row in rows }
+    timeline.fan_out_reviews(tuple_(Review.user_id, Review.eatery_id).in_(inserted_pairs), authors)
+
+    user_deltas = {}
+    eatery_deltas = {}
+    for row in rows:
+        for deltas, key in ((user_deltas, row["user_id"]), (eatery_deltas, row["eatery_id"])):
+            total, count = deltas.get(key, (0, 0))
+            deltas[key] = (total + row["rating"], count + 1)
+    apply_rating_deltas(User, user_deltas)
+    apply_rating_deltas(Eatery, eatery_deltas)
+    update_users_ranking({ user_id: count for user_id, (_, count) in user_deltas.items() })
+    return len(rows), errors
+
+def ingest_reviews(items, batch_size=BATCH_SIZE, run=commit_each):
+    """
+    Ingest an iterable of reviews (dicts, as accepted by POST /api/reviews/) batch by batch.
+    items is consumed lazily, so it can be a stream. Each batch is run and committed by
+    run(work), e.g. GroupCommitter.run. Returns {"inserted": n, "errors": [...]}.
+    """
+    inserted = 0
+    errors = []
+
+    def flush(batch):
+        nonlocal inserted
+        # A concurrent writer can take a (user, eatery) pair between our check and our insert;
+        # the retry re-checks the batch and reports that row as a conflict
+        for attempt in range(2):
+            try:
+                count, batch_errors = run(lambda: ingest_batch(batch))
+                break
+            except IntegrityError:
+                db.session.rollback()
+                if attempt:
+                    raise
+        inserted += count
+        errors.extend(batch_errors)
+
+    batch = []
+    for index, item in enumerate(items):
+        try:
+            batch.append((index, parse_review(item)))
+        except ValueError as e:
+            errors.append({"index": index, "error": str(e)})
+        if len(batch) == batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    errors.sort(key=lambda error: error["index"])
+    return {"inserted": inserted, "errors": errors}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="NDJSON or JSON list file, or - for NDJSON on stdin")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    load_config(app)
+    app.config["SQLALCHEMY_ECHO"] = False
+    db.init_app(app)
+    with app.app_context():
+        if args.path == "-":
+            result = ingest_reviews(parse_ndjson(sys.stdin), args.batch_size)
+        else:
+            with open(args.path) as f:
+                first = f.read(1)
+                while first.isspace():
+                    first = f.read(1)
+                f.seek(0)
+                items = json.load(f) if first == "[" else parse_ndjson(f)
+                result = ingest_reviews(items, args.batch_size)
+    print(json.dumps(result, indent=2))
+    return 1 if result["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
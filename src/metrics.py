@@ -0,0 +1,326 @@
+import bisect
+import collections
+import cProfile
+import glob
+import json
+import os
+import random
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+# Upper bounds (seconds) of the request duration histogram buckets
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# How often (seconds) a process writes its changed totals to METRICS_DIR for the others to report
+SNAPSHOT_SECONDS = 1.0
+
+class RouteTotals:
+    """
+    Running totals for one (route, method) pair.
+    """
+
+    def __init__(self):
+        self.requests = collections.Counter()  # status code -> requests
+        self.duration_buckets = [0] * len(DURATION_BUCKETS)
+        self.duration = 0.0
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.response_bytes = 0
+
+    def as_dict(self):
+        return {
+            "requests": dict(self.requests), "duration_buckets": list(self.duration_buckets), "duration": self.duration,
+            "statements": self.statements, "db_time": self.db_time, "rows": self.rows,
+            "response_bytes": self.response_bytes
+        }
+
+    def add(self, totals):
+        """
+        Add another process's totals (as_dict, read back from JSON) to these.
+        """
+        self.requests.update({ int(status): count for status, count in totals["requests"].items() })
+        self.duration_buckets = [ a + b for a, b in zip(self.duration_buckets, totals["duration_buckets"]) ]
+        self.duration += totals["duration"]
+        self.statements += totals["statements"]
+        self.db_time += totals["db_time"]
+        self.rows += totals["rows"]
+        self.response_bytes += totals["response_bytes"]
+
+class RequestStats:
+    """
+    What one request has done so far; kept in flask.g while it runs.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.response_bytes = 0
+        self.status = None
+        self.profile = None
+        self.statement_start = None
+
+def current_stats():
+    """
+    The RequestStats of the request being handled on this thread, or None.
+    """
+    return g.get("request_stats") if has_request_context() else None
+
+class RequestMetrics:
+    """
+    Per-route request metrics: wall time, SQL statements, time spent in the database, rows
+    returned (or written) by the database and response bytes, served at /metrics in the
+    Prometheus text format. Each process keeps its own totals; with METRICS_DIR set, every
+    process also writes them there (at most SNAPSHOT_SECONDS old) and /metrics reports the sum
+    over all of them, so any gunicorn worker answers a scrape for the whole server.
+
+    Optionally profiles a random sample of requests (PROFILE_SAMPLE_RATE) with cProfile and
+    writes the profile of any that took at least PROFILE_SLOW_MS to PROFILE_DIR, for
+    `python3 -m pstats <file>` or snakeviz.
+    """
+
+    def __init__(self):
+        self.routes = collections.defaultdict(RouteTotals)  # (route, method) -> RouteTotals
+        self.lock = threading.Lock()
+        self.sample_rate = 0.0
+        self.slow_seconds = None
+        self.profile_dir = None
+        self.shared_dir = None
+        self.changed = False  # totals not yet written to METRICS_DIR
+        self.writer_pid = None  # process whose snapshot thread is running
+
+    def init_app(self, app, engine):
+        """
+        Hook the app's requests and the engine's statements, starting from zero. With METRICS_DIR
+        set, drops the totals left there by processes that are gone (e.g. a previous run's workers).
+        """
+        self.shared_dir = None
+        self.writer_pid = None
+        self.clear()
+        self.sample_rate = app.config["PROFILE_SAMPLE_RATE"]
+        self.slow_seconds = app.config["PROFILE_SLOW_MS"] / 1000
+        self.profile_dir = os.path.join(app.instance_path, app.config["PROFILE_DIR"])
+        if app.config["METRICS_DIR"]:
+            self.shared_dir = os.path.join(app.instance_path, app.config["METRICS_DIR"])
+            os.makedirs(self.shared_dir, exist_ok=True)
+            self.remove_dead_snapshots()
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+        if engine.dialect.name == "sqlite":
+            event.listen(engine, "checkout", self.count_sqlite_rows)
+
+    # -- Database events ----------------------------------------------------------
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = current_stats()
+        if stats is not None:
+            stats.statement_start = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = current_stats()
+        if stats is None or stats.statement_start is None:
+            return
+        stats.statements += 1
+        stats.db_time += time.perf_counter() - stats.statement_start
+        stats.statement_start = None
+        # Rows written, or rows returned by drivers that know before fetching (not SQLite; see count_sqlite_rows)
+        if cursor.rowcount > 0:
+            stats.rows += cursor.rowcount
+
+    def count_sqlite_rows(self, dbapi_connection, connection_record, connection_proxy):
+        """
+        sqlite3 does not report how many rows a SELECT returned, so count them as they are
+        fetched through a pass-through row factory.
+        """
+        def row_factory(cursor, row):
+            stats = current_stats()
+            if stats is not None:
+                stats.rows += 1
+            return row
+        dbapi_connection.row_factory = row_factory
+
+    # -- Request hooks ------------------------------------------------------------
+    def before_request(self):
+        stats = g.request_stats = RequestStats()
+        if self.sample_rate and random.random() < self.sample_rate:
+            stats.profile = cProfile.Profile()
+            stats.profile.enable()
+
+    def after_request(self, response):
+        stats = current_stats()
+        if stats is None:
+            return response
+        stats.status = response.status_code
+        if response.content_length is not None:
+            stats.response_bytes = response.content_length
+        elif response.is_streamed:
+            # Counted as it is sent; streamed routes use stream_with_context, which keeps the
+            # request (and so teardown_request) open until the last chunk
+            response.response = self.count_bytes(stats, response.response)
+        return response
+
+    def count_bytes(self, stats, chunks):
+        for chunk in chunks:
+            stats.response_bytes += len(chunk)
+            yield chunk
+
+    def teardown_request(self, exc):
+        """
+        Record the request once it is over; for streamed responses that is after the last chunk.
+        """
+        stats = g.pop("request_stats", None)
+        if stats is None:
+            return
+        duration = time.perf_counter() - stats.start
+        if stats.profile is not None:
+            stats.profile.disable()
+            if duration >= self.slow_seconds:
+                self.dump_profile(stats.profile, duration)
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        status = stats.status or 500
+        with self.lock:
+            totals = self.routes[(route, request.method)]
+            totals.requests[status] += 1
+            bucket = bisect.bisect_left(DURATION_BUCKETS, duration)
+            if bucket < len(DURATION_BUCKETS):
+                totals.duration_buckets[bucket] += 1
+            totals.duration += duration
+            totals.statements += stats.statements
+            totals.db_time += stats.db_time
+            totals.rows += stats.rows
+            totals.response_bytes += stats.response_bytes
+            self.changed = True
+        if self.shared_dir is not None:
+            self.start_writer()
+
+    def dump_profile(self, profile, duration):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = "%s-%s-%s-%dms.prof" % (
+            time.strftime("%Y%m%dT%H%M%S"), request.method,
+            request.path.strip("/").replace("/", "_") or "root", duration * 1000
+        )
+        profile.dump_stats(os.path.join(self.profile_dir, name))
+
+    # -- Sharing totals between processes -----------------------------------------
+    def snapshot(self):
+        """
+        This process's totals as [[route, method, RouteTotals.as_dict()], ...].
+        """
+        with self.lock:
+            self.changed = False
+            return [ [route, method, totals.as_dict()] for (route, method), totals in self.routes.items() ]
+
+    def start_writer(self):
+        """
+        Start this process's snapshot thread if it has none: threads do not survive a fork,
+        so each gunicorn worker starts its own on its first request.
+        """
+        with self.lock:
+            if self.writer_pid == os.getpid():
+                return
+            self.writer_pid = os.getpid()
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def write_loop(self):
+        while self.shared_dir is not None:
+            time.sleep(SNAPSHOT_SECONDS)
+            if self.changed and self.shared_dir is not None:
+                try:
+                    self.write_snapshot()
+                except OSError:
+                    pass  # e.g. METRICS_DIR went away; the next write tries again
+
+    def write_snapshot(self):
+        """
+        Replace this process's file in METRICS_DIR with its current totals.
+        """
+        path = os.path.join(self.shared_dir, "%d.json" % os.getpid())
+        temporary = "%s.%d.tmp" % (path, threading.get_ident())
+        with open(temporary, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temporary, path)  # readers see the old file or the new one, never half of it
+
+    def read_snapshots(self):
+        """
+        The totals every process has written to METRICS_DIR, this one's up to date.
+        """
+        self.write_snapshot()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.shared_dir, "*.json")):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                pass  # its process was replacing or removing it
+        return snapshots
+
+    def remove_dead_snapshots(self):
+        for path in glob.glob(os.path.join(self.shared_dir, "*.json")):
+            try:
+                os.kill(int(os.path.basename(path)[:-len(".json")]), 0)
+            except ProcessLookupError:
+                os.remove(path)
+            except (ValueError, PermissionError):
+                pass  # not a snapshot, or a process alive under another user
+
+    # -- Exposition ---------------------------------------------------------------
+    def render(self):
+        """
+        Every route's totals in the Prometheus text exposition format, summed over every
+        process sharing METRICS_DIR if it is set.
+        """
+        snapshots = self.read_snapshots() if self.shared_dir is not None else [self.snapshot()]
+        merged = collections.defaultdict(RouteTotals)
+        for snapshot in snapshots:
+            for route, method, totals in snapshot:
+                merged[(route, method)].add(totals)
+        routes = sorted(merged.items())
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            lines.extend(samples)
+
+        def labels(route, method, **extra):
+            pairs = [("route", route), ("method", method)] + sorted(extra.items())
+            return ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+
+        metric("beli_requests_total", "counter", "Requests handled, by route, method and status.", [
+            "beli_requests_total{%s} %d" % (labels(route, method, status=status), count)
+            for (route, method), totals in routes for status, count in sorted(totals.requests.items())
+        ])
+        duration = []
+        for (route, method), totals in routes:
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS, totals.duration_buckets):
+                cumulative += count
+                duration.append("beli_request_duration_seconds_bucket{%s} %d" % (labels(route, method, le=bound), cumulative))
+            total = sum(totals.requests.values())
+            duration.append("beli_request_duration_seconds_bucket{%s} %d" % (labels(route, method, le="+Inf"), total))
+            duration.append("beli_request_duration_seconds_sum{%s} %.6f" % (labels(route, method), totals.duration))
+            duration.append("beli_request_duration_seconds_count{%s} %d" % (labels(route, method), total))
+        metric("beli_request_duration_seconds", "histogram", "Wall time from request start to the last response byte.", duration)
+        for name, attribute, help_text in (
+            ("beli_sql_statements_total", "statements", "SQL statements executed."),
+            ("beli_db_seconds_total", "db_time", "Time spent executing SQL statements."),
+            ("beli_db_rows_total", "rows", "Rows returned by SELECTs plus rows written."),
+            ("beli_response_bytes_total", "response_bytes", "Response body bytes sent.")
+        ):
+            metric(name, "counter", help_text, [
+                "%s{%s} %s" % (name, labels(route, method), round(getattr(totals, attribute), 6))
+                for (route, method), totals in routes
+            ])
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self.lock:
+            self.routes.clear()
+        if self.shared_dir is not None:
+            self.write_snapshot()
@@ -0,0 +1,205 @@
+"""
+Schema migrations for existing databases.
+
+Brings a database created by an older version of the app up to date without losing data.
+Migrations are applied in order and the last one applied is recorded in the schema_version
+table; each one only adds what is missing, so it is safe on databases that already have some
+of the changes. Databases created by seed.py are stamped with the latest version.
+
+Usage: python3 migrate.py
+"""
+from flask import Flask
+from sqlalchemy import inspect, text, MetaData, Table, Column, Integer
+from config import load_config
+from db import db, create_search_indexes, User, Connection, Eatery, Review, TimelineEntry, RankBucket
+from stats import eatery_score_expression, initialize_statistics, stale_statistics, update_user_rankings
+import timeline
+
+schema_version = Table("schema_version", MetaData(), Column("version", Integer, nullable=False))
+
+# -- Helpers ------------------------------------------------------------------------
+def add_column(column):
+    """
+    Add a model column to its table unless it is already there.
+    Scalar Python defaults become the column's server default so existing rows get a value.
+    """
+    connection = db.session.connection()
+    table = column.table
+    if column.name in [ c["name"] for c in inspect(connection).get_columns(table.name) ]:
+        return
+    preparer = connection.dialect.identifier_preparer
+    ddl = "ALTER TABLE %s ADD COLUMN %s %s" % (
+        preparer.format_table(table), preparer.format_column(column), column.type.compile(connection.dialect)
+    )
+    if column.default is not None and column.default.is_scalar:
+        ddl += " DEFAULT %r" % column.default.arg
+    connection.execute(text(ddl))
+
+def drop_column(table, name):
+    """
+    Drop a column that a model no longer has, with the indexes that cover it, if it is still there.
+    """
+    connection = db.session.connection()
+    if name not in [ c["name"] for c in inspect(connection).get_columns(table.name) ]:
+        return
+    preparer = connection.dialect.identifier_preparer
+    for index in inspect(connection).get_indexes(table.name):
+        if name in index["column_names"]:
+            connection.execute(text("DROP INDEX %s" % preparer.quote(index["name"])))
+    connection.execute(text("ALTER TABLE %s DROP COLUMN %s" % (preparer.format_table(table), preparer.quote(name))))
+
+def create_indexes(table):
+    """
+    Create any of a model table's indexes that do not exist yet.
+    """
+    connection = db.session.connection()
+    existing = { i["name"] for i in inspect(connection).get_indexes(table.name) }
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(connection)
+
+# -- Migrations ---------------------------------------------------------------------
+def add_rating_aggregates():
+    """
+    Running rating sums/counts on users and eateries; filled in once the migrations finish.
+    """
+    add_column(User.__table__.c.ratings_sum)
+    add_column(Eatery.__table__.c.ratings_count)
+    add_column(Eatery.__table__.c.ratings_sum)
+
+def add_rank_index():
+    """
+    User.last_review_at and the leaderboard's rank index; filled in once the migrations finish.
+    """
+    add_column(User.__table__.c.last_review_at)
+    create_indexes(User.__table__)
+
+def add_timelines():
+    """
+    The timeline_entry table, built from existing connections and reviews.
+    """
+    TimelineEntry.__table__.create(db.session.connection(), checkfirst=True)
+    timeline.rebuild_timelines()
+
+def add_secondary_indexes():
+    """
+    Indexes behind the review and follower listings.
+    """
+    create_indexes(Review.__table__)
+    create_indexes(Connection.__table__)
+
+def add_eatery_scores():
+    """
+    Eatery.score and the top-eateries indexes, scored from the existing rating aggregates.
+    """
+    add_column(Eatery.__table__.c.score)
+    create_indexes(Eatery.__table__)
+    Eatery.query.update(
+        {Eatery.score: eatery_score_expression(Eatery.ratings_sum, Eatery.ratings_count)}, synchronize_session=False
+    )
+
+def add_search_indexes():
+    """
+    The full-text search tables over eatery and review text, indexed from the existing rows.
+    """
+    create_search_indexes(db.session.connection(), rebuild=True)
+
+def add_timeline_author_index():
+    """
+    The index deleting a user's entries from other timelines goes through. Existing tables keep
+    their foreign keys without ON DELETE CASCADE (SQLite cannot alter them); deletion.py removes
+    dependent rows itself.
+    """
+    create_indexes(TimelineEntry.__table__)
+
+def add_rank_buckets():
+    """
+    The rank_bucket table rankings are counted from, in place of each user's stored ranking.
+    """
+    drop_column(User.__table__, "ranking")
+    create_indexes(User.__table__)
+    RankBucket.__table__.create(db.session.connection(), checkfirst=True)
+    update_user_rankings()
+
+def add_connection_autoincrement():
+    """
+    Connection ids that are never reused (SQLite AUTOINCREMENT), so the follow graph sees every new follow.
+    """
+    connection = db.session.connection()
+    if connection.dialect.name != "sqlite":
+        return  # sequences and identity columns do not hand out ids again
+    table = Connection.__table__
+    ddl = connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table.name}).scalar()
+    if "AUTOINCREMENT" in ddl.upper():
+        return
+    # SQLite cannot alter a column's definition: copy the rows into a table created from the model
+    connection.execute(text("ALTER TABLE connection RENAME TO connection_old"))
+    for index in inspect(connection).get_indexes("connection_old"):
+        connection.execute(text("DROP INDEX %s" % connection.dialect.identifier_preparer.quote(index["name"])))
+    table.create(connection)
+    columns = ", ".join(c.name for c in table.columns)
+    connection.execute(text("INSERT INTO connection (%s) SELECT %s FROM connection_old" % (columns, columns)))
+    connection.execute(text("DROP TABLE connection_old"))
+
+# (version, migration) in the order they must be applied
+MIGRATIONS = [
+    (1, add_rating_aggregates),
+    (2, add_rank_index),
+    (3, add_timelines),
+    (4, add_secondary_indexes),
+    (5, add_eatery_scores),
+    (6, add_search_indexes),
+    (7, add_timeline_author_index),
+    (8, add_rank_buckets),
+    (9, add_connection_autoincrement),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def current_version():
+    """
+    The schema version recorded in the database; 0 if it has never been migrated or stamped.
+    """
+    connection = db.session.connection()
+    if not inspect(connection).has_table(schema_version.name):
+        return 0
+    return connection.execute(schema_version.select()).scalar() or 0
+
+def stamp(version=LATEST_VERSION):
+    """
+    Record version as the database's schema version.
+    """
+    connection = db.session.connection()
+    schema_version.create(connection, checkfirst=True)
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert().values(version=version))
+    db.session.commit()
+
+def migrate():
+    """
+    Apply every migration newer than the database's schema version, committing after each one,
+    then rebuild the rating aggregates/rankings if they no longer match the review table.
+    Returns the migrations applied.
+    """
+    version = current_version()
+    applied = []
+    for number, migration in MIGRATIONS:
+        if number <= version:
+            continue
+        migration()
+        stamp(number)
+        applied.append(migration)
+    if stale_statistics():
+        initialize_statistics()
+    return applied
+
+if __name__ == "__main__":
+    app = Flask(__name__)
+    load_config(app)
+    app.config["SQLALCHEMY_ECHO"] = False
+    db.init_app(app)
+    with app.app_context():
+        applied = migrate()
+        for migration in applied:
+            print("Applied: %s" % migration.__doc__.strip())
+        print("Database schema is at version %d." % current_version())
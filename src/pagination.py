@@ -0,0 +1,80 @@
+import base64
+import datetime
+import json
+from sqlalchemy import tuple_, DateTime
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(values):
+    """
+    Encode the sort key values of the last row on a page as an opaque cursor string.
+    """
+    values = [ v.isoformat() if isinstance(v, datetime.datetime) else v for v in values ]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, keys):
+    """
+    Decode a cursor produced by encode_cursor back into values for the given key columns.
+    Raises ValueError if the cursor is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("invalid cursor")
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise ValueError("invalid cursor")
+    return [
+        datetime.datetime.fromisoformat(v) if isinstance(k.type, DateTime) else v
+        for k, v in zip(keys, values)
+    ]
+
+def page_limit(args):
+    """
+    Read ?limit= from the request args. Raises ValueError if it is not a positive integer.
+    """
+    try:
+        limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    return min(limit, MAX_PAGE_SIZE)
+
+def page_query(query, args, *keys, descending=False):
+    """
+    Apply ?after= and the ordering/limit for one page to query (an ORM Query or a select()),
+    fetching one extra row to tell whether there is a next page.
+    Returns (query, limit). Raises ValueError on a bad limit or cursor.
+    """
+    limit = page_limit(args)
+    after = args.get("after")
+    if after:
+        values = decode_cursor(after, keys)
+        if descending:
+            query = query.filter(tuple_(*keys) < tuple_(*values))
+        else:
+            query = query.filter(tuple_(*keys) > tuple_(*values))
+    query = query.order_by(*[ k.desc() if descending else k for k in keys ])
+    return query.limit(limit + 1), limit
+
+def page_result(rows, limit, *keys):
+    """
+    Trim the rows fetched by a page_query to the page and build the cursor for the next one.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor([ getattr(rows[-1], k.key) for k in keys ])
+
+def paginate(query, args, *keys, descending=False):
+    """
+    Keyset-paginate query using ?limit= and ?after= from the request args.
+    Rows are ordered by keys (all ascending, or all descending), which should end in a unique column
+    and be covered by an index so that each page is a single index seek.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    Raises ValueError on a bad limit or cursor.
+    """
+    query, limit = page_query(query, args, *keys, descending=descending)
+    return page_result(query.all(), limit, *keys)
@@ -0,0 +1,194 @@
+import atexit
+import os
+import threading
+import time
+from db import User, Eatery
+from stats import apply_rating_deltas, recompute_aggregates, ratings_count_drift, update_user_ranking, update_users_ranking
+
+class StatsRecomputer:
+    """
+    Keeps users' and eateries' rating aggregates and the leaderboard up to date after review writes.
+
+    In "sync" mode (the default) a write folds its rating change into the aggregates and moves
+    the user in the leaderboard inside its own transaction, as before. In "background" mode
+    the write only marks the user and eatery dirty once it has committed, and a worker thread
+    recomputes them from the Review table off the request path. Events for the same entity are
+    coalesced: the worker waits until no new event has arrived for STATS_DEBOUNCE_MS, but never
+    longer than STATS_MAX_STALENESS_MS after the oldest pending one, then recomputes every dirty
+    entity in one transaction. Reads may therefore be up to STATS_MAX_STALENESS_MS (plus the
+    time the recompute takes) out of date.
+
+    Each process has its own queue. Dirty entities still pending when a process exits are
+    flushed on the way out; if it is killed instead, the startup checksum reports the drift and
+    `flask --app app reconcile-stats` repairs it.
+    """
+
+    def __init__(self, committer):
+        self.committer = committer  # GroupCommitter the recompute transactions go through
+        self.app = None
+        self.background = False
+        self.debounce = 0
+        self.max_staleness = 0
+        self.on_recompute = None
+        self.condition = threading.Condition()
+        self.dirty_users = set()
+        self.dirty_eateries = set()
+        self.first_event = None  # monotonic time of the oldest pending event
+        self.last_event = None
+        self.recompute_lock = threading.Lock()  # held while a recompute runs
+        self.thread = None
+        self.pid = None
+        self.events = 0
+        self.recomputes = 0
+        self.max_lag = 0.0
+        atexit.register(self.flush)
+
+    def init_app(self, app, on_recompute=None):
+        """
+        Read STATS_MODE/STATS_DEBOUNCE_MS/STATS_MAX_STALENESS_MS from an app's config and drop
+        anything queued for another app's database, with the counters.
+        on_recompute(user_ids, eatery_ids, ranks) is called (in an app context) after each
+        background recompute, with the range of leaderboard ranks that changed hands.
+        """
+        mode = app.config["STATS_MODE"]
+        if mode not in ("sync", "background"):
+            raise ValueError("STATS_MODE must be 'sync' or 'background', not %r" % mode)
+        self.app = app
+        self.background = mode == "background"
+        self.debounce = app.config["STATS_DEBOUNCE_MS"] / 1000
+        self.max_staleness = app.config["STATS_MAX_STALENESS_MS"] / 1000
+        self.on_recompute = on_recompute
+        self.take()
+        with self.condition:
+            self.events = self.recomputes = 0
+            self.max_lag = 0.0
+
+    # -- Writes -------------------------------------------------------------------
+    def rating_changed(self, user_id, eatery_id, delta_sum, delta_count):
+        """
+        Record a review write inside its transaction. In sync mode, applies the rating change
+        to the user's and eatery's aggregates and re-ranks the user, returning the moved rank
+        range (see update_user_ranking); in background mode does nothing and returns None, and
+        the caller must mark_dirty once the write has committed.
+        """
+        if self.background:
+            return None
+        apply_rating_deltas(User, {user_id: (delta_sum, delta_count)})
+        apply_rating_deltas(Eatery, {eatery_id: (delta_sum, delta_count)})
+        return update_user_ranking(user_id, delta_count)
+
+    def ratings_removed(self, user_deltas, eatery_deltas):
+        """
+        Record, inside its transaction, that reviews went away with a deleted user or eatery.
+        user_deltas and eatery_deltas ({id: (delta_sum, delta_count)}) are the rating changes of
+        the users and eateries left behind. In sync mode, applies them and re-ranks the users,
+        returning the moved rank range; in background mode does nothing and returns None, and
+        the caller must mark_dirty once the delete has committed.
+        """
+        if self.background:
+            return None
+        apply_rating_deltas(User, user_deltas)
+        apply_rating_deltas(Eatery, eatery_deltas)
+        return update_users_ranking({ user_id: delta_count for user_id, (_, delta_count) in user_deltas.items() })
+
+    def mark_dirty(self, user_ids=(), eatery_ids=()):
+        """
+        Queue users and eateries for recomputation. Call after the change has committed, so
+        the recompute cannot read the database from before it. Does nothing in sync mode.
+        """
+        if not self.background:
+            return
+        with self.condition:
+            now = time.monotonic()
+            if self.first_event is None:
+                self.first_event = now
+            self.last_event = now
+            self.dirty_users.update(user_ids)
+            self.dirty_eateries.update(eatery_ids)
+            self.events += 1
+            self.condition.notify()
+        self.start_worker()
+
+    # -- Recomputing --------------------------------------------------------------
+    def start_worker(self):
+        """
+        Start the worker thread if this process does not have one yet (e.g. after a fork).
+        """
+        with self.condition:
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.work_loop, name="stats-recompute", daemon=True)
+                self.thread.start()
+
+    def work_loop(self):
+        while True:
+            with self.condition:
+                while self.first_event is None:
+                    self.condition.wait()
+                # Debounce: wait for a quiet spell, bounded by the staleness limit
+                while self.first_event is not None:
+                    due = min(self.last_event + self.debounce, self.first_event + self.max_staleness)
+                    remaining = due - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+            try:
+                self.flush()
+            except Exception:
+                # The entities went back in the queue; try again after the next wait
+                self.app.logger.exception("Recomputing statistics failed")
+
+    def take(self):
+        """
+        Remove and return (user_ids, eatery_ids, oldest event time) of everything pending.
+        """
+        with self.condition:
+            taken = (self.dirty_users, self.dirty_eateries, self.first_event)
+            self.dirty_users, self.dirty_eateries = set(), set()
+            self.first_event = self.last_event = None
+            return taken
+
+    def flush(self):
+        """
+        Recompute everything pending now, in the calling thread, and wait for a recompute the
+        worker may be running. Returns the number of users and eateries recomputed.
+        """
+        if self.app is None:
+            return {"users": 0, "eateries": 0}
+        with self.app.app_context(), self.recompute_lock:
+            user_ids, eatery_ids, first_event = self.take()
+            if not user_ids and not eatery_ids:
+                return {"users": 0, "eateries": 0}
+
+            def work():
+                count_deltas = ratings_count_drift(user_ids)
+                recompute_aggregates(User, user_ids)
+                recompute_aggregates(Eatery, eatery_ids)
+                return update_users_ranking(count_deltas)
+
+            try:
+                ranks = self.committer.run(work)
+            except:
+                self.mark_dirty(user_ids, eatery_ids)
+                raise
+            with self.condition:
+                self.recomputes += 1
+                self.max_lag = max(self.max_lag, time.monotonic() - first_event)
+            if self.on_recompute is not None:
+                self.on_recompute(user_ids, eatery_ids, ranks)
+            return {"users": len(user_ids), "eateries": len(eatery_ids)}
+
+    def stats(self):
+        """
+        Pending entities, events queued and recomputes run by this process, and the longest
+        any event has waited to be recomputed.
+        """
+        with self.condition:
+            return {
+                "mode": "background" if self.background else "sync",
+                "pending_users": len(self.dirty_users),
+                "pending_eateries": len(self.dirty_eateries),
+                "events": self.events,
+                "recomputes": self.recomputes,
+                "max_lag_ms": round(self.max_lag * 1000, 1)
+            }
@@ -0,0 +1,67 @@
+import re
+from sqlalchemy import func, literal_column, select
+from db import db, Eatery, Review, eatery_search, review_search
+from pagination import page_query, page_result
+
+# The most words a query may have; each one is another posting list to intersect
+MAX_QUERY_WORDS = 10
+
+# Shortest last word matched as a prefix: shorter prefixes are not indexed (see db.search_index_ddl)
+# and would merge the posting lists of most of the vocabulary
+MIN_PREFIX_LENGTH = 2
+
+# The most matches ranked per query, newest (highest id) first. bm25() scores every match it is
+# given, so without a cap a word found in most reviews would rank hundreds of thousands of rows
+MAX_CANDIDATES = 2000
+
+# bm25() weights of a match in an eatery's name, location and description
+EATERY_COLUMN_WEIGHTS = (10.0, 5.0, 1.0)
+
+# What can be searched: ?type= -> (model, search table, bm25() column weights)
+SEARCHES = {
+    "eateries": (Eatery, eatery_search, EATERY_COLUMN_WEIGHTS),
+    "reviews": (Review, review_search, ()),
+}
+
+def match_expression(q):
+    """
+    The FTS5 query for a user's search text: every word must match; the last one also matches
+    as a prefix, so results show up while the word is still being typed.
+    Raises ValueError if q has no words or too many.
+    """
+    words = re.findall(r"\w+", q or "")
+    if not words:
+        raise ValueError("q must contain at least one word")
+    if len(words) > MAX_QUERY_WORDS:
+        raise ValueError("q can have at most %d words" % MAX_QUERY_WORDS)
+    # Quoted, so words like AND/OR/NEAR are not read as operators
+    terms = [ '"%s"' % w for w in words ]
+    if len(words[-1]) >= MIN_PREFIX_LENGTH:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+def search(kind, match, args):
+    """
+    One page (?limit=&after=) of the kind ("eateries" or "reviews") of rows matching an FTS5
+    query, best match (lowest bm25) first among the MAX_CANDIDATES newest matches. Returns
+    (rows, next_cursor); each row has the model's serialized columns followed by its rank.
+    Raises ValueError on a bad limit or cursor.
+    """
+    model, table, weights = SEARCHES[kind]
+    candidates = select(
+        table.c.rowid.label("id"), func.bm25(literal_column(table.name), *weights).label("rank")
+    ).where(table.c[table.name].match(match)).order_by(table.c.rowid.desc()).limit(MAX_CANDIDATES).subquery()
+    # Rank and page on the index alone, then read just the page's rows
+    page, limit = page_query(select(candidates.c.id, candidates.c.rank), args, candidates.c.rank, candidates.c.id)
+    page = page.subquery()
+    rows = db.session.query(*model.columns(), page.c.rank).join(page, page.c.id == model.id).order_by(
+        page.c.rank, page.c.id
+    ).all()
+    return page_result(rows, limit, page.c.rank, model.id)
+
+def serialize_result(kind, row):
+    """
+    Serialize a row returned by search, with its relevance score (higher is better).
+    """
+    model = SEARCHES[kind][0]
+    return dict(model.serialize_row(row), score=-row.rank)
@@ -1,15 +1,31 @@
+import argparse
 from flask import Flask
 from db import db, User, Connection, Eatery, Review
+from stats import initialize_statistics
+import timeline
+import migrate
+import synthetic
+from config import load_config
+
+parser = argparse.ArgumentParser(description="Reset the database with sample data, plus optional synthetic data (see synthetic.py).")
+parser.add_argument("--users", type=int, default=0, help="synthetic users to add")
+parser.add_argument("--reviews-per-user", type=int, default=10)
+parser.add_argument("--following", type=int, default=20, help="average number of users each synthetic user follows")
+parser.add_argument("--eateries", type=int, default=100, help="total eateries once synthetic ones are added")
+parser.add_argument("--exponent", type=float, default=1.1, help="power-law exponent of follower popularity")
+parser.add_argument("--seed", type=int, default=0, help="random seed for synthetic data")
+args = parser.parse_args()
 
 app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///beli.db"  
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+load_config(app)
+app.config["SQLALCHEMY_ECHO"] = False
 
 db.init_app(app)
 
 with app.app_context():
     db.drop_all() # Reset
     db.create_all() # Prepopulate database with existing data
+    migrate.stamp() # Tables are created at the latest schema version
 
     # Users
     user1 = User(name="Lydia",  username="lydia")
@@ -80,5 +96,14 @@ with app.app_context():
     # Add and commit
     db.session.add_all(users + eateries + connections + reviews)
     db.session.commit()
+    initialize_statistics()
+    timeline.rebuild_timelines()
 
     print("✅ Database seeded with sample data.")
+
+    if args.users:
+        added = synthetic.generate(
+            args.users, args.reviews_per_user, following=args.following,
+            eateries=args.eateries, exponent=args.exponent, seed=args.seed
+        )
+        print("✅ Added synthetic data: %s." % ", ".join("%d %s" % (n, table) for table, n in added.items()))
@@ -0,0 +1,292 @@
+from db import db, User, Connection, Eatery, Review, RankBucket, rank_expression, insert_or_ignore
+from sqlalchemy import func, case, cast, bindparam, select, insert
+
+# Eatery scores pull each average towards EATERY_SCORE_PRIOR_MEAN as if the eatery had
+# EATERY_SCORE_PRIOR_WEIGHT more reviews of that rating, so a couple of 10s do not outrank
+# dozens of 9s. Changing either means recomputing every score (reconcile-stats --force).
+EATERY_SCORE_PRIOR_MEAN = 5.5
+EATERY_SCORE_PRIOR_WEIGHT = 5
+
+# Leaderboard order: more reviews = higher rank (lower number); ties go to the user who
+# reviewed most recently, then to the lower id. ix_user_rank_key read backwards.
+LEADERBOARD_ORDER = (User.ratings_count.desc(), User.last_review_at.desc(), User.id)
+
+# -- Update rankings/average ratings ---------------------------------------------
+# Rankings are not stored per user. RankBucket holds how many users have each review count,
+# and User.ranking counts the users in the buckets above plus those ahead in the same bucket
+# (db.rank_expression). A review write only moves its author between two buckets; before,
+# it renumbered every user between the author's old and new rank, up to the whole table.
+
+def refresh_last_review_at(user_ids=None):
+    """
+    Set the last review time of the users with the given ids (everyone's if None) from the Review table.
+    """
+    last_review_at = db.session.query(func.max(Review.timestamp)).filter(Review.user_id == User.id).scalar_subquery()
+    refreshed = User.query if user_ids is None else User.query.filter(User.id.in_(list(user_ids)))
+    refreshed.update({User.last_review_at: last_review_at}, synchronize_session=False)
+
+def update_user_rankings(user_ids=None):
+    """
+    Rebuild the leaderboard's rank buckets from scratch, after refreshing the last review time
+    of the users with the given ids (everyone's if None). Expects ratings_count to be up to date.
+    Runs in the caller's transaction, so the caller is responsible for committing.
+    """
+    refresh_last_review_at(user_ids)
+    RankBucket.query.delete(synchronize_session=False)
+    db.session.execute(insert(RankBucket).from_select(
+        ["ratings_count", "users"],
+        select(User.ratings_count, func.count(User.id)).where(User.ratings_count > 0).group_by(User.ratings_count)
+    ))
+
+def move_between_buckets(bucket_deltas):
+    """
+    Add delta to the number of users in each rank bucket of bucket_deltas ({ratings_count: delta}),
+    creating the buckets that do not exist yet. Two statements however many buckets change.
+    """
+    bucket_deltas = { count: delta for count, delta in bucket_deltas.items() if delta }
+    if not bucket_deltas:
+        return
+    table = RankBucket.__table__
+    db.session.execute(insert_or_ignore(RankBucket, db.session.get_bind().dialect), [
+        {"ratings_count": count, "users": 0} for count in bucket_deltas
+    ])
+    update = table.update().where(table.c.ratings_count == bindparam("bucket")).values(
+        users=table.c.users + bindparam("delta")
+    )
+    db.session.execute(update, [ {"bucket": count, "delta": delta} for count, delta in bucket_deltas.items() ])
+
+def rank_of(ratings_count, last_review_at, user_id):
+    """
+    The rank a user with this review count, last review time and id has (or would have) in the
+    leaderboard as it stands; 0 without reviews.
+    """
+    if ratings_count <= 0:
+        return 0
+    return db.session.query(rank_expression(ratings_count, last_review_at, user_id)).scalar()
+
+def update_user_ranking(user_id, delta_count):
+    """
+    Move one user to their place in the leaderboard after their review count changed by
+    delta_count; see update_users_ranking.
+    """
+    return update_users_ranking({user_id: delta_count})
+
+def update_users_ranking(count_deltas):
+    """
+    Move users to their places in the leaderboard after their reviews changed. count_deltas
+    ({user_id: change in ratings_count}) must already be applied to ratings_count. Refreshes
+    their last review time and moves each from the bucket of their old count to that of their
+    new one; no other user's row is written.
+    Runs in the caller's transaction, so the caller is responsible for committing.
+    Returns the (lo, hi) range of rankings whose holders changed (hi None means down to the
+    last user), or None if nothing moved.
+    """
+    if not count_deltas:
+        return None
+    user_ids = list(count_deltas)
+    keys = db.session.query(User.id, User.ratings_count, User.last_review_at).filter(User.id.in_(user_ids))
+    old_keys = { id: (count - count_deltas[id], last) for id, count, last in keys }
+    refresh_last_review_at(user_ids)
+    new_keys = { id: (count, last) for id, count, last in keys }
+
+    bucket_deltas = {}
+    moved = []
+    for user_id, new_key in new_keys.items():
+        old_key = old_keys[user_id]
+        if old_key == new_key:
+            continue
+        for (count, last), delta in ((old_key, -1), (new_key, 1)):
+            if count > 0:
+                bucket_deltas[count] = bucket_deltas.get(count, 0) + delta
+            moved.append((count, last, user_id))
+    if not moved:
+        return None
+    move_between_buckets(bucket_deltas)
+
+    # Only users whose place lies between a mover's old and new place change rank; a user
+    # joining or leaving the leaderboard moves everyone below their place
+    ranked = [ key for key in moved if key[0] > 0 ]
+    if not ranked:
+        return None
+    def place(key):
+        count, last, user_id = key
+        return (-count, -last.timestamp() if last else 0.0, user_id)
+    lo = rank_of(*min(ranked, key=place))
+    if len(ranked) < len(moved):
+        return (lo, None)
+    return (lo, rank_of(*max(ranked, key=place)))
+
+def drop_user_ranking(user_id):
+    """
+    Take a user who is about to be deleted out of the leaderboard. Runs in the caller's transaction.
+    """
+    count = db.session.execute(select(User.ratings_count).where(User.id == user_id)).scalar()
+    if count:
+        move_between_buckets({count: -1})
+
+def ratings_count_drift(user_ids):
+    """
+    {user_id: reviews in the Review table - stored ratings_count} for the users with the given
+    ids: the count_deltas recomputing their aggregates will make.
+    """
+    review_count = db.session.query(func.count(Review.id)).filter(Review.user_id == User.id).scalar_subquery()
+    return dict(db.session.query(User.id, review_count - User.ratings_count).filter(User.id.in_(list(user_ids))))
+
+def average_rating_expression(ratings_sum, ratings_count):
+    """
+    SQL expression for an average rating (rounded to 1 decimal) from a running sum and count.
+    """
+    return case(
+        (ratings_count > 0, func.round(cast(ratings_sum / ratings_count, db.Numeric), 1)),
+        else_=0
+    )
+
+def eatery_score_expression(ratings_sum, ratings_count):
+    """
+    SQL expression for an eatery's score, its Bayesian average rating, from a running sum and
+    count (0 without reviews, like the average).
+    """
+    return case(
+        (ratings_count > 0, (ratings_sum + EATERY_SCORE_PRIOR_MEAN * EATERY_SCORE_PRIOR_WEIGHT)
+            / (ratings_count + EATERY_SCORE_PRIOR_WEIGHT)),
+        else_=0
+    )
+
+def aggregate_values(model, ratings_sum, ratings_count):
+    """
+    Column values for a User's or Eatery's rating aggregates given SQL expressions for the new sum and count.
+    """
+    values = {
+        "ratings_sum": ratings_sum,
+        "ratings_count": ratings_count,
+        "average_rating": average_rating_expression(ratings_sum, ratings_count)
+    }
+    if model is Eatery:
+        values["score"] = eatery_score_expression(ratings_sum, ratings_count)
+    return values
+
+def apply_rating_deltas(model, deltas):
+    """
+    Add (delta_sum, delta_count) to the running rating sum/count of each User or Eatery in deltas
+    ({id: (delta_sum, delta_count)}) and refresh their average ratings (and eateries' scores). One
+    UPDATE statement, executed once per entity. Runs in the caller's transaction, so the caller is
+    responsible for committing.
+    """
+    if not deltas:
+        return
+    table = model.__table__
+    ratings_sum = table.c.ratings_sum + bindparam("delta_sum")
+    ratings_count = table.c.ratings_count + bindparam("delta_count")
+    update = table.update().where(table.c.id == bindparam("entity_id")).values(
+        **aggregate_values(model, ratings_sum, ratings_count)
+    )
+    db.session.execute(update, [
+        {"entity_id": entity_id, "delta_sum": delta_sum, "delta_count": delta_count}
+        for entity_id, (delta_sum, delta_count) in deltas.items()
+    ])
+
+def update_user_average_rating(user_id, delta_sum, delta_count):
+    """"
+    Update user's running rating sum/count by the given deltas and refresh their average rating.
+    Runs in the caller's transaction, so the caller is responsible for committing.
+    """
+    apply_rating_deltas(User, {user_id: (delta_sum, delta_count)})
+
+def update_eatery_average_rating(eatery_id, delta_sum, delta_count):
+    """"
+    Update eatery's running rating sum/count by the given deltas and refresh its average rating and score.
+    Runs in the caller's transaction, so the caller is responsible for committing.
+    """
+    apply_rating_deltas(Eatery, {eatery_id: (delta_sum, delta_count)})
+
+def recompute_aggregates(model, ids=None):
+    """
+    Rebuild the rating sum/count/average (and score) of the Users or Eateries with the given ids (every
+    row if ids is None) from the Review table, in one set-based UPDATE. Unlike
+    apply_rating_deltas this does not depend on what was stored before, so running it twice
+    or late does no harm. Runs in the caller's transaction, so the caller is responsible for committing.
+    """
+    fk = Review.user_id if model is User else Review.eatery_id
+    ratings_sum = db.session.query(func.coalesce(func.sum(Review.rating), 0)).filter(fk == model.id).scalar_subquery()
+    ratings_count = db.session.query(func.count(Review.id)).filter(fk == model.id).scalar_subquery()
+    rows = model.query if ids is None else model.query.filter(model.id.in_(list(ids)))
+    rows.update(aggregate_values(model, ratings_sum, ratings_count), synchronize_session=False)
+
+def recompute_follow_counts():
+    """
+    Rebuild every user's follower/following counts from the Connection table, in one set-based
+    UPDATE per counter. Runs in the caller's transaction, so the caller is responsible for committing.
+    """
+    for column, key in ((User.follower_count, Connection.following_id), (User.following_count, Connection.follower_id)):
+        count = db.session.query(func.count(Connection.id)).filter(key == User.id).scalar_subquery()
+        User.query.update({column: count}, synchronize_session=False)
+
+def reconcile_statistics():
+    """
+    Rebuild every user's and eatery's rating sum/count/average from the Review table, and every
+    user's follow counts from the Connection table. One set-based UPDATE per table/counter; use
+    this to repair drifted running aggregates.
+    Runs in the caller's transaction, so the caller is responsible for committing.
+    """
+    recompute_aggregates(User)
+    recompute_aggregates(Eatery)
+    recompute_follow_counts()
+
+def statistics_checksum():
+    """
+    Checksum of the persisted aggregates against the Review and Connection tables, as a dict of
+    name: (stored, expected) pairs. Each pair is one aggregate query, so this is cheap to run
+    at startup compared to rebuilding anything. Drift that cancels out across rows (e.g. two
+    users' counts swapped) is not caught; `reconcile-stats --force` rebuilds regardless.
+    """
+    review_count, review_total = db.session.query(
+        func.count(Review.id), func.coalesce(func.sum(Review.rating), 0)
+    ).one()
+    checksum = {}
+    for model in (User, Eatery):
+        count, total = db.session.query(
+            func.coalesce(func.sum(model.ratings_count), 0), func.coalesce(func.sum(model.ratings_sum), 0)
+        ).one()
+        checksum[model.__tablename__ + "_ratings_count"] = (count, review_count)
+        checksum[model.__tablename__ + "_ratings_sum"] = (total, review_total)
+    # Scores follow from the stored sums/counts checked above
+    checksum["eatery_score"] = db.session.query(
+        func.coalesce(func.sum(Eatery.score), 0),
+        func.coalesce(func.sum(eatery_score_expression(Eatery.ratings_sum, Eatery.ratings_count)), 0)
+    ).one()
+    # Every reviewer is counted once, in the rank bucket of their review count
+    bucket_users, bucket_reviews = db.session.query(
+        func.coalesce(func.sum(RankBucket.users), 0), func.coalesce(func.sum(RankBucket.users * RankBucket.ratings_count), 0)
+    ).one()
+    reviewers, reviewed = db.session.query(
+        func.count(User.id), func.coalesce(func.sum(User.ratings_count), 0)
+    ).filter(User.ratings_count > 0).one()
+    checksum["rank_bucket_users"] = (bucket_users, reviewers)
+    checksum["rank_bucket_reviews"] = (bucket_reviews, reviewed)
+    # Every connection is counted once on each side
+    connections = db.session.query(func.count(Connection.id)).scalar()
+    follower_total, following_total = db.session.query(
+        func.coalesce(func.sum(User.follower_count), 0), func.coalesce(func.sum(User.following_count), 0)
+    ).one()
+    checksum["user_follower_count"] = (follower_total, connections)
+    checksum["user_following_count"] = (following_total, connections)
+    return checksum
+
+def stale_statistics():
+    """
+    Names of the checksum entries that do not match; empty if the aggregates are consistent.
+    Rating sums are floats built up one delta at a time, so they only need to match closely.
+    """
+    return [
+        name for name, (stored, expected) in statistics_checksum().items()
+        if abs(stored - expected) > 1e-6
+    ]
+
+def initialize_statistics():
+    """
+    Rebuild average ratings for users/eateries + rank buckets from the Review table and commit.
+    Maintenance only (reconcile-stats, migrate.py, seed.py); the app never runs this on startup.
+    """
+    reconcile_statistics()
+    update_user_rankings()
+    db.session.commit()
@@ -0,0 +1,122 @@
+"""
+Synthetic data at scale, for benchmarks and for trying the routes against a realistic amount of data.
+
+Follows have a power-law shape: everyone follows about the same number of people, but whom they
+follow is drawn with probability proportional to 1 / popularity_rank ** exponent, so a few users
+collect most of the followers, as on real social networks. Every user reviews the same number of
+distinct eateries, with ratings and timestamps spread over the past year. Review text is a few
+words drawn from a vocabulary with the same power-law shape (Zipf's law), so that full-text
+search sees a few very common words and a long tail of rare ones. Generation is seeded, so the
+same arguments always give the same data.
+
+Usage: python3 seed.py --users 10000 --reviews-per-user 20 [--following 50] [--eateries 200]
+"""
+import bisect
+import datetime
+import itertools
+import random
+from sqlalchemy import func, insert
+from db import db, User, Connection, Eatery, Review
+from stats import initialize_statistics
+import timeline
+
+# Rows per executemany INSERT
+INSERT_BATCH_SIZE = 10000
+
+# The most common words of review text, most common first; the long tail is made-up dish names
+REVIEW_WORDS = (
+    "the", "and", "was", "good", "great", "food", "really", "place", "service", "love", "nice", "coffee",
+    "pizza", "lunch", "friendly", "delicious", "fresh", "best", "spicy", "sandwich", "salad", "noodles",
+    "cheap", "slow", "crowded", "quiet", "burrito", "soup", "bagel", "dessert", "overpriced", "cozy"
+)
+REVIEW_VOCABULARY_SIZE = 20000
+REVIEW_WORDS_PER_REVIEW = (4, 30)
+
+def insert_rows(model, rows):
+    """
+    Insert an iterable of row dicts into model's table, INSERT_BATCH_SIZE rows per statement.
+    """
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, INSERT_BATCH_SIZE))
+        if not batch:
+            return
+        db.session.execute(insert(model), batch)
+
+def power_law_sampler(population, exponent, rng):
+    """
+    A function drawing one member of population, the i-th (from 0) with probability
+    proportional to 1 / (i + 1) ** exponent.
+    """
+    cumulative = list(itertools.accumulate(1 / (i + 1) ** exponent for i in range(len(population))))
+    total = cumulative[-1]
+    return lambda: population[bisect.bisect_left(cumulative, rng.random() * total)]
+
+def generate(users, reviews_per_user, following=20, eateries=100, exponent=1.1, seed=0):
+    """
+    Add users new users, eateries new eateries (fewer if enough already exist), about following
+    follows per new user and reviews_per_user reviews per new user to the database, then rebuild
+    the statistics, follower counts and timelines. Returns the number of rows added per table.
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime.now()
+    year = datetime.timedelta(days=365).total_seconds()
+
+    first_user = (db.session.query(func.max(User.id)).scalar() or 0) + 1
+    user_ids = list(range(first_user, first_user + users))
+    insert_rows(User, (
+        {"name": "User %d" % id, "username": "user%d" % id, "bio": "", "location": "", "timestamp": now}
+        for id in user_ids
+    ))
+
+    existing_eateries = db.session.query(func.count(Eatery.id)).scalar()
+    first_eatery = (db.session.query(func.max(Eatery.id)).scalar() or 0) + 1
+    new_eateries = max(0, eateries - existing_eateries)
+    insert_rows(Eatery, (
+        {"name": "Eatery %d" % id, "description": "", "location": "Hall %d" % (id % 50), "average_rating": 0}
+        for id in range(first_eatery, first_eatery + new_eateries)
+    ))
+    eatery_ids = [ id for (id,) in db.session.query(Eatery.id) ]
+
+    # Popularity order is a shuffle of the new users, so follower counts are not tied to ids
+    popular = user_ids[:]
+    rng.shuffle(popular)
+    pick_followee = power_law_sampler(popular, exponent, rng)
+    connections = []
+    for follower_id in user_ids:
+        wanted = min(max(0, round(rng.expovariate(1 / following))) if following else 0, users - 1)
+        followees = set()
+        # Give up after a few misses: the most popular users get drawn over and over
+        for _ in range(wanted * 4):
+            if len(followees) == wanted:
+                break
+            followee = pick_followee()
+            if followee != follower_id:
+                followees.add(followee)
+        connections.extend({"follower_id": follower_id, "following_id": f} for f in followees)
+    insert_rows(Connection, connections)
+
+    vocabulary = list(REVIEW_WORDS) + [ "dish%d" % i for i in range(REVIEW_VOCABULARY_SIZE - len(REVIEW_WORDS)) ]
+    pick_word = power_law_sampler(vocabulary, 1.0, rng)
+    reviews = []
+    for user_id in user_ids:
+        for eatery_id in rng.sample(eatery_ids, min(reviews_per_user, len(eatery_ids))):
+            reviews.append({
+                "user_id": user_id,
+                "eatery_id": eatery_id,
+                "rating": round(rng.uniform(1, 10), 1),
+                "review_text": " ".join(pick_word() for _ in range(rng.randint(*REVIEW_WORDS_PER_REVIEW))),
+                "timestamp": now - datetime.timedelta(seconds=rng.random() * year)
+            })
+    insert_rows(Review, reviews)
+
+    db.session.commit()
+    # Also counts everyone's followers/following
+    initialize_statistics()
+    timeline.rebuild_timelines()
+    return {
+        "users": users,
+        "eateries": new_eateries,
+        "connections": len(connections),
+        "reviews": len(reviews)
+    }
@@ -0,0 +1,52 @@
+"""
+Fixtures shared by the tests: a database seeded with seed.py's sample data, and apps built on
+copies of it. Run the tests from src with `python3 -m pytest`.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import pytest
+from app import create_app
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def use_database(monkeypatch, path, **settings):
+    """
+    Point apps created from now on at the SQLite file at path, with SQL echo off and settings
+    applied as environment overrides (see config.ENV_OVERRIDES).
+    """
+    monkeypatch.setenv("SQLALCHEMY_DATABASE_URI", "sqlite:///%s" % path)
+    monkeypatch.setenv("SQLALCHEMY_ECHO", "0")
+    for name, value in settings.items():
+        monkeypatch.setenv(name, str(value))
+
+@pytest.fixture(scope="session")
+def seeded_database(tmp_path_factory):
+    """
+    Path of a SQLite file seeded by seed.py, once per session. Tests that write use a copy (database).
+    """
+    path = tmp_path_factory.mktemp("seeded") / "beli.db"
+    env = {**os.environ, "SQLALCHEMY_DATABASE_URI": "sqlite:///%s" % path}
+    subprocess.run([sys.executable, "seed.py"], cwd=SRC, env=env, check=True, stdout=subprocess.DEVNULL)
+    return path
+
+@pytest.fixture
+def database(seeded_database, tmp_path):
+    """
+    Path of this test's own copy of the seeded database.
+    """
+    path = tmp_path / "beli.db"
+    shutil.copyfile(seeded_database, path)
+    return path
+
+@pytest.fixture
+def make_app(database, monkeypatch):
+    """
+    make_app(profile="development", **settings): an app on this test's database, with settings
+    applied as environment overrides (so processes it starts inherit them).
+    """
+    def make(profile="development", **settings):
+        use_database(monkeypatch, database, **settings)
+        return create_app(profile)
+    return make
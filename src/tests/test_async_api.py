@@ -0,0 +1,48 @@
+"""
+The async read API serves the same bodies as app.py for the routes it shares, from the same configuration.
+"""
+import json
+import os
+import pytest
+from starlette.testclient import TestClient
+from async_api import create_async_app
+from config import instance_database_url
+
+ROUTES_TO_COMPARE = [
+    "/api/users/1/followers/?limit=2",
+    "/api/users/1/following/",
+    "/api/users/3/reviews/",
+    "/api/users/1/following_reviews/",
+    "/api/leaderboard/?user_id=4",
+    "/api/leaderboard/?limit=500",
+    "/api/leaderboard/?user_id=abc",
+    "/api/leaderboard/?user_id=0",
+    "/api/leaderboard/?limit=x&user_id=abc",
+    "/api/leaderboard/?limit=0",
+    "/api/eateries/19/reviews/",
+    "/api/reviews/?limit=3",
+    "/api/users/999/followers/",
+    "/api/reviews/?limit=x",
+]
+
+def test_async_api_matches_wsgi_app(make_app):
+    wsgi = make_app().test_client()
+    with TestClient(create_async_app("development")) as client:
+        for route in ROUTES_TO_COMPARE:
+            expected = wsgi.get(route)
+            response = client.get(route)
+            assert (response.status_code, response.json()) == (expected.status_code, json.loads(expected.data)), route
+
+@pytest.mark.parametrize("url, resolved", [
+    ("sqlite:///beli.db", "sqlite:///{instance}/beli.db"),
+    ("sqlite:///data/beli.db", "sqlite:///{instance}/data/beli.db"),
+    ("sqlite:////var/beli.db", "sqlite:////var/beli.db"),
+    ("sqlite:///file:beli.db?uri=true", "sqlite:///file:{instance}/beli.db?uri=true"),
+    ("sqlite://", "sqlite://"),
+    ("postgresql://beli@db/beli", "postgresql://beli@db/beli"),
+])
+def test_relative_sqlite_paths_resolve_against_instance_folder(tmp_path, url, resolved):
+    instance = str(tmp_path / "instance")
+    assert str(instance_database_url(url, instance)) == resolved.format(instance=instance)
+    if "{instance}" in resolved:
+        assert os.path.isdir(instance)
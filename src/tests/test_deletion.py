@@ -0,0 +1,79 @@
+"""
+Deleting users, eateries and reviews keeps aggregates, follow counters and the leaderboard
+consistent with the rows left behind, also on databases created before ON DELETE CASCADE.
+"""
+import json
+import shutil
+import pytest
+from sqlalchemy import func
+from app import create_app
+from conftest import SRC, use_database
+from db import db, User, Review, Connection
+from stats import stale_statistics
+from test_follows import counter_mismatches
+from test_recompute import post_review
+
+def expected_ranking():
+    """
+    {user id: ranking} worked out from the Review table alone: most reviews first, then the
+    most recent review, then the lowest id; 0 for users without reviews.
+    """
+    reviews = dict(db.session.query(Review.user_id, func.count(Review.id)).group_by(Review.user_id).all())
+    last = dict(db.session.query(Review.user_id, func.max(Review.timestamp)).group_by(Review.user_id).all())
+    ranked = sorted(reviews, key=lambda user_id: (-reviews[user_id], -last[user_id].timestamp(), user_id))
+    ranking = { user_id: 0 for user_id, in db.session.query(User.id) }
+    ranking.update({ user_id: place for place, user_id in enumerate(ranked, start=1) })
+    return ranking
+
+def assert_consistent(app):
+    with app.app_context():
+        assert stale_statistics() == []
+        assert counter_mismatches() == []
+        assert dict(db.session.query(User.id, User.ranking)) == expected_ranking()
+
+@pytest.fixture(params=["sync", "background"])
+def app(make_app, request):
+    return make_app(STATS_MODE=request.param)
+
+def flush(client):
+    assert client.post("/api/admin/flush/").status_code == 200
+
+def test_delete_eatery_reranks_by_the_remaining_reviews(app):
+    client = app.test_client()
+    post_review(client, 4, 2, 8)  # user 4: two reviews
+    post_review(client, 2, 4, 6)
+    assert client.delete("/api/reviews/3/").status_code == 200  # user 2: two reviews, the latest after user 4's
+    post_review(client, 4, 3, 9)  # user 4 pulls ahead of user 2 with a third review...
+    assert client.delete("/api/eateries/3/").status_code == 200
+    flush(client)
+    # ...and drops back behind them once it is deleted: user 2 reviewed more recently
+    rankings = { user_id: json.loads(client.get("/api/users/%d/ranking/" % user_id).data)["ranking"] for user_id in (2, 4) }
+    assert rankings[2] < rankings[4]
+    assert_consistent(app)
+
+def test_delete_user(app):
+    client = app.test_client()
+    assert client.delete("/api/users/3/").status_code == 200
+    flush(client)
+    assert_consistent(app)
+    with app.app_context():
+        assert db.session.query(Connection).filter((Connection.follower_id == 3) | (Connection.following_id == 3)).count() == 0
+
+def test_delete_review(app):
+    client = app.test_client()
+    assert client.delete("/api/reviews/5/").status_code == 200
+    assert client.delete("/api/reviews/5/").status_code == 404
+    flush(client)
+    assert_consistent(app)
+
+def test_deletes_without_cascading_foreign_keys(monkeypatch, tmp_path):
+    # The bundled database predates ON DELETE CASCADE on the timeline's foreign keys
+    path = tmp_path / "beli.db"
+    shutil.copyfile("%s/instance/beli.db" % SRC, path)
+    use_database(monkeypatch, path, STATS_MODE="sync")
+    app = create_app("development")
+    client = app.test_client()
+    assert client.delete("/api/reviews/1/").status_code == 200
+    assert client.delete("/api/eateries/19/").status_code == 200
+    assert client.delete("/api/users/4/").status_code == 200
+    assert_consistent(app)
@@ -0,0 +1,112 @@
+"""
+Follow/unfollow keeps both users' counters in step with the Connection table, also when
+several server processes write to one SQLite file at once.
+"""
+import json
+import multiprocessing
+import random
+import shutil
+import sqlite3
+import threading
+import pytest
+from sqlalchemy import func
+from app import create_app, follow_graph
+from conftest import SRC, use_database
+from db import db, User, Connection
+
+PROCESSES = 4
+THREADS = 2  # clients per process, so writers also wait on each other in-process
+REQUESTS = 40  # per client
+USERS = (1, 2, 3, 4)  # the seeded users; few pairs, so clients keep hitting the same ones
+
+def counter_mismatches():
+    """
+    [(user id, follower_count, followers, following_count, following)] for every user whose
+    counters disagree with the Connection table.
+    """
+    followers = db.session.query(func.count(Connection.id)).filter(Connection.following_id == User.id).scalar_subquery()
+    following = db.session.query(func.count(Connection.id)).filter(Connection.follower_id == User.id).scalar_subquery()
+    return db.session.query(User.id, User.follower_count, followers, User.following_count, following).filter(
+        (User.follower_count != followers) | (User.following_count != following)
+    ).all()
+
+def follow_client(seed, barrier, results):
+    """
+    One server process: an app on the shared database (from the environment the test set)
+    whose clients follow and unfollow random pairs. Puts the unexpected statuses on results.
+    """
+    app = create_app("production", check_stats=False)
+    unexpected = []
+
+    def client(rng):
+        http = app.test_client()
+        for _ in range(REQUESTS):
+            method = rng.choice(["POST", "DELETE"])
+            follower_id, following_id = rng.sample(USERS, 2)
+            response = http.open("/api/connections/", method=method, data=json.dumps({
+                "follower_id": follower_id, "following_id": following_id
+            }))
+            # Unfollowing a pair that is not connected is a 404; anything else is an error
+            if response.status_code != 200 and (method, response.status_code) != ("DELETE", 404):
+                unexpected.append((method, response.status_code))
+
+    clients = [ threading.Thread(target=client, args=(random.Random(seed * THREADS + i),)) for i in range(THREADS) ]
+    barrier.wait()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    results.put(unexpected)
+
+@pytest.mark.parametrize("group_commit_ms", [0, 2])
+def test_concurrent_follows_across_processes(make_app, group_commit_ms):
+    app = make_app("production", GROUP_COMMIT_MS=group_commit_ms)
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(PROCESSES)
+    results = context.Queue()
+    processes = [ context.Process(target=follow_client, args=(seed, barrier, results)) for seed in range(PROCESSES) ]
+    for process in processes:
+        process.start()
+    unexpected = [ status for _ in processes for status in results.get(timeout=120) ]
+    for process in processes:
+        process.join(timeout=30)
+        assert process.exitcode == 0
+
+    assert unexpected == []
+    with app.app_context():
+        assert counter_mismatches() == []
+        connections = db.session.query(func.count(Connection.id)).scalar()
+        totals = db.session.query(func.sum(User.follower_count), func.sum(User.following_count)).one()
+    assert tuple(totals) == (connections, connections)
+
+def test_repeated_follow_and_unfollow_are_no_ops(make_app):
+    app = make_app()
+    client = app.test_client()
+    pair = json.dumps({"follower_id": 2, "following_id": 3})
+    assert [ client.post("/api/connections/", data=pair).status_code for _ in range(2) ] == [200, 200]
+    assert [ client.delete("/api/connections/", data=pair).status_code for _ in range(2) ] == [200, 404]
+    with app.app_context():
+        assert counter_mismatches() == []
+        assert db.session.get(User, 3).follower_count == 1  # only user 1 is left following 3
+
+@pytest.mark.parametrize("bundled", [False, True])
+def test_follow_graph_sees_follows_after_an_unfollow_of_the_newest(make_app, monkeypatch, tmp_path, bundled):
+    if bundled:
+        # The bundled database, migrated from before connection ids were AUTOINCREMENT
+        path = tmp_path / "bundled.db"
+        shutil.copyfile("%s/instance/beli.db" % SRC, path)
+        use_database(monkeypatch, path)
+        app = create_app("development")
+    else:
+        app = make_app()
+        path = app.config["SQLALCHEMY_DATABASE_URI"][len("sqlite:///"):]
+    other_process = sqlite3.connect(path, isolation_level=None)
+    with app.app_context():
+        # Another process follows, then unfollows (the newest connection) and follows someone else
+        other_process.execute("INSERT INTO connection (follower_id, following_id, timestamp) VALUES (2, 3, '2024-01-01')")
+        assert 3 in follow_graph.following_of(2)
+        db.session.remove()  # end the read, as a request does, so the other process can write
+        other_process.execute("DELETE FROM connection WHERE follower_id = 2 AND following_id = 3")
+        other_process.execute("INSERT INTO connection (follower_id, following_id, timestamp) VALUES (2, 4, '2024-01-01')")
+        assert 4 in follow_graph.following_of(2)
+    other_process.close()
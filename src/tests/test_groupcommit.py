@@ -0,0 +1,35 @@
+"""
+Review writes under group commit when another process holds SQLite's write lock.
+"""
+import json
+import sqlite3
+import pytest
+from app import write_committer
+from config import ProductionConfig
+
+REVIEW = json.dumps({"user_id": 4, "eatery_id": 2, "rating": 8})
+
+@pytest.fixture
+def app(make_app, monkeypatch):
+    # Give up on the lock after 200ms instead of the production profile's 5s
+    monkeypatch.setattr(ProductionConfig, "SQLITE_PRAGMAS", {**ProductionConfig.SQLITE_PRAGMAS, "busy_timeout": 200})
+    return make_app("production", STATS_MODE="sync", GROUP_COMMIT_MS=5)
+
+def test_locked_database_fails_the_batch_and_keeps_the_writer(app, database):
+    client = app.test_client()
+    other_process = sqlite3.connect(database, isolation_level=None)
+    other_process.execute("BEGIN IMMEDIATE")
+    try:
+        assert client.post("/api/reviews/", data=REVIEW).status_code == 500
+    finally:
+        other_process.execute("ROLLBACK")
+        other_process.close()
+    assert write_committer.thread.is_alive()
+    assert client.post("/api/reviews/", data=REVIEW).status_code == 201
+
+def test_writer_is_restarted_if_it_died(app):
+    write_committer.start_writer()
+    write_committer.queue.put(None)  # not a (work, future) pair: the writer thread dies on it
+    write_committer.thread.join(timeout=5)
+    assert not write_committer.thread.is_alive()
+    assert app.test_client().post("/api/reviews/", data=REVIEW).status_code == 201
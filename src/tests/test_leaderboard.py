@@ -0,0 +1,28 @@
+"""
+/api/leaderboard/ and its arguments.
+"""
+import json
+import pytest
+
+@pytest.fixture
+def client(make_app):
+    return make_app().test_client()
+
+def test_leaderboard_with_user(client):
+    response = client.get("/api/leaderboard/?limit=2&user_id=4")
+    assert response.status_code == 200
+    body = json.loads(response.data)
+    # User 3 has the most reviews; users 1 and 2 have two each, user 2's most recent
+    assert [ u["id"] for u in body["leaderboard"] ] == [3, 2]
+    assert body["user"] == {"id": 4, "ranking": 4}
+
+@pytest.mark.parametrize("query, error", [
+    ("user_id=abc", "user_id must be an integer"),
+    ("user_id=0", "user_id must be positive"),
+    ("limit=x", "limit must be an integer"),
+    ("limit=0", "limit must be positive"),
+])
+def test_bad_arguments_are_rejected(client, query, error):
+    response = client.get("/api/leaderboard/?" + query)
+    assert response.status_code == 400
+    assert json.loads(response.data) == {"error": error}
@@ -0,0 +1,41 @@
+"""
+/metrics totals, summed over the processes sharing METRICS_DIR (as gunicorn workers do).
+"""
+import multiprocessing
+from app import create_app, request_metrics
+
+REQUESTS = 5  # per process
+
+def requests_total(metrics, route):
+    prefix = 'beli_requests_total{route="%s",method="GET",status="200"} ' % route
+    return sum(int(line[len(prefix):]) for line in metrics.splitlines() if line.startswith(prefix))
+
+def worker():
+    """
+    One server process: answers a few requests, then writes its totals as a worker does.
+    """
+    client = create_app("production", check_stats=False).test_client()
+    for _ in range(REQUESTS):
+        assert client.get("/api/users/1/rating_count/").status_code == 200
+    request_metrics.write_snapshot()
+
+def test_metrics_are_summed_over_processes(make_app, tmp_path):
+    app = make_app("production", METRICS_DIR=tmp_path / "metrics")
+    context = multiprocessing.get_context("spawn")
+    processes = [ context.Process(target=worker) for _ in range(2) ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    client = app.test_client()
+    assert client.get("/api/users/1/rating_count/").status_code == 200
+    metrics = client.get("/metrics").get_data(as_text=True)
+    assert requests_total(metrics, "/api/users/<int:user_id>/rating_count/") == 2 * REQUESTS + 1
+
+def test_metrics_per_process_without_metrics_dir(make_app):
+    client = make_app().test_client()
+    assert client.get("/api/users/1/rating_count/").status_code == 200
+    metrics = client.get("/metrics").get_data(as_text=True)
+    assert requests_total(metrics, "/api/users/<int:user_id>/rating_count/") == 1
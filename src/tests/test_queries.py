@@ -0,0 +1,28 @@
+"""
+The read routes' query budgets and query plans (see check_queries.py), against the seeded sample data.
+"""
+import pytest
+from check_queries import QUERY_BUDGETS, check_app, request_route, budget_problems, route_plan_problems
+from conftest import use_database
+
+@pytest.fixture(scope="module")
+def requested(seeded_database):
+    """
+    (engine, {route: (response, statements)}) for every route in QUERY_BUDGETS, requested once in order.
+    """
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        use_database(monkeypatch, seeded_database)
+        app, client, engine = check_app("development")
+    return engine, { route: request_route(client, engine, route) for route in QUERY_BUDGETS }
+
+@pytest.mark.parametrize("route", QUERY_BUDGETS)
+def test_query_budget(requested, route):
+    response, statements = requested[1][route]
+    assert budget_problems(route, response, statements) == []
+
+@pytest.mark.parametrize("route", QUERY_BUDGETS)
+def test_query_plans(requested, route):
+    # Every query is served by an index: a dropped or unusable index fails here
+    engine, responses = requested
+    response, statements = responses[route]
+    assert route_plan_problems(engine, route, statements) == []
@@ -0,0 +1,119 @@
+"""
+Rating aggregates and the leaderboard after review writes, updated in the write's transaction
+(STATS_MODE=sync) or by the background recompute worker (see recompute.py).
+"""
+import json
+import time
+import pytest
+import app as app_module
+from app import stats_recomputer
+from db import db, User, Eatery
+from stats import LEADERBOARD_ORDER, stale_statistics
+
+def post_review(client, user_id, eatery_id, rating):
+    response = client.post("/api/reviews/", data=json.dumps({"user_id": user_id, "eatery_id": eatery_id, "rating": rating}))
+    assert response.status_code == 201
+    return json.loads(response.data)
+
+def get(client, route):
+    response = client.get(route)
+    assert response.status_code == 200
+    return json.loads(response.data)
+
+def leaderboard_in_order():
+    """
+    Whether every user's ranking is their place in LEADERBOARD_ORDER (0 for users without reviews).
+    """
+    users = User.query.order_by(*LEADERBOARD_ORDER).all()
+    expected = [ place if user.ratings_count > 0 else 0 for place, user in enumerate(users, start=1) ]
+    return [ user.ranking for user in users ] == expected
+
+@pytest.fixture
+def background_app(make_app):
+    """
+    An app in background mode whose worker, left alone, waits a minute before recomputing, so
+    tests see the pending state and decide when to flush.
+    """
+    return make_app(STATS_MODE="background", STATS_DEBOUNCE_MS=60000, STATS_MAX_STALENESS_MS=60000)
+
+def test_sync_mode_updates_in_the_write(make_app):
+    app = make_app(STATS_MODE="sync")
+    client = app.test_client()
+    for eatery_id in (2, 3, 4):
+        post_review(client, 4, eatery_id, 8)
+    assert get(client, "/api/users/4/rating_count/") == {"ratings_count": 4}
+    assert get(client, "/api/users/4/ranking/") == {"ranking": 1}
+    assert stats_recomputer.stats()["pending_users"] == 0
+    with app.app_context():
+        assert stale_statistics() == []
+        assert leaderboard_in_order()
+
+def test_background_mode_defers_until_flushed(background_app):
+    client = background_app.test_client()
+    post_review(client, 4, 2, 9)
+    post_review(client, 4, 3, 7)
+    post_review(client, 2, 3, 4)
+
+    pending = stats_recomputer.stats()
+    assert (pending["pending_users"], pending["pending_eateries"], pending["events"]) == (2, 2, 3)
+    with background_app.app_context():
+        assert db.session.get(User, 4).ratings_count == 1
+        assert stale_statistics() != []
+
+    flushed = json.loads(client.post("/api/admin/flush/").data)
+    # The three events were coalesced into one recompute
+    assert flushed["flushed"] == {"users": 2, "eateries": 2}
+    assert flushed["recompute"]["recomputes"] == 1
+    assert flushed["recompute"]["pending_users"] == 0
+    user = get(client, "/api/users/4/")
+    # User 2 reached three reviews later, so ranks ahead of user 4
+    assert (user["ratings_count"], user["average_rating"], user["ranking"]) == (3, 7.6, 2)
+    with background_app.app_context():
+        assert stale_statistics() == []
+        assert leaderboard_in_order()
+        assert db.session.get(Eatery, 3).ratings_count == 3
+
+def test_worker_recomputes_within_max_staleness(make_app):
+    app = make_app(STATS_MODE="background", STATS_DEBOUNCE_MS=10, STATS_MAX_STALENESS_MS=50)
+    client = app.test_client()
+    post_review(client, 4, 2, 9)
+    deadline = time.monotonic() + 5
+    while stats_recomputer.stats()["recomputes"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert stats_recomputer.stats()["recomputes"] == 1
+    assert get(client, "/api/users/4/rating_count/") == {"ratings_count": 2}
+    with app.app_context():
+        assert stale_statistics() == []
+
+def test_failed_recompute_is_queued_again(background_app, monkeypatch):
+    client = background_app.test_client()
+    post_review(client, 4, 2, 9)
+
+    def fail(work):
+        raise RuntimeError("database went away")
+    with monkeypatch.context() as patch:
+        patch.setattr(stats_recomputer.committer, "run", fail)
+        with pytest.raises(RuntimeError):
+            stats_recomputer.flush()
+    assert stats_recomputer.stats()["pending_users"] == 1
+
+    assert stats_recomputer.flush() == {"users": 1, "eateries": 1}
+    with background_app.app_context():
+        assert stale_statistics() == []
+
+@pytest.mark.parametrize("limit", [1, 50])
+def test_cached_rankings_follow_the_leaderboard(make_app, monkeypatch, limit):
+    # With a limit of 1 every move drops all cached user views; with 50, just the moved users'
+    monkeypatch.setattr(app_module, "RANK_INVALIDATION_LIMIT", limit)
+    app = make_app(STATS_MODE="sync")
+    client = app.test_client()
+    def rankings():
+        return { user_id: get(client, "/api/users/%d/ranking/" % user_id)["ranking"] for user_id in (1, 2, 3, 4) }
+    before = rankings()
+    for eatery_id in (2, 3, 4):
+        rankings()  # cache every user's view before each move
+        post_review(client, 4, eatery_id, 8)
+    with app.app_context():
+        expected = dict(db.session.query(User.id, User.ranking))
+    assert rankings() == expected
+    assert expected[4] == 1 and before != expected
@@ -0,0 +1,27 @@
+"""
+/api/eateries/top/ and its arguments.
+"""
+import json
+import pytest
+
+@pytest.fixture
+def client(make_app):
+    return make_app().test_client()
+
+def test_min_reviews_filters(client):
+    response = client.get("/api/eateries/top/?min_reviews=2")
+    assert response.status_code == 200
+    # Mattin's Cafe is the only seeded eatery with more than one review
+    assert [ e["id"] for e in json.loads(response.data)["eateries"] ] == [19]
+
+@pytest.mark.parametrize("query, error", [
+    ("min_reviews=abc", "min_reviews must be an integer"),
+    ("min_reviews=0", "min_reviews must be positive"),
+    ("min_reviews=-3", "min_reviews must be positive"),
+    ("limit=x", "limit must be an integer"),
+    ("limit=0", "limit must be positive"),
+])
+def test_bad_arguments_are_rejected(client, query, error):
+    response = client.get("/api/eateries/top/?" + query)
+    assert response.status_code == 400
+    assert json.loads(response.data) == {"error": error}
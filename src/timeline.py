@@ -0,0 +1,106 @@
+from db import db, User, Connection, Review, TimelineEntry
+from sqlalchemy import bindparam, delete, func, insert, literal, select
+from sqlalchemy.orm import aliased
+
+# Max number of reviews kept in each user's home timeline
+TIMELINE_CAP = 500
+
+TIMELINE_COLUMNS = ["owner_id", "review_id", "author_id", "timestamp"]
+
+def trim_timelines(owner_ids):
+    """
+    Drop everything older than the newest TIMELINE_CAP entries of each given owner's timeline.
+    owner_ids may be a list or a subquery.
+    """
+    # Find each owner's cutoff once, rather than once per timeline row in a correlated DELETE
+    newer = aliased(TimelineEntry)
+    cutoff = select(newer.timestamp).where(
+        newer.owner_id == User.id
+    ).order_by(newer.timestamp.desc()).offset(TIMELINE_CAP - 1).limit(1).scalar_subquery()
+    cutoffs = [
+        {"owner": owner_id, "cutoff": timestamp}
+        for owner_id, timestamp in db.session.execute(select(User.id, cutoff).where(User.id.in_(owner_ids)))
+        if timestamp is not None
+    ]
+    if cutoffs:
+        db.session.execute(delete(TimelineEntry).where(
+            TimelineEntry.owner_id == bindparam("owner"), TimelineEntry.timestamp < bindparam("cutoff")
+        ).execution_options(synchronize_session=False), cutoffs)
+
+def fan_out_review(review):
+    """
+    Append a newly created review to the timelines of everyone following its author.
+    The review must already be flushed so that it has an id.
+    """
+    followers = select(Connection.follower_id).where(Connection.following_id == review.user_id)
+    db.session.execute(insert(TimelineEntry).from_select(TIMELINE_COLUMNS, select(
+        Connection.follower_id, literal(review.id), literal(review.user_id), literal(review.timestamp, db.DateTime)
+    ).where(Connection.following_id == review.user_id)))
+    trim_timelines(followers)
+
+def fan_out_reviews(review_filter, author_ids):
+    """
+    Append many newly created reviews, selected by review_filter (a condition on Review),
+    to the timelines of everyone following their authors, in one INSERT ... SELECT.
+    """
+    db.session.execute(insert(TimelineEntry).from_select(TIMELINE_COLUMNS, select(
+        Connection.follower_id, Review.id, Review.user_id, Review.timestamp
+    ).join(Connection, Connection.following_id == Review.user_id).where(review_filter)))
+    trim_timelines(select(Connection.follower_id).where(Connection.following_id.in_(author_ids)).distinct())
+
+def touch_review(review):
+    """
+    Move an edited review to its new timestamp in its author's followers' timelines.
+    Re-fans it out, since the bumped timestamp may bring it back into timelines that had trimmed it.
+    """
+    remove_review([review.id])
+    fan_out_review(review)
+
+def remove_review(review_ids):
+    """
+    Remove reviews from every timeline. review_ids may be a list or a subquery.
+    """
+    TimelineEntry.query.filter(TimelineEntry.review_id.in_(review_ids)).delete(synchronize_session=False)
+
+def backfill_timeline(follower_id, following_id):
+    """
+    Copy the newest reviews of a just-followed user into the follower's timeline.
+    """
+    recent = select(
+        literal(follower_id), Review.id, Review.user_id, Review.timestamp
+    ).where(Review.user_id == following_id).order_by(Review.timestamp.desc()).limit(TIMELINE_CAP)
+    db.session.execute(insert(TimelineEntry).from_select(TIMELINE_COLUMNS, recent))
+    trim_timelines([follower_id])
+
+def purge_timeline(follower_id, following_id):
+    """
+    Remove a just-unfollowed user's reviews from the follower's timeline.
+    """
+    TimelineEntry.query.filter_by(owner_id=follower_id, author_id=following_id).delete(synchronize_session=False)
+
+def remove_user(user_id):
+    """
+    Remove a user's own timeline and their reviews from everyone else's.
+    """
+    TimelineEntry.query.filter(
+        (TimelineEntry.owner_id == user_id) | (TimelineEntry.author_id == user_id)
+    ).delete(synchronize_session=False)
+
+def rebuild_timelines():
+    """
+    Rebuild every timeline from the Connection and Review tables.
+    """
+    TimelineEntry.query.delete(synchronize_session=False)
+    # Number each follower's candidate entries newest first and keep the first TIMELINE_CAP,
+    # rather than inserting them all and trimming each timeline afterwards
+    candidates = select(
+        Connection.follower_id.label("owner_id"), Review.id.label("review_id"),
+        Review.user_id.label("author_id"), Review.timestamp.label("timestamp"),
+        func.row_number().over(
+            partition_by=Connection.follower_id, order_by=(Review.timestamp.desc(), Review.id.desc())
+        ).label("position")
+    ).join(Review, Review.user_id == Connection.following_id).subquery()
+    db.session.execute(insert(TimelineEntry).from_select(TIMELINE_COLUMNS, select(
+        candidates.c.owner_id, candidates.c.review_id, candidates.c.author_id, candidates.c.timestamp
+    ).where(candidates.c.position <= TIMELINE_CAP)))
+    db.session.commit()
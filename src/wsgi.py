@@ -0,0 +1,11 @@
+"""
+WSGI entry point for production servers, e.g. `gunicorn wsgi:app` (see gunicorn.conf.py).
+"""
+from app import create_app, follow_graph
+
+app = create_app()
+
+# Load the follow graph up front: with preload_app this runs once in the gunicorn master, and
+# the workers it forks start with the graph instead of each loading it on a first request
+with app.app_context():
+    follow_graph.refresh()